@@ -1,16 +1,19 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from datetime import date
-from decimal import Decimal
+from functools import partial
 
 from django.conf import settings
 
 from . import adi_config as config, ADI_JOURNAL_LABEL
+from .datasets import DailyDataset
 from .exceptions import EmptyFileError
+from .profiling import profile_stage, profiled_stage
+from .rendering import JournalRow, compile_value, format_values
+from .streaming import StreamingJournal
 from .types import PaymentType, RecordType
 from .utils import (
-    Journal, retrieve_all_transactions, retrieve_all_valid_credits,
-    reconcile_for_date, retrieve_prisons, get_full_narrative,
-    get_or_create_file
+    Journal, reconcile_for_date, get_full_narrative,
+    get_or_create_file, patch_cell_values, run_concurrently
 )
 
 
@@ -21,11 +24,18 @@ def get_adi_journal_file(api_session, receipt_date, user=None):
         generate_adi_journal,
         f_args=[api_session, receipt_date],
         f_kwargs={'user': user},
-        file_extension='xlsm'
+        file_extension='xlsm',
+        stream=True,
     )
+    sheet_name = receipt_date.strftime('%d%m%y')
+    try:
+        # only the batch name is personalised so the cached package is patched rather than re-saved
+        return patch_cell_values(filepath, sheet_name, {config.ADI_BATCH_NAME_CELL: get_batch_name(user)})
+    except ValueError:
+        pass
     journal = AdiJournal(
         filepath,
-        receipt_date.strftime('%d%m%y'),
+        sheet_name,
         config.ADI_JOURNAL_START_ROW,
         config.ADI_JOURNAL_FIELDS
     )
@@ -33,7 +43,63 @@ def get_adi_journal_file(api_session, receipt_date, user=None):
     return journal.create_file()
 
 
-class AdiJournal(Journal):
+def get_batch_name(user=None):
+    return config.ADI_BATCH_NAME_FORMAT % {
+        'date': date.today().strftime(config.ADI_BATCH_DATE_FORMAT),
+        'initials': user.get_initials() if user else '<initials>',
+    }
+
+
+# compiled values of a payment row's cells in field order and the position of the cell that receives the amount
+RowTemplate = namedtuple('RowTemplate', 'cells amount_index')
+
+
+class AdiRowLayout:
+    """
+    Computes the cells of ADI journal payment rows. A row template is compiled once for each payment
+    and record type, resolving static values so that only context-dependent values are formatted for each row.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.row_templates = {}
+
+    def get_row_template(self, payment_type, record_type):
+        key = (payment_type, record_type)
+        row_template = self.row_templates.get(key)
+        if row_template is None:
+            amount_field = {RecordType.debit: 'debit', RecordType.credit: 'credit'}.get(record_type)
+            cells = []
+            amount_index = None
+            for index, field in enumerate(self.fields):
+                if field == amount_field:
+                    amount_index = index
+                try:
+                    value = self.fields[field]['value'][payment_type.name][record_type.name] or None
+                except KeyError:
+                    value = None  # no static value
+                cells.append(compile_value(value))
+            row_template = RowTemplate(cells, amount_index)
+            self.row_templates[key] = row_template
+        return row_template
+
+    def payment_row(self, amount, payment_type, record_type, **kwargs):
+        row_template = self.get_row_template(payment_type, record_type)
+        values = format_values(row_template.cells, kwargs)
+        if row_template.amount_index is not None:
+            values[row_template.amount_index] = float(amount)
+        return JournalRow(tuple(values))
+
+
+class AdiJournalMixin:
+    """
+    Adds payment rows and the totals footer to an ADI journal rendered by either `Journal` or `StreamingJournal`
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.row_layout = AdiRowLayout(self.fields)
+
     def _add_column_sum(self, field):
         self.set_field(
             field,
@@ -43,29 +109,12 @@ class AdiJournal(Journal):
                     'start': self.start_row,
                     'end': self.current_row - 1
                 }),
-            extra_style=config.ADI_FINAL_ROW_STYLE
+            extra_style=config.ADI_FINAL_ROW_STYLE,
+            number_format='£#,##0.00_-'
         )
-        cell = self.get_cell(field)
-        self.journal_ws[cell].number_format = '£#,##0.00_-'
-
-    def lookup(self, field, payment_type, record_type, context=None):
-        context = context or {}
-
-        try:
-            value_dict = self.fields[field]['value']
-            value = value_dict[payment_type.name][record_type.name]
-            if value:
-                return value.format(**context)
-        except KeyError:
-            pass  # no static value
-        return None
 
     def set_batch_name(self, user=None):
-        batch_date = date.today().strftime(config.ADI_BATCH_DATE_FORMAT)
-        self.journal_ws[config.ADI_BATCH_NAME_CELL] = config.ADI_BATCH_NAME_FORMAT % {
-            'date': batch_date,
-            'initials': user.get_initials() if user else '<initials>',
-        }
+        self.set_cell_value(config.ADI_BATCH_NAME_CELL, get_batch_name(user))
 
     def finish_journal(self, receipt_date, user=None):
         for field in self.fields:
@@ -77,10 +126,9 @@ class AdiJournal(Journal):
         self._add_column_sum('debit')
         self._add_column_sum('credit')
 
-        self.journal_ws.title = receipt_date.strftime('%d%m%y')
-        self.wb.create_named_range(
+        self.set_title(receipt_date.strftime('%d%m%y'))
+        self.create_named_range(
             'BNE_UPLOAD',
-            self.journal_ws,
             '$B$%(start)s:$B$%(end)s' % {
                 'start': self.start_row,
                 'end': self.current_row - 1,
@@ -100,40 +148,33 @@ class AdiJournal(Journal):
         accounting_date = date.today()
         if accounting_date.month != receipt_date.month:
             accounting_date = receipt_date
-        self.journal_ws[config.ADI_DATE_CELL] = accounting_date.strftime(config.ADI_DATE_FORMAT)
+        self.set_cell_value(config.ADI_DATE_CELL, accounting_date.strftime(config.ADI_DATE_FORMAT))
 
     def add_payment_row(self, amount, payment_type, record_type, **kwargs):
-        for field in self.fields:
-            static_value = self.lookup(field, payment_type, record_type, context=kwargs)
-            self.set_field(field, static_value)
+        self.add_row(self.row_layout.payment_row(amount, payment_type, record_type, **kwargs))
 
-        if record_type == RecordType.debit:
-            self.set_field('debit', float(amount))
-        elif record_type == RecordType.credit:
-            self.set_field('credit', float(amount))
 
-        self.next_row()
+class AdiJournal(AdiJournalMixin, Journal):
+    """
+    ADI journal built with openpyxl, also used to personalise cached journals that cannot be patched
+    """
 
 
-def generate_adi_journal(api_session, receipt_date, user=None):
-    start_date, end_date = reconcile_for_date(api_session, receipt_date)
+class StreamingAdiJournal(AdiJournalMixin, StreamingJournal):
+    """
+    ADI journal streamed into a copy of the workbook template
+    """
 
-    credits = retrieve_all_valid_credits(
-        api_session,
-        received_at__gte=start_date,
-        received_at__lt=end_date
-    )
-    refundable_transactions = retrieve_all_transactions(
-        api_session,
-        status='refundable',
-        received_at__gte=start_date,
-        received_at__lt=end_date
-    )
-    rejected_transactions = retrieve_all_transactions(
-        api_session,
-        status='unidentified',
-        received_at__gte=start_date,
-        received_at__lt=end_date
+
+def generate_adi_journal(api_session, receipt_date, user=None, output=None):
+    reconcile_for_date(api_session, receipt_date)
+
+    dataset = DailyDataset(api_session, receipt_date)
+    credits, refundable_transactions, rejected_transactions, prison_registry = run_concurrently(
+        dataset.credits,
+        partial(dataset.transactions, 'refundable'),
+        partial(dataset.transactions, 'unidentified'),
+        dataset.prison_registry,
     )
 
     if (len(credits) == 0 and
@@ -141,95 +182,131 @@ def generate_adi_journal(api_session, receipt_date, user=None):
             len(refundable_transactions) == 0):
         raise EmptyFileError()
 
-    journal_date = receipt_date.strftime('%d/%m/%Y')
-    journal = AdiJournal(
+    rows = get_adi_journal_rows(
+        receipt_date, credits, refundable_transactions, rejected_transactions, prison_registry
+    )
+    return render_adi_journal(rows, receipt_date, user=user, output=output)
+
+
+def render_adi_journal(rows, receipt_date, user=None, output=None):
+    """
+    Renders ADI journal rows into the workbook template,
+    streaming the package unless STREAM_JOURNAL_WORKBOOKS is disabled to use openpyxl
+    """
+    journal_class = StreamingAdiJournal if settings.STREAM_JOURNAL_WORKBOOKS else AdiJournal
+    journal = journal_class(
         settings.ADI_TEMPLATE_FILEPATH,
         config.ADI_JOURNAL_SHEET,
         config.ADI_JOURNAL_START_ROW,
         config.ADI_JOURNAL_FIELDS
     )
+    with profile_stage('render rows'):
+        for row in rows:
+            journal.add_row(row)
+        journal.finish_journal(receipt_date, user)
+    with profile_stage('save workbook'):
+        return journal.create_file(output)
+
+
+@profiled_stage('rows')
+def get_adi_journal_rows(receipt_date, credits, refundable_transactions, rejected_transactions, prison_registry,
+                         fields=config.ADI_JOURNAL_FIELDS):
+    """
+    Computes the payment rows of an ADI journal without building a workbook
+    :return: list of JournalRow
+    """
+    journal_date = receipt_date.strftime('%d/%m/%Y')
+    layout = AdiRowLayout(fields)
+    rows = []
 
-    prisons = retrieve_prisons(api_session)
-    bu_lookup = {prison['general_ledger_code']: nomis_id for nomis_id, prison in prisons.items()}
-    private_estate_cost_centre = {
-        prison['general_ledger_code']
-        for nomis_id, prison in prisons.items()
-        if prison.get('private_estate')
-    }
-
-    debit_card_batches = defaultdict(int)
-    prison_totals = defaultdict(int)
-    prison_transactions = defaultdict(list)
-    for credit in credits:
-        business_unit = prisons[credit['prison']]['general_ledger_code']
-        amount = Decimal(credit['amount']) / 100
-        prison_totals[business_unit] += amount
-        if credit['source'] == 'online':
-            if credit['reconciliation_code']:
-                card_reconciliation_code = credit['reconciliation_code']
-            else:
-                card_reconciliation_code = '%s - Card payment' % journal_date
-            debit_card_batches[card_reconciliation_code] += amount
-        else:
-            prison_transactions[business_unit].append(credit)
+    private_estate_cost_centre = prison_registry.private_estate_ledger_codes
+    debit_card_batches, prison_totals, prison_transactions = aggregate_credits(
+        credits, prison_registry, journal_date
+    )
 
     # add valid payment rows
     # debit card batches
     for batch_code in debit_card_batches:
-        journal.add_payment_row(
-            debit_card_batches[batch_code], PaymentType.payment, RecordType.debit,
+        rows.append(layout.payment_row(
+            to_pounds(debit_card_batches[batch_code]), PaymentType.payment, RecordType.debit,
             reconciliation_code=batch_code
-        )
+        ))
     # other credits
     for business_unit in prison_totals:
         for transaction in prison_transactions.get(business_unit, []):
-            journal.add_payment_row(
-                Decimal(transaction['amount']) / 100,
+            rows.append(layout.payment_row(
+                to_pounds(transaction['amount']),
                 PaymentType.payment, RecordType.debit,
                 reconciliation_code=transaction['reconciliation_code']
-            )
-        journal.add_payment_row(
-            prison_totals[business_unit], PaymentType.payment, RecordType.credit,
+            ))
+        rows.append(layout.payment_row(
+            to_pounds(prison_totals[business_unit]), PaymentType.payment, RecordType.credit,
             prison_ledger_code=business_unit,
             prison_name=(
                 'Private estate'
                 if business_unit in private_estate_cost_centre else
-                prisons[bu_lookup[business_unit]]['name']
+                prison_registry.by_ledger_code[business_unit]['name']
             ),
             date=journal_date
-        )
+        ))
 
-    add_refund_rows(journal, journal_date, refundable_transactions)
-    add_reject_rows(journal, journal_date, rejected_transactions)
+    rows.extend(get_refund_rows(layout, journal_date, refundable_transactions))
+    rows.extend(get_reject_rows(layout, journal_date, rejected_transactions))
+    return rows
 
-    journal.finish_journal(receipt_date, user)
-    return journal.create_file()
+
+def to_pounds(pence):
+    # amounts are summed in integer pence and only converted when written,
+    # giving the same value as the exact decimal division
+    return pence / 100
+
+
+def aggregate_credits(credits, prison_registry, journal_date):
+    """
+    Groups credits by card payment batch and by business unit, summing amounts in integer pence
+    :return: tuple of card payment batch totals by reconciliation code, credit totals by business unit
+        and lists of other credits by business unit
+    """
+    ledger_codes = prison_registry.ledger_codes
+    default_card_reconciliation_code = '%s - Card payment' % journal_date
+
+    debit_card_batches = defaultdict(int)
+    prison_totals = defaultdict(int)
+    prison_transactions = defaultdict(list)
+    for credit in credits:
+        business_unit = ledger_codes[credit['prison']]
+        amount = credit['amount']
+        prison_totals[business_unit] += amount
+        if credit['source'] == 'online':
+            debit_card_batches[credit['reconciliation_code'] or default_card_reconciliation_code] += amount
+        else:
+            prison_transactions[business_unit].append(credit)
+    return debit_card_batches, prison_totals, prison_transactions
 
 
-def add_refund_rows(journal, journal_date, refundable_transactions):
+def get_refund_rows(layout, journal_date, refundable_transactions):
     refund_total = 0
     for refund in refundable_transactions:
-        refund_amount = Decimal(refund['amount']) / 100
-        refund_total += refund_amount
-        journal.add_payment_row(
-            refund_amount, PaymentType.refund, RecordType.debit,
+        refund_total += refund['amount']
+        yield layout.payment_row(
+            to_pounds(refund['amount']), PaymentType.refund, RecordType.debit,
             reconciliation_code=str(refund['ref_code'])
         )
     if refundable_transactions:
-        journal.add_payment_row(
-            refund_total, PaymentType.refund, RecordType.credit, date=journal_date
+        yield layout.payment_row(
+            to_pounds(refund_total), PaymentType.refund, RecordType.credit, date=journal_date
         )
 
 
-def add_reject_rows(journal, journal_date, rejected_transactions):
+def get_reject_rows(layout, journal_date, rejected_transactions):
     for reject in rejected_transactions:
-        reject_amount = Decimal(reject['amount']) / 100
+        reject_amount = to_pounds(reject['amount'])
         reference = get_full_narrative(reject)
-        journal.add_payment_row(
+        yield layout.payment_row(
             reject_amount, PaymentType.reject, RecordType.debit,
             reconciliation_code=str(reject['ref_code'])
         )
-        journal.add_payment_row(
+        yield layout.payment_row(
             reject_amount, PaymentType.reject, RecordType.credit,
             reference=reference, date=journal_date
         )
@@ -0,0 +1,88 @@
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from mtp_common.auth.exceptions import HttpServerError
+import requests
+
+logger = logging.getLogger('mtp')
+
+# failures that are likely to succeed if the same request is repeated
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, HttpServerError)
+
+
+class RetryBudget:
+    """
+    Limits how many times requests can be retried during one operation, such as loading all pages of a list,
+    so that an unavailable api is not retried for every request in turn
+    """
+
+    def __init__(self, retries=None):
+        self.remaining = settings.REQUEST_RETRY_BUDGET if retries is None else retries
+        self.attempts = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        """
+        Takes a retry from the budget
+        :return: the delay to wait before retrying or None if the budget is spent
+        """
+        with self.lock:
+            if self.remaining <= 0:
+                return None
+            self.remaining -= 1
+            attempt = self.attempts
+            self.attempts += 1
+        # exponential backoff with full jitter so that parallel requests do not retry in lockstep
+        return random.uniform(0, min(
+            settings.REQUEST_RETRY_MAX_DELAY,
+            settings.REQUEST_RETRY_BASE_DELAY * 2 ** attempt,
+        ))
+
+
+def get_with_retries(api_session, path, budget=None, **kwargs):
+    """
+    Makes a GET request, retrying transient failures with backoff while the budget allows.
+    Only idempotent requests can be safely retried.
+    :param budget: RetryBudget shared by all requests in the operation
+    """
+    budget = budget or RetryBudget()
+    while True:
+        try:
+            return api_session.get(path, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            delay = budget.spend()
+            if delay is None:
+                raise
+            logger.warning('Retrying %s in %.1fs after error: %r', path, delay, e)
+            time.sleep(delay)
+
+
+def retrieve_all_pages_for_path(api_session, path, budget=None, **params):
+    """
+    Loads all pages of a paginated api list into a single results list,
+    like `mtp_common.api.retrieve_all_pages_for_path`, but retrying failed pages so
+    that loading resumes from the last page received instead of starting over
+    :param api_session: Requests Session object
+    :param path: URL path
+    :param budget: RetryBudget shared by all pages
+    :param params: additional URL params
+    """
+    budget = budget or RetryBudget()
+    page_size = settings.REQUEST_PAGE_SIZE
+    loaded_results = []
+
+    while True:
+        response = get_with_retries(
+            api_session, path, budget=budget,
+            params=dict(limit=page_size, offset=len(loaded_results), **params)
+        )
+        content = response.json()
+        results = content.get('results', [])
+        loaded_results += results
+        if not results or len(loaded_results) >= content.get('count', 0):
+            break
+
+    return loaded_results
@@ -0,0 +1,271 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date, timedelta
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from . import (
+    adi, disbursements, refund, statement, utils, ADI_JOURNAL_LABEL, ACCESSPAY_LABEL,
+    MT940_STMT_LABEL, DISBURSEMENTS_LABEL
+)
+from .datasets import DailySnapshot
+from .fixtures import BANK_ACCOUNT, PRISONS
+
+BENCHMARK_VOLUMES = (1000, 10000, 100000)
+BENCHMARK_DATE = date(2016, 9, 13)
+BENCHMARK_BASELINE_PATH = 'local_files/benchmarks/baseline.json'
+
+# functions that generate each file from its receipt date's dataset
+BENCHMARKED_GENERATORS = {
+    ADI_JOURNAL_LABEL: adi.generate_adi_journal,
+    MT940_STMT_LABEL: statement.generate_bank_statement,
+    ACCESSPAY_LABEL: refund.generate_refund_file_for_date,
+    DISBURSEMENTS_LABEL: disbursements.generate_disbursements_journal,
+}
+
+
+class BenchmarkResult(namedtuple('BenchmarkResult', 'label volume seconds peak_memory')):
+    __slots__ = ()
+
+    @property
+    def records_per_second(self):
+        return self.volume / self.seconds if self.seconds else 0
+
+    def as_dict(self):
+        return {
+            'seconds': self.seconds,
+            'peak_memory': self.peak_memory,
+            'records_per_second': self.records_per_second,
+        }
+
+
+class BenchmarkApiSession:
+    """
+    Stands in for an api session so that benchmarks only measure generation from a prepared snapshot
+    """
+
+    def get(self, *args, **kwargs):
+        raise RuntimeError('Benchmarked file generation should not load data from the api')
+
+    def post(self, *args, **kwargs):
+        # reconciliation is accepted without being sent anywhere
+        return None
+
+
+def build_credits(volume, rng):
+    credits = []
+    for i in range(volume):
+        credit = {
+            'id': i,
+            'status': 'credited',
+            'amount': rng.randint(500, 5000),
+            'prison': PRISONS[i % len(PRISONS)]['nomis_id'],
+        }
+        if i % 2:
+            credit.update(source='bank_transfer', reconciliation_code='9%05d' % rng.randint(0, 99999))
+        else:
+            credit.update(source='online', reconciliation_code='800001')
+        credits.append(credit)
+    return credits
+
+
+def build_transactions(volume, received_at, rng):
+    """
+    Builds bank transactions where, like the bank statement tests, a quarter are administrative debits
+    and a fifth of the credits are refunded
+    """
+    transactions = []
+    for i in range(volume):
+        transaction = {
+            'id': i,
+            'category': 'debit' if i % 4 == 3 else 'credit',
+            'amount': rng.randint(500, 5000),
+            'ref_code': '9%05d' % rng.randint(0, 99999),
+            'received_at': received_at,
+            'sender_sort_code': '112233',
+            'sender_account_number': '12345678',
+        }
+        if transaction['category'] == 'credit':
+            if i % 5 == 0:
+                transaction['refunded'] = True
+            elif i % 12:
+                transaction['credited'] = True
+                transaction['prison'] = PRISONS[i % 4]['nomis_id']
+        if i % 5:
+            transaction.update(sender_name='sender', reference='reference', reference_in_sender_field=False)
+        else:
+            transaction.update(sender_name='reference', reference_in_sender_field=True)
+        transactions.append(transaction)
+    return transactions
+
+
+def build_disbursements(volume, rng):
+    disbursements = []
+    for i in range(volume):
+        disbursement_id = i + 95
+        invoice_number = 1000000 + disbursement_id
+        disbursement = {
+            'id': disbursement_id,
+            'amount': rng.randint(500, 5000),
+            'invoice_number': str(invoice_number) if invoice_number < 1000100 else 'PMD%s' % invoice_number,
+            'prisoner': 'A%dAE' % rng.randint(1000, 9999),
+            'prison': PRISONS[i % 4]['nomis_id'],
+            'recipient_first_name': 'Stan', 'recipient_last_name': 'White',
+            'recipient_email': '', 'remittance_description': '' if i % 2 else 'FEES',
+            'address_line1': '50 Fake Street',
+            'address_line2': '',
+            'city': 'London',
+            'postcode': 'N17 9LK',
+            'country': 'United Kingdom',
+            'resolution': 'confirmed',
+            'email': 'person@mtp.local',
+            'log_set': [
+                {'user': {'first_name': 'John', 'last_name': 'Smith'}, 'action': 'created'},
+                {'user': {'first_name': 'Pearl', 'last_name': 'Vance'}, 'action': 'confirmed'},
+            ],
+            'roll_number': '',
+        }
+        if i % 3 == 0:
+            disbursement.update(method='cheque', sort_code='', account_number='')
+        else:
+            disbursement.update(method='bank_transfer', sort_code='123456', account_number='12345678')
+        disbursements.append(disbursement)
+    return disbursements
+
+
+def build_private_estate_batches(receipt_date, rng):
+    return [
+        {
+            'date': receipt_date.isoformat(),
+            'prison': prison['nomis_id'],
+            'total_amount': rng.randint(5000, 200000),
+            'bank_account': dict(BANK_ACCOUNT),
+            'remittance_emails': ['private@mtp.local'],
+        }
+        for prison in PRISONS
+        if prison['private_estate']
+    ]
+
+
+def build_sources(volume, receipt_date=BENCHMARK_DATE, seed=0):
+    """
+    Builds a synthetic dataset for a receipt date with `volume` each of credits, transactions and disbursements,
+    in the shape that the api returns them
+    :param seed: makes amounts and references repeatable so that benchmark runs are comparable
+    :return: dict of daily snapshot sources
+    """
+    rng = random.Random(seed)
+    transactions = build_transactions(volume, receipt_date.isoformat() + 'T12:00:00Z', rng)
+    credit_transactions = [transaction for transaction in transactions if transaction['category'] == 'credit']
+    return {
+        'credits': build_credits(volume, rng),
+        'transactions:all': transactions,
+        'transactions:refundable': [
+            transaction for transaction in credit_transactions if transaction.get('refunded')
+        ],
+        'transactions:unidentified': [
+            transaction for transaction in credit_transactions
+            if not transaction.get('refunded') and not transaction.get('credited')
+        ],
+        'disbursements': build_disbursements(volume, rng),
+        'private_estate_batches': build_private_estate_batches(receipt_date, rng),
+        'prisons': PRISONS,
+        'last_balance': {'date': (receipt_date - timedelta(days=1)).isoformat(), 'closing_balance': 1000000},
+    }
+
+
+@contextmanager
+def temporary_file_cache():
+    """
+    Points the file cache at a temporary directory so that benchmarks never read or replace
+    cached files, snapshots or reconciliation markers of real receipt dates
+    """
+    cache_path = tempfile.mkdtemp(prefix='benchmark-cache-')
+    original_cache_path = utils.FILE_CACHE_PATH
+    utils.FILE_CACHE_PATH = cache_path
+    try:
+        yield cache_path
+    finally:
+        utils.FILE_CACHE_PATH = original_cache_path
+        shutil.rmtree(cache_path, ignore_errors=True)
+
+
+def run_benchmark(label, volume, receipt_date=BENCHMARK_DATE, repeat=1):
+    """
+    Times a file generator with the receipt date's prepared snapshot, taking the best of `repeat` runs.
+    Peak memory is measured in a separate run since tracing allocations slows generation down.
+    """
+    generator = BENCHMARKED_GENERATORS[label]
+    api_session = BenchmarkApiSession()
+
+    timings = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        generator(api_session, receipt_date)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        generator(api_session, receipt_date)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(label, volume, min(timings), peak_memory)
+
+
+def run_benchmarks(volumes=BENCHMARK_VOLUMES, labels=None, receipt_date=BENCHMARK_DATE, repeat=1):
+    """
+    Benchmarks each file generator at each volume of synthetic records
+    :return: list of BenchmarkResult
+    """
+    labels = labels or list(BENCHMARKED_GENERATORS)
+    results = []
+    for volume in volumes:
+        # each volume starts from an empty cache so that every run reconciles in the same way
+        with temporary_file_cache():
+            DailySnapshot(receipt_date).replace(build_sources(volume, receipt_date))
+            for label in labels:
+                results.append(run_benchmark(label, volume, receipt_date=receipt_date, repeat=repeat))
+    return results
+
+
+def load_baseline(path=BENCHMARK_BASELINE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baseline(results, path=BENCHMARK_BASELINE_PATH):
+    """
+    Saves results as the baseline, keeping baselines of generators and volumes that were not benchmarked
+    """
+    baseline = load_baseline(path)
+    for result in results:
+        baseline.setdefault(result.label, {})[str(result.volume)] = result.as_dict()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """
+    Compares results with a baseline
+    :param tolerance: fraction by which time or peak memory can exceed the baseline
+    :return: list of (result, measure, baseline value) for each measure that regressed
+    """
+    regressions = []
+    for result in results:
+        expected = baseline.get(result.label, {}).get(str(result.volume))
+        if not expected:
+            continue
+        for measure in ('seconds', 'peak_memory'):
+            if getattr(result, measure) > expected[measure] * (1 + tolerance):
+                regressions.append((result, measure, expected[measure]))
+    return regressions
@@ -0,0 +1,146 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from .prisons import PrisonRegistry, get_prison_registry
+from .profiling import profile_stage
+from .utils import (
+    get_cached_file_path, get_start_and_end_date, retrieve_all_disbursements, retrieve_all_transactions,
+    retrieve_all_valid_credits, retrieve_last_balance, retrieve_private_estate_batches,
+)
+
+SNAPSHOT_LABEL = 'SOURCE_DATA'
+
+
+class DailySnapshot:
+    """
+    Compressed copies of raw api results for a receipt date, stored alongside the file cache.
+    Each source is saved once in its own file so that sources loaded in parallel
+    are written and read independently without rewriting the others.
+    """
+    # snapshots are short-lived so fast compression matters more than size
+    compress_level = 1
+
+    def __init__(self, receipt_date):
+        self.path = get_cached_file_path(SNAPSHOT_LABEL, receipt_date)
+        self._sources = {}
+
+    def get_source_path(self, name):
+        return os.path.join(self.path, '%s.json.gz' % name.replace(':', '-'))
+
+    def get(self, name, loader):
+        """
+        Returns a source from the snapshot, loading and saving it first if necessary
+        :param name: source name
+        :param loader: callable that loads the source from the api
+        """
+        if name in self._sources:
+            return self._sources[name]
+
+        with profile_stage('read snapshot'):
+            found, value = self._read(name)
+        if not found:
+            with profile_stage('api: %s' % name):
+                value = loader()
+            self._write(name, value)
+        self._sources[name] = value
+        return value
+
+    def replace(self, sources):
+        """
+        Replaces all sources in the snapshot, e.g. with synthetic data for benchmarks
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        for name, value in sources.items():
+            self._write(name, value)
+        self._sources = dict(sources)
+
+    def _read(self, name):
+        try:
+            with gzip.open(self.get_source_path(name), 'rt', encoding='utf-8') as f:
+                return True, json.load(f)
+        except (OSError, ValueError, EOFError):
+            return False, None
+
+    def _write(self, name, value):
+        os.makedirs(self.path, exist_ok=True)
+        # written to a temporary file first so that a partly written source is never read
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(
+                    json.dumps(value, separators=(',', ':')).encode('utf-8'), compresslevel=self.compress_level
+                ))
+            os.replace(temp_path, self.get_source_path(name))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+class DailyDataset:
+    """
+    Api data needed to build the files for a receipt date.
+    Each source is loaded from the api once and saved in the date's snapshot so that regenerating a file,
+    or building another file for the same date, does not go back to the api.
+    Transaction statuses are only known to the api so they are loaded separately,
+    but categories are partitioned locally from the full list.
+    """
+
+    def __init__(self, api_session, receipt_date):
+        self.api_session = api_session
+        self.receipt_date = receipt_date
+        self.start_date, self.end_date = get_start_and_end_date(receipt_date)
+        self.snapshot = DailySnapshot(receipt_date)
+
+    def credits(self):
+        return self.snapshot.get('credits', lambda: retrieve_all_valid_credits(
+            self.api_session,
+            received_at__gte=self.start_date,
+            received_at__lt=self.end_date
+        ))
+
+    def transactions(self, status=None):
+        def loader():
+            filters = {
+                'received_at__gte': self.start_date,
+                'received_at__lt': self.end_date,
+            }
+            if status:
+                filters['status'] = status
+            return retrieve_all_transactions(self.api_session, **filters)
+
+        return self.snapshot.get('transactions:%s' % (status or 'all'), loader)
+
+    def transactions_with_category(self, category):
+        return [
+            transaction
+            for transaction in self.transactions()
+            if transaction['category'] == category
+        ]
+
+    def disbursements(self):
+        return self.snapshot.get('disbursements', lambda: retrieve_all_disbursements(
+            self.api_session,
+            resolution=['confirmed', 'sent'],
+            log__action='confirmed',
+            logged_at__gte=self.start_date,
+            logged_at__lt=self.end_date
+        ))
+
+    def private_estate_batches(self):
+        return self.snapshot.get('private_estate_batches', lambda: retrieve_private_estate_batches(
+            self.api_session, self.start_date, self.end_date
+        ))
+
+    def prison_registry(self):
+        prisons = self.snapshot.get('prisons', lambda: list(
+            get_prison_registry(self.api_session).by_nomis_id.values()
+        ))
+        return PrisonRegistry(prisons)
+
+    def last_balance(self):
+        return self.snapshot.get('last_balance', lambda: retrieve_last_balance(
+            self.api_session, self.receipt_date
+        ))
@@ -4,10 +4,24 @@ from functools import wraps
 from django.contrib import messages
 from django.http import HttpResponseBadRequest
 from django.shortcuts import redirect
-from django.urls import reverse_lazy
-from django.utils.translation import gettext as _
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.urls import reverse, reverse_lazy
+from django.utils.translation import gettext as _, gettext_lazy
 
 from .exceptions import EmptyFileError, EarlyReconciliationError, UpstreamServiceUnavailable
+from .generation import FILE_GENERATORS
+from .profiling import profile_file_generation, profiling_requested
+from .tasks import start_file_generation
+from .utils import get_cached_file_path, get_file_validators
+
+FILE_DOWNLOAD_ERROR_MESSAGES = {
+    EmptyFileError.__name__: gettext_lazy('No transactions available'),
+    EarlyReconciliationError.__name__: gettext_lazy('This file cannot be downloaded until the next working day'),
+    UpstreamServiceUnavailable.__name__: gettext_lazy(
+        'There was a problem generating the file. Please try again later.'
+    ),
+}
 
 
 def filter_by_receipt_date(view_func):
@@ -31,11 +45,79 @@ def handle_file_download_errors(view_func):
     def wrapper(request, receipt_date, *args, **kwargs):
         try:
             return view_func(request, receipt_date, *args, **kwargs)
-        except EmptyFileError:
-            messages.error(request, _('No transactions available'))
-        except EarlyReconciliationError:
-            messages.error(request, _('This file cannot be downloaded until the next working day'))
-        except UpstreamServiceUnavailable:
-            messages.error(request, _('There was a problem generating the file. Please try again later.'))
+        except (EmptyFileError, EarlyReconciliationError, UpstreamServiceUnavailable) as e:
+            messages.error(request, FILE_DOWNLOAD_ERROR_MESSAGES[e.__class__.__name__])
         return redirect(reverse_lazy('bank_admin:dashboard'))
     return wrapper
+
+
+def generate_in_background(label):
+    """
+    Starts generating the file in the uWSGI spooler if it is not cached yet
+    and sends the user to wait for it instead of building it within the request.
+    Generation is profiled if requested, whether in the spooler or within the request.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, receipt_date, *args, **kwargs):
+            profile = profiling_requested(request)
+            if start_file_generation(label, receipt_date, profile=profile):
+                return redirect('%s?label=%s&receipt_date=%s' % (
+                    reverse('bank_admin:file_generation_status'), label, receipt_date.isoformat()
+                ))
+            with profile_file_generation(label, receipt_date, enabled=profile):
+                return view_func(request, receipt_date, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def conditional_file_download(label, on_not_modified, variant=None):
+    """
+    Answers If-None-Match and If-Modified-Since requests with 304 Not Modified based on the cached file alone,
+    before the file is loaded, and adds ETag and Last-Modified headers to downloads
+    :param on_not_modified: function of the request and receipt date performing the view's side effects,
+        like recording the download, when the client already has the file
+    :param variant: function of the user returning how the response is personalised from the cached file;
+        personalised responses are only validated by their weak ETag since the file's modification time
+        is shared by all users
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, receipt_date, *args, **kwargs):
+            filepath = get_cached_file_path(label, receipt_date, extension=FILE_GENERATORS[label].extension)
+            personalisation = variant(request.user) if variant else None
+
+            etag, last_modified = get_validators(filepath, personalisation)
+            # `file_download_response` only resumes downloads with a Range header if If-Range matches these
+            request.file_validators = etag, last_modified
+            if etag:
+                response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                if response is not None:
+                    if response.status_code == 304:
+                        on_not_modified(request, receipt_date)
+                        set_validator_headers(response, etag, last_modified)
+                    return response
+
+            response = view_func(request, receipt_date, *args, **kwargs)
+            if response.status_code in (200, 206):
+                if not etag:
+                    # file was generated by this request
+                    etag, last_modified = get_validators(filepath, personalisation)
+                if etag:
+                    set_validator_headers(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_validators(filepath, personalisation):
+    etag, last_modified = get_file_validators(filepath, variant=personalisation)
+    if personalisation:
+        last_modified = None
+    return etag, last_modified
+
+
+def set_validator_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
@@ -3,14 +3,14 @@ import logging
 
 from django.conf import settings
 from django.utils.dateparse import parse_date
-from mtp_common.api import retrieve_all_pages_for_path
 
 from . import disbursements_config as config, DISBURSEMENTS_LABEL
+from .datasets import DailyDataset
 from .exceptions import EmptyFileError
-from .utils import (
-    get_start_and_end_date, retrieve_prisons, Journal, get_or_create_file,
-    reconcile_for_date,
-)
+from .profiling import profile_stage, profiled_stage
+from .rendering import UNSET, JournalRow, compile_value, format_values
+from .streaming import StreamingJournal
+from .utils import Journal, get_or_create_file, reconcile_for_date, run_concurrently
 
 logger = logging.getLogger('mtp')
 
@@ -26,52 +26,51 @@ def get_disbursements_file(api_session, receipt_date, mark_sent=False):
         receipt_date,
         generate_disbursements_journal,
         f_args=[api_session, receipt_date],
-        file_extension='xlsm'
+        file_extension='xlsm',
+        stream=True,
     )
     if mark_sent:
         mark_as_sent(api_session, receipt_date)
     return open(filepath, 'rb')
 
 
-class DisbursementJournal(Journal):
-    def add_disbursement_row(self, **kwargs):
-        for field in self.fields:
-            if (kwargs['payment_method'] != PAYMENT_METHODS['bank_transfer'] and
-                    field in config.BANK_DETAILS_FIELDS):
-                continue
-            static_value = self.lookup(field, context=kwargs)
-            self.set_field(field, static_value)
-        self.next_row()
+class DisbursementRowLayout:
+    """
+    Computes the cells of disbursement journal rows from a row template compiled once for each payment method;
+    bank details are left unset unless paying by bank transfer
+    """
 
+    def __init__(self, fields):
+        self.fields = fields
+        self.row_templates = {}
 
-def retrieve_all_disbursements(api_session, **kwargs):
-    return retrieve_all_pages_for_path(
-        api_session, 'disbursements/', **kwargs)
+    def get_row_template(self, payment_method):
+        row_template = self.row_templates.get(payment_method)
+        if row_template is None:
+            row_template = [
+                (UNSET, False)
+                if payment_method != PAYMENT_METHODS['bank_transfer'] and field in config.BANK_DETAILS_FIELDS
+                else compile_value(self.fields[field].get('value'))
+                for field in self.fields
+            ]
+            self.row_templates[payment_method] = row_template
+        return row_template
 
+    def disbursement_row(self, **kwargs):
+        return JournalRow(tuple(format_values(self.get_row_template(kwargs['payment_method']), kwargs)))
 
-def retrieve_private_estate_batches(api_session, start_date, end_date, prison=None):
-    filters = dict(
-        date__gte=start_date.date(),
-        date__lt=end_date.date(),
-    )
-    if prison:
-        filters['prison'] = prison
-    return retrieve_all_pages_for_path(
-        api_session,
-        'private-estate-batches/',
-        **filters
-    )
+
+class DisbursementJournal(Journal):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.row_layout = DisbursementRowLayout(self.fields)
+
+    def add_disbursement_row(self, **kwargs):
+        self.add_row(self.row_layout.disbursement_row(**kwargs))
 
 
 def mark_as_sent(api_session, date):
-    start_date, end_date = get_start_and_end_date(date)
-    disbursements = retrieve_all_disbursements(
-        api_session,
-        resolution=['confirmed', 'sent'],
-        log__action='confirmed',
-        logged_at__gte=start_date,
-        logged_at__lt=end_date
-    )
+    disbursements = DailyDataset(api_session, date).disbursements()
     if len(disbursements) != 0:
         api_session.post(
             'disbursements/actions/send/',
@@ -79,38 +78,58 @@ def mark_as_sent(api_session, date):
         )
 
 
-def generate_disbursements_journal(api_session, date):
-    start_date, end_date = reconcile_for_date(api_session, date)
+def generate_disbursements_journal(api_session, date, output=None):
+    reconcile_for_date(api_session, date)
 
-    private_estate_batches = retrieve_private_estate_batches(api_session, start_date, end_date)
-
-    disbursements = retrieve_all_disbursements(
-        api_session,
-        resolution=['confirmed', 'sent'],
-        log__action='confirmed',
-        logged_at__gte=start_date,
-        logged_at__lt=end_date
+    dataset = DailyDataset(api_session, date)
+    private_estate_batches, disbursements, prison_registry = run_concurrently(
+        dataset.private_estate_batches,
+        dataset.disbursements,
+        dataset.prison_registry,
     )
 
     if len(private_estate_batches) == 0 and len(disbursements) == 0:
         raise EmptyFileError()
 
-    journal = DisbursementJournal(
+    rows = get_disbursements_journal_rows(date, private_estate_batches, disbursements, prison_registry)
+    return render_disbursements_journal(rows, output=output)
+
+
+def render_disbursements_journal(rows, output=None):
+    """
+    Renders disbursement journal rows into the workbook template,
+    streaming the package unless STREAM_JOURNAL_WORKBOOKS is disabled to use openpyxl
+    """
+    journal_class = StreamingJournal if settings.STREAM_JOURNAL_WORKBOOKS else DisbursementJournal
+    journal = journal_class(
         settings.DISBURSEMENT_TEMPLATE_FILEPATH,
         config.DISBURSEMENTS_JOURNAL_SHEET,
         config.DISBURSEMENTS_JOURNAL_START_ROW,
         config.DISBURSEMENT_FIELDS
     )
+    with profile_stage('render rows'):
+        for row in rows:
+            journal.add_row(row)
+    with profile_stage('save workbook'):
+        return journal.create_file(output)
+
+
+@profiled_stage('rows')
+def get_disbursements_journal_rows(date, private_estate_batches, disbursements, prison_registry,
+                                   fields=config.DISBURSEMENT_FIELDS):
+    """
+    Computes the rows of a disbursements journal without building a workbook
+    :return: list of JournalRow
+    """
     journal_date = date.strftime('%d/%m/%Y')
-    prisons = retrieve_prisons(api_session)
-
-    add_private_estate_batches(journal, journal_date, prisons, private_estate_batches)
-    add_disbursements(journal, journal_date, prisons, disbursements)
-
-    return journal.create_file()
+    layout = DisbursementRowLayout(fields)
+    prisons = prison_registry.by_nomis_id
+    rows = list(get_private_estate_batch_rows(layout, journal_date, prisons, private_estate_batches))
+    rows.extend(get_disbursement_rows(layout, journal_date, prisons, disbursements))
+    return rows
 
 
-def add_private_estate_batches(journal, journal_date, prisons, private_estate_batches):
+def get_private_estate_batch_rows(layout, journal_date, prisons, private_estate_batches):
     for private_estate_batch in private_estate_batches:
         if not private_estate_batch.get('bank_account'):
             logger.error('Private estate batch missing bank account %(prison)s %(date)s', private_estate_batch)
@@ -125,7 +144,7 @@ def add_private_estate_batches(journal, journal_date, prisons, private_estate_ba
         prison_name = prison.get('short_name') or prison['name']
         bank_account = private_estate_batch['bank_account']
         recipient_email = private_estate_batch['remittance_emails'][0]
-        journal.add_disbursement_row(
+        yield layout.disbursement_row(
             creator='Prisoner money team',
             confirmer='Prisoner money team',
             amount_pounds=Decimal(private_estate_batch['total_amount']) / 100,
@@ -148,7 +167,7 @@ def add_private_estate_batches(journal, journal_date, prisons, private_estate_ba
         )
 
 
-def add_disbursements(journal, journal_date, prisons, disbursements):
+def get_disbursement_rows(layout, journal_date, prisons, disbursements):
     for disbursement in disbursements:
         for field in disbursement:
             if disbursement[field] is None:
@@ -167,7 +186,7 @@ def add_disbursements(journal, journal_date, prisons, disbursements):
                     user['first_name'][0], user['last_name']
                 )
 
-        journal.add_disbursement_row(
+        yield layout.disbursement_row(
             creator=creator,
             confirmer=confirmer,
             amount_pounds=Decimal(disbursement['amount']) / 100,
@@ -0,0 +1,23 @@
+"""
+Reference data shared by tests and benchmarks, kept apart from test helpers
+so that it can be used without testing dependencies
+"""
+
+PRISONS = [
+    {'nomis_id': 'BPR', 'general_ledger_code': '048', 'name': 'Big Prison', 'private_estate': False},
+    {'nomis_id': 'MPR', 'general_ledger_code': '067', 'name': 'Medium Prison', 'private_estate': False},
+    {'nomis_id': 'SPR', 'general_ledger_code': '054', 'name': 'Small Prison', 'private_estate': False},
+    {'nomis_id': 'NPR', 'general_ledger_code': '067', 'name': 'New Prison', 'private_estate': False},
+    {'nomis_id': 'PR1', 'general_ledger_code': '10101000', 'name': 'Private 1', 'private_estate': True,
+     'cms_establishment_code': '10'},
+    {'nomis_id': 'PR2', 'general_ledger_code': '10101000', 'name': 'Private 2', 'private_estate': True,
+     'cms_establishment_code': '20'},
+]
+
+BANK_ACCOUNT = {
+    'address_line1': 'line 1',
+    'city': 'city',
+    'postcode': 'post code',
+    'account_number': '12345678',
+    'sort_code': '101010',
+}
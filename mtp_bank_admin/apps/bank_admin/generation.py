@@ -0,0 +1,120 @@
+from collections import namedtuple
+import json
+import logging
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.urls import reverse
+
+from . import (
+    adi, disbursements, refund, statement, ADI_JOURNAL_LABEL, ACCESSPAY_LABEL,
+    MT940_STMT_LABEL, DISBURSEMENTS_LABEL
+)
+from .exceptions import EmptyFileError, EarlyReconciliationError, UpstreamServiceUnavailable
+from .profiling import profile_file_generation
+from .utils import get_cached_file_path
+
+logger = logging.getLogger('mtp')
+
+FileGenerator = namedtuple('FileGenerator', 'function extension download_url_name')
+
+# functions that create each cached file without side effects such as marking records as sent
+FILE_GENERATORS = {
+    ACCESSPAY_LABEL: FileGenerator(
+        refund.get_refund_file, None, 'bank_admin:download_refund_file'
+    ),
+    ADI_JOURNAL_LABEL: FileGenerator(
+        adi.get_adi_journal_file, 'xlsm', 'bank_admin:download_adi_journal'
+    ),
+    MT940_STMT_LABEL: FileGenerator(
+        statement.get_bank_statement_file, None, 'bank_admin:download_bank_statement'
+    ),
+    DISBURSEMENTS_LABEL: FileGenerator(
+        disbursements.get_disbursements_file, 'xlsm', 'bank_admin:download_disbursements'
+    ),
+}
+
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+# errors that generation can be expected to raise, others are recorded as `error`
+KNOWN_ERRORS = (EmptyFileError, EarlyReconciliationError, UpstreamServiceUnavailable)
+
+
+def get_download_url(label, receipt_date):
+    return '%s?receipt_date=%s' % (
+        reverse(FILE_GENERATORS[label].download_url_name),
+        receipt_date.isoformat(),
+    )
+
+
+def get_file_generation_status(label, receipt_date):
+    """
+    Returns the status of a file's generation: `ready` if the file is cached,
+    `pending` while it is being generated in the background, `failed` with the error name if that failed
+    or None if it has not been requested
+    """
+    extension = FILE_GENERATORS[label].extension
+    if os.path.isfile(get_cached_file_path(label, receipt_date, extension=extension)):
+        return {'status': STATUS_READY}
+    try:
+        with open(_get_status_path(label, receipt_date)) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if status['status'] == STATUS_PENDING and time.time() - status['started_at'] > settings.FILE_GENERATION_TIMEOUT:
+        # spooler must have stopped before generation finished
+        return None
+    return status
+
+
+def mark_file_generation_pending(label, receipt_date):
+    _write_status(label, receipt_date, {'status': STATUS_PENDING, 'started_at': time.time()})
+
+
+def clear_file_generation_status(label, receipt_date):
+    try:
+        os.remove(_get_status_path(label, receipt_date))
+    except FileNotFoundError:
+        pass
+
+
+def generate_file(api_session, label, receipt_date, profile=False):
+    """
+    Creates the cached file, recording the outcome for `get_file_generation_status`
+    :param profile: write a profile report of the file's generation
+    """
+    try:
+        with profile_file_generation(label, receipt_date, enabled=profile):
+            generated = FILE_GENERATORS[label].function(api_session, receipt_date)
+            if hasattr(generated, 'close'):
+                generated.close()
+    except KNOWN_ERRORS as e:
+        _write_status(label, receipt_date, {'status': STATUS_FAILED, 'error': e.__class__.__name__})
+        return
+    except Exception:
+        logger.exception('Could not generate %s file for %s', label, receipt_date)
+        _write_status(label, receipt_date, {'status': STATUS_FAILED, 'error': 'error'})
+        return
+    clear_file_generation_status(label, receipt_date)
+
+
+def _get_status_path(label, receipt_date):
+    return get_cached_file_path(label, receipt_date, extension='status')
+
+
+def _write_status(label, receipt_date, status):
+    status_path = _get_status_path(label, receipt_date)
+    dirname = os.path.dirname(status_path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f)
+        os.replace(temp_path, status_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -6,17 +6,24 @@ from django.core.management import BaseCommand, CommandError
 from django.utils.dateparse import parse_date
 from mtp_common.auth import api_client
 
-from bank_admin.utils import WorkdayChecker
+from bank_admin.profiling import profile_file_generation
+from bank_admin.utils import reconcile_for_date
+from bank_admin.workdays import get_workday_calendar
 
 logger = logging.getLogger('mtp')
 
 
 class FileGenerationCommand(BaseCommand):
     function = NotImplemented
+    label = NotImplemented
 
     def add_arguments(self, parser):
         super().add_arguments(parser)
         parser.add_argument('--date', dest='date', type=str, help='Receipt date')
+        parser.add_argument('--force-reconcile', action='store_true',
+                            help='Reconcile the receipt date again even if already reconciled')
+        parser.add_argument('--profile', action='store_true',
+                            help='Write a report of the time and memory used by each stage of generation')
 
     def handle(self, *args, **options):
         if options['date']:
@@ -24,7 +31,7 @@ class FileGenerationCommand(BaseCommand):
             if not receipt_date:
                 raise CommandError('Date %s cannot be parsed, use YYYY-MM-DD format' % date)
         else:
-            workdays = WorkdayChecker()
+            workdays = get_workday_calendar()
             if not workdays.is_workday(date.today()):
                 return
             receipt_date = workdays.get_previous_workday(date.today())
@@ -33,4 +40,7 @@ class FileGenerationCommand(BaseCommand):
             settings.BANK_ADMIN_USERNAME,
             settings.BANK_ADMIN_PASSWORD
         )
-        self.__class__.function(api_session, receipt_date)
+        with profile_file_generation(self.label, receipt_date, enabled=options['profile']):
+            if options['force_reconcile']:
+                reconcile_for_date(api_session, receipt_date, force=True)
+            self.__class__.function(api_session, receipt_date)
@@ -0,0 +1,57 @@
+from django.core.management import BaseCommand, CommandError
+
+from bank_admin.benchmarks import (
+    BENCHMARK_BASELINE_PATH, BENCHMARK_VOLUMES, BENCHMARKED_GENERATORS,
+    find_regressions, load_baseline, run_benchmarks, save_baseline
+)
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks file generation from synthetic datasets at increasing volumes, comparing results with saved baselines.
+    Data is read from a prepared snapshot so api paging and reconciliation requests are not measured.
+    """
+    help = 'Measures file generation time, peak memory and throughput at increasing volumes of records'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--volumes', type=int, nargs='+', default=list(BENCHMARK_VOLUMES),
+                            help='Numbers of records to generate files from')
+        parser.add_argument('--files', nargs='+', choices=list(BENCHMARKED_GENERATORS),
+                            help='Files to generate, defaults to all')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs to take the best of')
+        parser.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH, help='Path of the baseline file')
+        parser.add_argument('--save-baseline', action='store_true', help='Save results as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Fraction by which results can exceed the baseline before being reported')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error if any result exceeds the baseline')
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(volumes=options['volumes'], labels=options['files'], repeat=options['repeat'])
+        baseline = load_baseline(options['baseline'])
+        regressions = find_regressions(results, baseline, tolerance=options['tolerance'])
+
+        self.stdout.write('%-20s %8s %10s %12s %12s %10s' % (
+            'File', 'Records', 'Seconds', 'Peak MiB', 'Records/s', 'Baseline'
+        ))
+        for result in results:
+            expected = baseline.get(result.label, {}).get(str(result.volume))
+            if expected and expected['seconds']:
+                change = '%+.0f%%' % ((result.seconds / expected['seconds'] - 1) * 100)
+            else:
+                change = '-'
+            self.stdout.write('%-20s %8d %10.3f %12.1f %12.0f %10s' % (
+                result.label, result.volume, result.seconds, result.peak_memory / 2 ** 20,
+                result.records_per_second, change,
+            ))
+
+        for result, measure, expected in regressions:
+            self.stderr.write('%s with %d records regressed: %s is %s, baseline %s' % (
+                result.label, result.volume, measure, getattr(result, measure), expected
+            ))
+        if options['save_baseline']:
+            save_baseline(results, options['baseline'])
+            self.stdout.write('Saved baseline to %s' % options['baseline'])
+        elif regressions and options['fail_on_regression']:
+            raise CommandError('%d benchmark results regressed' % len(regressions))
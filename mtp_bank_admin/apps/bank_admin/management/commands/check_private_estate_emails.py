@@ -9,8 +9,8 @@ from mtp_common.auth import api_client
 from mtp_common.notify import NotifyClient
 from mtp_common.stack import StackException, is_first_instance
 
-from bank_admin.disbursements import retrieve_private_estate_batches
-from bank_admin.utils import WorkdayChecker, get_start_and_end_date
+from bank_admin.utils import get_start_and_end_date, retrieve_private_estate_batches
+from bank_admin.workdays import get_workday_calendar
 
 logger = logging.getLogger('mtp')
 
@@ -43,7 +43,7 @@ class Command(BaseCommand):
             return
 
         today = timezone.now().date()
-        workdays = WorkdayChecker()
+        workdays = get_workday_calendar()
         if not workdays.is_workday(today):
             logger.info('Non-workday: no private estate emails to check')
             return
@@ -1,9 +1,85 @@
+from datetime import datetime
+import logging
+import os
 import shutil
+import time
 
 from django.core.management import BaseCommand
 
+from bank_admin.utils import FILE_CACHE_PATH, get_preceding_workday_list
+
+logger = logging.getLogger('mtp')
+
+# undated entries, like temporary files left by interrupted writes, are only removed once this old
+UNDATED_ENTRY_MAX_AGE = 24 * 60 * 60  # seconds
+
+
+def get_entry_date(name):
+    """
+    Returns the date of a cached file, snapshot, status or reconciliation marker (and its lock) from its name
+    """
+    try:
+        return datetime.strptime(name.lstrip('.')[:8], '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def is_expired(path, earliest_date):
+    entry_date = get_entry_date(os.path.basename(path))
+    if entry_date is not None:
+        return entry_date < earliest_date
+    try:
+        return time.time() - os.path.getmtime(path) > UNDATED_ENTRY_MAX_AGE
+    except FileNotFoundError:
+        return False
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 
 class Command(BaseCommand):
+    """
+    Removes cached files, api data snapshots and reconciliation markers for dates before the dashboard's list
+    of preceding workdays. Those within it are kept so that `prewarm_file_cache` only needs to generate files
+    for new workdays rather than reconciling and loading the whole list again.
+    """
+    help = 'Removes cached files for dates before the preceding workdays shown on the dashboard'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--days', type=int, default=20, help='Number of workdays to keep')
+        parser.add_argument('--offset', type=int, default=2, help='Number of most recent workdays skipped')
+        parser.add_argument('--all', action='store_true', help='Remove the whole file cache')
 
     def handle(self, *args, **options):
-        shutil.rmtree('local_files/cache/', ignore_errors=True)
+        if options['all']:
+            shutil.rmtree(FILE_CACHE_PATH, ignore_errors=True)
+            return
+
+        workdays = get_preceding_workday_list(options['days'], offset=options['offset'])
+        if not workdays:
+            return
+        earliest_date = min(workdays)
+
+        try:
+            labels = os.listdir(FILE_CACHE_PATH)
+        except FileNotFoundError:
+            return
+        removed = 0
+        for label in labels:
+            label_path = os.path.join(FILE_CACHE_PATH, label)
+            if not os.path.isdir(label_path):
+                continue
+            for name in os.listdir(label_path):
+                path = os.path.join(label_path, name)
+                if is_expired(path, earliest_date):
+                    remove_entry(path)
+                    removed += 1
+        logger.info('Removed %d cached entries from before %s', removed, earliest_date)
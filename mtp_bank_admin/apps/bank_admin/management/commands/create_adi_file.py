@@ -1,6 +1,8 @@
+from bank_admin import ADI_JOURNAL_LABEL
 from bank_admin.adi import get_adi_journal_file
 from . import FileGenerationCommand
 
 
 class Command(FileGenerationCommand):
     function = get_adi_journal_file
+    label = ADI_JOURNAL_LABEL
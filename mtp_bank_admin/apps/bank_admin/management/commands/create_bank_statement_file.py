@@ -1,6 +1,8 @@
+from bank_admin import MT940_STMT_LABEL
 from bank_admin.statement import get_bank_statement_file
 from . import FileGenerationCommand
 
 
 class Command(FileGenerationCommand):
     function = get_bank_statement_file
+    label = MT940_STMT_LABEL
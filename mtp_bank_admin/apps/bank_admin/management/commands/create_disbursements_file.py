@@ -1,6 +1,8 @@
+from bank_admin import DISBURSEMENTS_LABEL
 from bank_admin.disbursements import get_disbursements_file
 from . import FileGenerationCommand
 
 
 class Command(FileGenerationCommand):
     function = get_disbursements_file
+    label = DISBURSEMENTS_LABEL
@@ -1,6 +1,8 @@
+from bank_admin import ACCESSPAY_LABEL
 from bank_admin.refund import get_refund_file
 from . import FileGenerationCommand
 
 
 class Command(FileGenerationCommand):
     function = get_refund_file
+    label = ACCESSPAY_LABEL
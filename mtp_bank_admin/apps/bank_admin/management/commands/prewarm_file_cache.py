@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from mtp_common.auth import api_client
+
+from bank_admin import ACCESSPAY_LABEL
+from bank_admin.exceptions import EmptyFileError
+from bank_admin.generation import (
+    FILE_GENERATORS, STATUS_FAILED, STATUS_READY, generate_file, get_file_generation_status
+)
+from bank_admin.utils import get_preceding_workday_list
+
+logger = logging.getLogger('mtp')
+
+
+def needs_generation(status):
+    if not status:
+        return True
+    # files already generated or being generated in the spooler are skipped
+    # as are dates with nothing to download, but other failures are tried again
+    return status['status'] == STATUS_FAILED and status['error'] != EmptyFileError.__name__
+
+
+class RequestLimitedSession:
+    """
+    Wraps the api session shared by the files being prewarmed so that, although each file loads
+    several sources and pages in parallel, at most `max_requests` GET requests are in flight at once.
+    Posts such as reconciliation are not limited since they can take minutes.
+    """
+
+    def __init__(self, api_session, max_requests):
+        self.api_session = api_session
+        self.slots = threading.BoundedSemaphore(max(1, max_requests))
+
+    def get(self, *args, **kwargs):
+        with self.slots:
+            return self.api_session.get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.api_session, name)
+
+
+class Command(BaseCommand):
+    """
+    Generates every file that could be downloaded from the dashboard's list of preceding workdays
+    so that users never wait for reconciliation and file generation.
+    Scheduled commands already generate files for the previous workday.
+    """
+    help = 'Generates missing cached files for the preceding workdays shown on the dashboard'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--days', type=int, default=20, help='Number of workdays to generate')
+        parser.add_argument('--offset', type=int, default=2, help='Number of most recent workdays to skip')
+        parser.add_argument('--workers', type=int, default=4, help='Number of files to generate in parallel')
+        parser.add_argument('--max-requests', type=int, default=8,
+                            help='Number of api requests that all workers can make at once')
+
+    def handle(self, *args, **options):
+        labels = [
+            label
+            for label in FILE_GENERATORS
+            # Access Pay refunds files are always empty when they are not shown
+            if label != ACCESSPAY_LABEL or settings.SHOW_ACCESS_PAY_REFUNDS
+        ]
+        # files for the same date are grouped so that they can share reconciliation and api data
+        missing_files = [
+            (label, receipt_date)
+            for receipt_date in get_preceding_workday_list(options['days'], offset=options['offset'])
+            for label in labels
+            if needs_generation(get_file_generation_status(label, receipt_date))
+        ]
+        if not missing_files:
+            logger.info('All files for preceding workdays are already cached')
+            return
+
+        api_session = RequestLimitedSession(api_client.get_authenticated_api_session(
+            settings.BANK_ADMIN_USERNAME,
+            settings.BANK_ADMIN_PASSWORD
+        ), options['max_requests'])
+
+        def generate(missing_file):
+            label, receipt_date = missing_file
+            generate_file(api_session, label, receipt_date)
+            return get_file_generation_status(label, receipt_date)
+
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            statuses = list(executor.map(generate, missing_files))
+
+        generated = sum(1 for status in statuses if status and status['status'] == STATUS_READY)
+        failed = [
+            '%s %s (%s)' % (label, receipt_date, status['error'])
+            for (label, receipt_date), status in zip(missing_files, statuses)
+            if status and status['status'] == STATUS_FAILED
+        ]
+        logger.info('Generated %d of %d missing files for preceding workdays', generated, len(missing_files))
+        if failed:
+            logger.info('Could not generate: %s', ', '.join(failed))
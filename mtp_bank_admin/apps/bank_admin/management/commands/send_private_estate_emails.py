@@ -10,15 +10,16 @@ from django.utils.dateformat import format as format_date
 from django.utils.dateparse import parse_date
 from django.utils.functional import cached_property
 from django.utils.translation import activate, get_language
-from mtp_common.api import retrieve_all_pages_for_path
 from mtp_common.auth import api_client
 from mtp_common.s3_bucket import generate_upload_path, get_download_url
 from mtp_common.stack import StackException, is_first_instance
 from mtp_common.tasks import send_email, upload_to_s3
 from mtp_common.utils import format_currency
 
-from bank_admin.disbursements import retrieve_private_estate_batches
-from bank_admin.utils import WorkdayChecker, retrieve_prisons, reconcile_for_date
+from bank_admin.api import retrieve_all_pages_for_path
+from bank_admin.prisons import get_prison_registry
+from bank_admin.utils import reconcile_for_date, retrieve_private_estate_batches
+from bank_admin.workdays import get_workday_calendar
 
 logger = logging.getLogger('mtp')
 
@@ -54,7 +55,7 @@ class Command(BaseCommand):
                                '(command is not idempotent)')
                 return
             today = timezone.now().date()
-            workdays = WorkdayChecker()
+            workdays = get_workday_calendar()
             if not workdays.is_workday(today):
                 logger.info('Non-workday: no private estate batches to process')
                 return
@@ -76,12 +77,7 @@ class Command(BaseCommand):
             logger.info('No private estate batches to handle for %s', date)
             return
 
-        prisons = retrieve_prisons(self.api_session)
-        prisons = {
-            nomis_id: prison
-            for nomis_id, prison in prisons.items()
-            if prison.get('private_estate')
-        }
+        prisons = get_prison_registry(self.api_session).private_estate
 
         if not get_language():
             language = getattr(settings, 'LANGUAGE_CODE', 'en')
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from requests.exceptions import RequestException
+
+from .api import retrieve_all_pages_for_path
+
+logger = logging.getLogger('mtp')
+
+PRISON_CACHE_KEY = 'bank-admin-prisons'
+
+
+class PrisonRegistry:
+    """
+    Prison reference data with lookups precomputed for the file generators
+    """
+
+    def __init__(self, prisons, fetched_at=None):
+        self.fetched_at = fetched_at
+        self.by_nomis_id = {prison['nomis_id']: prison for prison in prisons}
+        self.ledger_codes = {prison['nomis_id']: prison['general_ledger_code'] for prison in prisons}
+        # several prisons can share a general ledger code, the last one listed is used for naming
+        self.by_ledger_code = {prison['general_ledger_code']: prison for prison in prisons}
+        self.private_estate = {
+            nomis_id: prison
+            for nomis_id, prison in self.by_nomis_id.items()
+            if prison.get('private_estate')
+        }
+        self.private_estate_ledger_codes = {
+            prison['general_ledger_code']
+            for prison in self.private_estate.values()
+        }
+
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at >= settings.PRISON_CACHE_TTL
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_prison_registry(api_session, refresh=False):
+    """
+    Returns the shared prison registry, loading the prison list from the api only once
+    every `PRISON_CACHE_TTL` seconds across all generators and commands.
+    A stale registry is revalidated by reloading the list, but is still used if the api cannot be reached.
+    """
+    global _registry
+
+    registry = _get_cached_registry()
+    if registry and not refresh and not registry.is_stale():
+        return registry
+
+    with _registry_lock:
+        registry = _get_cached_registry()
+        if registry and not refresh and not registry.is_stale():
+            return registry
+        try:
+            prisons = retrieve_all_pages_for_path(api_session, 'prisons/')
+        except RequestException:
+            if not registry:
+                raise
+            logger.exception('Could not revalidate prison list, using cached copy')
+            return registry
+        fetched_at = time.time()
+        cache.set(
+            PRISON_CACHE_KEY,
+            {'fetched_at': fetched_at, 'prisons': prisons},
+            timeout=settings.PRISON_CACHE_STALE_TIMEOUT,
+        )
+        _registry = PrisonRegistry(prisons, fetched_at)
+        return _registry
+
+
+def _get_cached_registry():
+    global _registry
+
+    cached = cache.get(PRISON_CACHE_KEY)
+    if not cached:
+        return None
+    registry = _registry
+    if registry is None or registry.fetched_at != cached['fetched_at']:
+        # another process or thread refreshed the shared cache so rebuild the lookups
+        registry = PrisonRegistry(cached['prisons'], cached['fetched_at'])
+        _registry = registry
+    return registry
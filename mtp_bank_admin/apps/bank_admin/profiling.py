@@ -0,0 +1,227 @@
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+import contextvars
+import cProfile
+from datetime import datetime
+from functools import wraps
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+
+logger = logging.getLogger('mtp')
+
+# profile of the file generation running in the current context, propagated to threads by `run_concurrently`
+_active_profile = contextvars.ContextVar('file_generation_profile', default=None)
+
+# tracemalloc is process-wide so it is only stopped once no profile is running
+_tracing_lock = threading.Lock()
+_tracing_profiles = 0
+_tracing_started = False
+
+Stage = namedtuple('Stage', 'name started seconds allocated peak_memory top_allocations')
+
+
+def profiling_requested(request):
+    """
+    Whether generating a file for a download request should be profiled: always if enabled in settings,
+    otherwise only for user administrators adding `profile` to the query string
+    """
+    return settings.PROFILE_FILE_GENERATION or (
+        'profile' in request.GET and request.user.has_perm('auth.change_user')
+    )
+
+
+def profile_file_generation(label, receipt_date, enabled=False):
+    """
+    Returns a context manager profiling the generation of a file if enabled
+    by argument or by the PROFILE_FILE_GENERATION setting, unless it is already being profiled
+    """
+    if (enabled or settings.PROFILE_FILE_GENERATION) and _active_profile.get() is None:
+        return GenerationProfile(label, receipt_date)
+    return nullcontext()
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Records a stage of file generation if it is being profiled
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+    else:
+        with profile.stage(name):
+            yield
+
+
+def profiled_stage(name):
+    """
+    Decorates a function to record calls as a stage of file generation if it is being profiled
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _start_tracing():
+    global _tracing_profiles, _tracing_started
+
+    with _tracing_lock:
+        if not _tracing_profiles and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started = True
+        _tracing_profiles += 1
+
+
+def _stop_tracing():
+    global _tracing_profiles, _tracing_started
+
+    with _tracing_lock:
+        _tracing_profiles -= 1
+        if not _tracing_profiles and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+
+
+class GenerationProfile:
+    """
+    Times each stage of a file's generation, tracing memory allocated with tracemalloc and
+    profiling the generating thread with cProfile. A report is written under FILE_GENERATION_PROFILE_PATH
+    unless no stages ran, e.g. because the file was already cached.
+    Stages running in parallel threads, like loading api data, overlap so their memory use includes each other's.
+    Taking tracemalloc snapshots is slow with many traced allocations so only one is taken as each stage
+    of the generating thread ends, attributing allocations made in parallel threads to the next one;
+    this time is excluded from stages and reported separately.
+    """
+    top_allocation_count = 5
+    profile_stats_count = 40
+
+    def __init__(self, label, receipt_date):
+        self.label = label
+        self.receipt_date = receipt_date
+        self.stages = []
+        self.error = None
+        self.seconds = None
+        self.peak_memory = None
+        self.profiler = None
+        self.report_path = None
+        self.thread = None
+        self.snapshot = None
+        self.overhead = 0
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        _start_tracing()
+        self.snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        self.context_token = _active_profile.set(self)
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # another thread is already being profiled
+            self.profiler = None
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.seconds = time.perf_counter() - self.start_time
+        if self.profiler:
+            self.profiler.disable()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        self.peak_memory = max([peak_memory] + [stage.peak_memory for stage in self.stages])
+        _active_profile.reset(self.context_token)
+        _stop_tracing()
+        if exc_type:
+            self.error = exc_type.__name__
+        if self.stages:
+            try:
+                self.write_report()
+            except OSError:
+                logger.exception('Could not write profile of %s file for %s', self.label, self.receipt_date)
+
+    @contextmanager
+    def stage(self, name):
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        nested_stages = len(self.stages)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            end_memory, peak_memory = tracemalloc.get_traced_memory()
+            # stages within this one reset the peak
+            peak_memory = max([peak_memory] + [stage.peak_memory for stage in self.stages[nested_stages:]])
+            top_allocations = self.get_top_allocations() if threading.get_ident() == self.thread else []
+            self.stages.append(Stage(
+                name, start - self.start_time, seconds, end_memory - memory, peak_memory, top_allocations
+            ))
+
+    def get_top_allocations(self):
+        """
+        Returns the lines of code that allocated the most memory still held since the previous snapshot
+        """
+        start = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot()
+        statistics = snapshot.compare_to(self.snapshot, 'lineno')[:self.top_allocation_count]
+        self.snapshot = snapshot
+        self.overhead += time.perf_counter() - start
+        return [str(statistic) for statistic in statistics if statistic.size_diff > 0]
+
+    def get_report(self):
+        lines = [
+            'Profile of %s file for %s, generated %s' % (
+                self.label, self.receipt_date.isoformat(), datetime.now().isoformat(timespec='seconds')
+            ),
+            'Total: %.3fs, peak traced memory %.1f MiB%s' % (
+                self.seconds - self.overhead, self.peak_memory / 2 ** 20,
+                ', failed with %s' % self.error if self.error else '',
+            ),
+            'Excluded time taking tracemalloc snapshots: %.3fs' % self.overhead,
+            '',
+            '%-32s %10s %10s %15s %12s' % ('Stage', 'Started', 'Seconds', 'Allocated MiB', 'Peak MiB'),
+        ]
+        # stages are recorded as they finish but listed in the order they started
+        stages = sorted(self.stages, key=lambda stage: stage.started)
+        for stage in stages:
+            lines.append('%-32s %10.3f %10.3f %15.1f %12.1f' % (
+                stage.name, stage.started, stage.seconds, stage.allocated / 2 ** 20, stage.peak_memory / 2 ** 20
+            ))
+        for stage in stages:
+            if stage.top_allocations:
+                lines.extend(['', 'Largest allocations held at the end of %s:' % stage.name])
+                lines.extend('  %s' % allocation for allocation in stage.top_allocations)
+        if self.profiler:
+            stats = io.StringIO()
+            pstats.Stats(self.profiler, stream=stats).sort_stats('cumulative').print_stats(self.profile_stats_count)
+            lines.extend([
+                '', 'Generating thread by cumulative time, including tracemalloc snapshots:', stats.getvalue()
+            ])
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self):
+        """
+        Writes the text report and, if the generating thread was profiled, cProfile stats for tools like snakeviz
+        """
+        path = os.path.join(
+            settings.FILE_GENERATION_PROFILE_PATH, self.label,
+            '%s-%s' % (self.receipt_date.strftime('%Y%m%d'), datetime.now().strftime('%Y%m%d%H%M%S%f')),
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.txt', 'w') as f:
+            f.write(self.get_report())
+        if self.profiler:
+            self.profiler.dump_stats(path + '.prof')
+        self.report_path = path + '.txt'
+        logger.info('Profile of %s file for %s written to %s', self.label, self.receipt_date, self.report_path)
@@ -6,10 +6,11 @@ import io
 from django.conf import settings
 
 from . import ACCESSPAY_LABEL
+from .datasets import DailyDataset
 from .exceptions import EmptyFileError
+from .profiling import profiled_stage
 from .utils import (
-    retrieve_all_transactions, escape_csv_formula, reconcile_for_date,
-    get_or_create_file, get_start_and_end_date
+    escape_csv_formula, reconcile_for_date, get_or_create_file
 )
 
 
@@ -26,13 +27,7 @@ def get_refund_file(api_session, receipt_date, mark_refunded=False):
 
 
 def mark_as_refunded(api_session, date):
-    start_date, end_date = get_start_and_end_date(date)
-    transactions_to_refund = retrieve_all_transactions(
-        api_session,
-        status='refundable',
-        received_at__gte=start_date,
-        received_at__lt=end_date
-    )
+    transactions_to_refund = DailyDataset(api_session, date).transactions('refundable')
     if len(transactions_to_refund) != 0:
         refunded_transactions = [
             {'id': t['id'], 'refunded': True}
@@ -42,17 +37,13 @@ def mark_as_refunded(api_session, date):
 
 
 def generate_refund_file_for_date(api_session, receipt_date):
-    start_date, end_date = reconcile_for_date(api_session, receipt_date)
-    transactions_to_refund = retrieve_all_transactions(
-        api_session,
-        status='refundable',
-        received_at__gte=start_date,
-        received_at__lt=end_date
-    )
+    reconcile_for_date(api_session, receipt_date)
+    transactions_to_refund = DailyDataset(api_session, receipt_date).transactions('refundable')
     filedata = generate_refund_file(transactions_to_refund)
     return filedata
 
 
+@profiled_stage('rows')
 def generate_refund_file(transactions):
     if len(transactions) == 0:
         raise EmptyFileError()
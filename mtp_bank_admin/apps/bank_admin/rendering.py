@@ -0,0 +1,49 @@
+# value of cells that are left as they are in the journal's template
+UNSET = type('Unset', (), {'__slots__': (), '__repr__': lambda self: 'UNSET'})()
+
+
+class JournalRow:
+    """
+    Values of a journal row's cells in the order of the journal's fields, computed independently of
+    how the journal is rendered; `None` empties a cell and `UNSET` leaves it as it is in the template
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __eq__(self, other):
+        return isinstance(other, JournalRow) and self.values == other.values
+
+    def __repr__(self):
+        return 'JournalRow(%r)' % (self.values,)
+
+    def as_dict(self, field_names):
+        return {
+            field: value
+            for field, value in zip(field_names, self.values)
+            if value is not UNSET
+        }
+
+
+def compile_value(value):
+    """
+    Prepares a field's configured value for a row template
+    :return: tuple of the value and whether it needs formatting with each row's context
+    """
+    return value, value is not None and ('{' in value or '}' in value)
+
+
+def format_values(compiled_values, context):
+    """
+    Formats compiled values with a row's context, leaving cells empty if the context is missing a value
+    """
+    values = []
+    for value, formatted in compiled_values:
+        if formatted:
+            try:
+                value = value.format(**context)
+            except KeyError:
+                value = None
+        values.append(value)
+    return values
@@ -5,9 +5,11 @@ from django.utils.dateparse import parse_date
 from mt940_writer import Account, Balance, Statement, Transaction, TransactionType
 
 from . import MT940_STMT_LABEL
+from .datasets import DailyDataset
+from .profiling import profile_stage
 from .utils import (
-    retrieve_all_transactions, get_daily_file_uid, get_or_create_file,
-    reconcile_for_date, retrieve_last_balance, get_full_narrative
+    get_daily_file_uid, get_or_create_file,
+    reconcile_for_date, get_full_narrative
 )
 
 
@@ -22,44 +24,42 @@ def get_bank_statement_file(api_session, receipt_date):
 
 
 def generate_bank_statement(api_session, receipt_date):
-    start_date, end_date = reconcile_for_date(api_session, receipt_date)
+    reconcile_for_date(api_session, receipt_date)
 
-    transactions = retrieve_all_transactions(
-        api_session,
-        received_at__gte=start_date,
-        received_at__lt=end_date
-    )
+    dataset = DailyDataset(api_session, receipt_date)
+    transactions = dataset.transactions()
 
-    transaction_records = []
-    credit_num = 0
-    credit_total = 0
-    debit_num = 0
-    debit_total = 0
-    for transaction in transactions:
-        narrative = get_full_narrative(transaction)
-        amount = Decimal(transaction['amount']) / 100
+    with profile_stage('rows'):
+        transaction_records = []
+        credit_num = 0
+        credit_total = 0
+        debit_num = 0
+        debit_total = 0
+        for transaction in transactions:
+            narrative = get_full_narrative(transaction)
+            amount = Decimal(transaction['amount']) / 100
 
-        if transaction['category'] == 'debit':
-            amount *= -1
-            debit_num += 1
-            debit_total += amount
-        else:
-            if transaction.get('ref_code'):
-                narrative = str(transaction['ref_code']) + ' BGC'
-            credit_num += 1
-            credit_total += amount
+            if transaction['category'] == 'debit':
+                amount *= -1
+                debit_num += 1
+                debit_total += amount
+            else:
+                if transaction.get('ref_code'):
+                    narrative = str(transaction['ref_code']) + ' BGC'
+                credit_num += 1
+                credit_total += amount
 
-        transaction_record = Transaction(
-            receipt_date,
-            amount,
-            TransactionType.miscellaneous,
-            narrative
-        )
-        transaction_records.append(transaction_record)
+            transaction_record = Transaction(
+                receipt_date,
+                amount,
+                TransactionType.miscellaneous,
+                narrative
+            )
+            transaction_records.append(transaction_record)
 
     account = Account(settings.BANK_STMT_ACCOUNT_NUMBER, settings.BANK_STMT_SORT_CODE)
 
-    last_balance = retrieve_last_balance(api_session, receipt_date)
+    last_balance = dataset.last_balance()
     if last_balance:
         opening_date = parse_date(last_balance['date']) or receipt_date
         opening_amount = Decimal(last_balance['closing_balance']) / 100
@@ -76,4 +76,5 @@ def generate_bank_statement(api_session, receipt_date):
         closing_balance, transaction_records
     )
 
-    return str(statement)
+    with profile_stage('render'):
+        return str(statement)
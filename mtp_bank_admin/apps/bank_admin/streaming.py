@@ -0,0 +1,385 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from functools import lru_cache
+import io
+import os
+import re
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import zipfile
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE
+from openpyxl.utils.cell import (
+    column_index_from_string, coordinate_from_string, get_column_letter, quote_sheetname
+)
+from openpyxl.utils.exceptions import IllegalCharacterError
+
+from .rendering import UNSET
+from .utils import Journal, copy_member, get_worksheet_member
+
+STYLES_MEMBER = 'xl/styles.xml'
+WORKBOOK_MEMBER = 'xl/workbook.xml'
+
+_SHEET_DATA_RE = re.compile(r'<sheetData\s*/>|<sheetData>(?P<rows>.*?)</sheetData>', re.DOTALL)
+_DIMENSION_RE = re.compile(r'<dimension ref="(?P<first>[A-Z]+\d+)(?::(?P<last>[A-Z]+)\d+)?"\s*/>')
+_ROW_RE = re.compile(r'<row\b(?P<attrs>[^>]*?)(?:/>|>(?P<cells>.*?)</row>)', re.DOTALL)
+_ROW_NUMBER_RE = re.compile(r'(?:^|\s)r="(\d+)"')
+_CELL_RE = re.compile(r'<c\b(?P<attrs>[^>]*?)(?:/>|>.*?</c>)', re.DOTALL)
+_CELL_COLUMN_RE = re.compile(r'(?:^|\s)r="([A-Z]+)\d+"')
+_STYLE_RE = re.compile(r'(?:^|\s)s="(\d+)"')
+_XF_RE = re.compile(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', re.DOTALL)
+_COUNT_RE = re.compile(r'\scount="\d+"')
+
+# template rows are kept as their opening tag's attributes and cell XML and style id by column index
+_TemplateRow = namedtuple('_TemplateRow', 'attrs cells')
+_Template = namedtuple('_Template', 'worksheet_member sheet_head sheet_tail rows last_column workbook styles')
+
+
+@lru_cache(maxsize=8)
+def _load_template(template_path, mtime, sheet_name):
+    with zipfile.ZipFile(template_path) as package:
+        worksheet_member = get_worksheet_member(package, sheet_name)
+        worksheet = package.read(worksheet_member).decode('utf-8')
+        workbook = package.read(WORKBOOK_MEMBER).decode('utf-8')
+        styles = package.read(STYLES_MEMBER).decode('utf-8')
+
+    sheet_data = _SHEET_DATA_RE.search(worksheet)
+    rows = {}
+    for row_match in _ROW_RE.finditer(sheet_data.group('rows') or ''):
+        attrs = row_match.group('attrs')
+        cells = {}
+        for cell_match in _CELL_RE.finditer(row_match.group('cells') or ''):
+            cell_attrs = cell_match.group('attrs')
+            column = column_index_from_string(_CELL_COLUMN_RE.search(cell_attrs).group(1))
+            style = _STYLE_RE.search(cell_attrs)
+            cells[column] = (cell_match.group(), int(style.group(1)) if style else 0)
+        rows[int(_ROW_NUMBER_RE.search(attrs).group(1))] = _TemplateRow(attrs, cells)
+
+    dimension = _DIMENSION_RE.search(worksheet)
+    last_column = dimension.group('last') if dimension else None
+    return _Template(
+        worksheet_member=worksheet_member,
+        sheet_head=worksheet[:sheet_data.start()],
+        sheet_tail=worksheet[sheet_data.end():],
+        rows=rows,
+        last_column=column_index_from_string(last_column) if last_column else 1,
+        workbook=workbook,
+        styles=styles,
+    )
+
+
+class _Stylesheet:
+    """
+    Adds the cell formats used by a journal to the template's stylesheet. New formats copy the template
+    cell's format and replace the parts set by the compiled style, like openpyxl does when styling a cell.
+    """
+    collections = (('fonts', 'font'), ('fills', 'fill'), ('borders', 'border'))
+    style_attributes = {'font': 'fontId', 'fill': 'fillId', 'border': 'borderId'}
+
+    def __init__(self, styles):
+        self.styles = styles
+        self.template_xfs = _XF_RE.findall(self._get_collection('cellXfs'))
+        self.counts = {
+            collection: len(re.findall(r'<%s[\s/>]' % element, self._get_collection(collection)))
+            for collection, element in self.collections
+        }
+        self.num_fmt_ids = {
+            code: int(num_fmt_id)
+            for num_fmt_id, code in re.findall(
+                r'<numFmt numFmtId="(\d+)" formatCode="([^"]*)"', self._get_collection('numFmts')
+            )
+        }
+        self.next_num_fmt_id = max(self.num_fmt_ids.values(), default=163) + 1
+        self.added = defaultdict(list)
+        self.ids = {}
+        self.xf_ids = {}
+
+    def _get_collection(self, collection):
+        match = re.search(r'<%s\b[^>]*?(?:/>|>(.*?)</%s>)' % (collection, collection), self.styles, re.DOTALL)
+        return (match and match.group(1)) or ''
+
+    def _add(self, collection, xml, start):
+        key = (collection, xml)
+        index = self.ids.get(key)
+        if index is None:
+            index = start + len(self.added[collection])
+            self.added[collection].append(xml)
+            self.ids[key] = index
+        return index
+
+    def get_num_fmt_id(self, number_format):
+        if number_format in BUILTIN_FORMATS_REVERSE:
+            return BUILTIN_FORMATS_REVERSE[number_format]
+        if number_format not in self.num_fmt_ids:
+            self.num_fmt_ids[number_format] = self.next_num_fmt_id
+            self.added['numFmts'].append('<numFmt numFmtId="%d" formatCode=%s/>' % (
+                self.next_num_fmt_id, _quote_attribute(number_format)
+            ))
+            self.next_num_fmt_id += 1
+        return self.num_fmt_ids[number_format]
+
+    def get_xf_id(self, base_xf_id, compiled_style, number_format=None):
+        if not compiled_style and not number_format:
+            return base_xf_id
+        key = (base_xf_id, id(compiled_style), number_format)
+        xf_id = self.xf_ids.get(key)
+        if xf_id is None:
+            xf = ElementTree.fromstring(self.template_xfs[base_xf_id])
+            for name, style_object in compiled_style or ():
+                if name == 'alignment':
+                    for alignment in xf.findall('alignment'):
+                        xf.remove(alignment)
+                    alignment = style_object.to_tree()
+                    if alignment is not None:
+                        xf.insert(0, alignment)
+                    xf.set('applyAlignment', '1')
+                    continue
+                collection = name + 's'
+                xf.set(self.style_attributes[name], str(self._add(
+                    collection, ElementTree.tostring(style_object.to_tree(), encoding='unicode'),
+                    self.counts[collection],
+                )))
+                xf.set('apply%s' % name.title(), '1')
+            if number_format:
+                xf.set('numFmtId', str(self.get_num_fmt_id(number_format)))
+                xf.set('applyNumberFormat', '1')
+            xf_id = self._add('cellXfs', ElementTree.tostring(xf, encoding='unicode'), len(self.template_xfs))
+            self.xf_ids[key] = xf_id
+        return xf_id
+
+    def to_xml(self):
+        styles = self.styles
+        if self.added['numFmts']:
+            if '<numFmts' in styles:
+                styles = _append_children(styles, 'numFmts', self.added['numFmts'], len(self.num_fmt_ids))
+            else:
+                # number formats come first in a stylesheet
+                opening_tag = re.search(r'<styleSheet\b[^>]*>', styles)
+                styles = '%s<numFmts count="%d">%s</numFmts>%s' % (
+                    styles[:opening_tag.end()], len(self.added['numFmts']),
+                    ''.join(self.added['numFmts']), styles[opening_tag.end():],
+                )
+        for collection, _ in self.collections:
+            if self.added[collection]:
+                styles = _append_children(
+                    styles, collection, self.added[collection], self.counts[collection] + len(self.added[collection])
+                )
+        if self.added['cellXfs']:
+            styles = _append_children(
+                styles, 'cellXfs', self.added['cellXfs'], len(self.template_xfs) + len(self.added['cellXfs'])
+            )
+        return styles
+
+
+def _append_children(xml, tag, children, count):
+    opening_tag = re.search(r'<%s\b[^>]*>' % tag, xml)
+    closing_tag = xml.index('</%s>' % tag, opening_tag.end())
+    new_opening_tag = _COUNT_RE.sub(' count="%d"' % count, opening_tag.group(), count=1)
+    return ''.join([
+        xml[:opening_tag.start()], new_opening_tag, xml[opening_tag.end():closing_tag],
+        ''.join(children), xml[closing_tag:],
+    ])
+
+
+def _quote_attribute(value):
+    return '"%s"' % escape(value, {'"': '&quot;'})
+
+
+class StreamingJournal:
+    """
+    Renders a journal by streaming the worksheet's XML into a copy of the workbook template's zip package,
+    so that neither the template nor the written cells are built as an openpyxl object model.
+    Only the worksheet, stylesheet and workbook parts are rewritten; every other part, including
+    the VBA project, is copied byte-for-byte. Cells are valued and styled as `Journal` would do.
+    """
+
+    # rows of the worksheet written to the package at a time
+    chunk_size = 500
+
+    def __init__(self, template_path, sheet_name, start_row, fields):
+        self.template_path = template_path
+        self.sheet_name = sheet_name
+        self.title = sheet_name
+
+        self.start_row = start_row
+        self.current_row = start_row
+        self.fields = fields
+        self.field_columns = {
+            field: column_index_from_string(fields[field]['column'])
+            for field in fields
+        }
+        self.field_styles = {
+            field: Journal.compile_style(fields[field].get('style'))
+            for field in fields
+        }
+        # journal rows by row number and other cells by row number and column index
+        self.rows = {}
+        self.cells = defaultdict(dict)
+        self.defined_names = []
+        self.has_formulas = False
+
+    def next_row(self, increment=1):
+        self.current_row += increment
+
+    def get_cell(self, field):
+        return '%s%s' % (self.fields[field]['column'],
+                         self.current_row)
+
+    def add_row(self, row):
+        self.rows[self.current_row] = row
+        self.next_row()
+
+    def set_field(self, field, value, style=None, extra_style=None, number_format=None):
+        if style is None and extra_style is None:
+            compiled_style = self.field_styles[field]
+        else:
+            compiled_style = Journal.compile_style(style or self.fields[field].get('style', {}), extra_style)
+        self.cells[self.current_row][self.field_columns[field]] = (value, compiled_style, number_format)
+
+    def set_cell_value(self, coordinate, value):
+        column, row = coordinate_from_string(coordinate)
+        self.cells[row][column_index_from_string(column)] = (value, None, None)
+
+    def set_title(self, title):
+        self.title = title
+
+    def create_named_range(self, name, reference):
+        self.defined_names.append((name, '%s!%s' % (quote_sheetname(self.title), reference)))
+
+    def create_file(self, output=None):
+        """
+        Saves the workbook
+        :param output: file path or writable file-like object to stream the package into;
+            if omitted, the file contents are returned as bytes
+        """
+        if output is not None:
+            self._write_package(output)
+            return None
+        f = io.BytesIO()
+        self._write_package(f)
+        return f.getvalue()
+
+    def _write_package(self, output):
+        template = _load_template(self.template_path, os.stat(self.template_path).st_mtime_ns, self.sheet_name)
+        stylesheet = _Stylesheet(template.styles)
+        with zipfile.ZipFile(self.template_path) as package, \
+                zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as journal_package:
+            for member in package.infolist():
+                if member.filename == template.worksheet_member:
+                    info = zipfile.ZipInfo(member.filename, date_time=member.date_time)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with journal_package.open(info, 'w', force_zip64=True) as f:
+                        for chunk in self._iter_worksheet(template, stylesheet):
+                            f.write(chunk.encode('utf-8'))
+                elif member.filename not in (STYLES_MEMBER, WORKBOOK_MEMBER):
+                    copy_member(package, journal_package, member)
+            # formats and calculation settings are only known once the worksheet is written
+            journal_package.writestr(package.getinfo(STYLES_MEMBER), stylesheet.to_xml().encode('utf-8'))
+            journal_package.writestr(package.getinfo(WORKBOOK_MEMBER), self._get_workbook(template).encode('utf-8'))
+
+    def _iter_worksheet(self, template, stylesheet):
+        row_numbers = sorted(set(template.rows) | set(self.rows) | set(self.cells))
+        last_row = row_numbers[-1] if row_numbers else 1
+        last_column = max([template.last_column] + list(self.field_columns.values()) + [
+            column for cells in self.cells.values() for column in cells
+        ])
+        dimension = '%s%d' % (get_column_letter(last_column), last_row)
+        yield _DIMENSION_RE.sub(
+            lambda match: '<dimension ref="%s:%s"/>' % (match.group('first'), dimension),
+            template.sheet_head, count=1,
+        ) + '<sheetData>'
+
+        field_columns = [(self.field_columns[field], self.fields[field]['column']) for field in self.fields]
+        field_styles = [self.field_styles[field] for field in self.fields]
+        # style ids of journal rows' cells only differ where rows are written over styled template rows
+        row_xf_ids = {}
+        chunk = []
+        for row_number in row_numbers:
+            template_row = template.rows.get(row_number)
+            cells = dict(template_row.cells) if template_row else {}
+
+            row = self.rows.get(row_number)
+            if row is not None:
+                xf_ids_key = template_row and row_number
+                xf_ids = row_xf_ids.get(xf_ids_key)
+                if xf_ids is None:
+                    xf_ids = [
+                        stylesheet.get_xf_id(cells[column][1] if column in cells else 0, compiled_style)
+                        for (column, _), compiled_style in zip(field_columns, field_styles)
+                    ]
+                    row_xf_ids[xf_ids_key] = xf_ids
+                for (column, column_letter), xf_id, value in zip(field_columns, xf_ids, row.values):
+                    if value is not UNSET:
+                        cells[column] = (self._get_cell_xml(column_letter, row_number, xf_id, value), xf_id)
+            for column, (value, compiled_style, number_format) in self.cells.get(row_number, {}).items():
+                template_cell = cells.get(column)
+                xf_id = stylesheet.get_xf_id(template_cell[1] if template_cell else 0, compiled_style, number_format)
+                cells[column] = (self._get_cell_xml(get_column_letter(column), row_number, xf_id, value), xf_id)
+
+            row_attrs = template_row.attrs if template_row else ' r="%d"' % row_number
+            chunk.append('<row%s>%s</row>' % (row_attrs, ''.join(cells[column][0] for column in sorted(cells))))
+            if len(chunk) >= self.chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+
+        yield ''.join(chunk) + '</sheetData>' + template.sheet_tail
+
+    def _get_cell_xml(self, column_letter, row_number, xf_id, value):
+        style = ' s="%d"' % xf_id if xf_id else ''
+        if value is None or value == '':
+            return '<c r="%s%d"%s/>' % (column_letter, row_number, style)
+        if not isinstance(value, str):
+            if isinstance(value, bool):
+                return '<c r="%s%d"%s t="b"><v>%d</v></c>' % (column_letter, row_number, style, value)
+            if isinstance(value, (int, float, Decimal)):
+                return '<c r="%s%d"%s><v>%s</v></c>' % (column_letter, row_number, style, value)
+            value = str(value)
+        if value[0] == '=' and len(value) > 1:
+            self.has_formulas = True
+            return '<c r="%s%d"%s><f>%s</f><v></v></c>' % (column_letter, row_number, style, escape(value[1:]))
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            raise IllegalCharacterError('%s cannot be used in worksheets.' % value)
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        return '<c r="%s%d"%s t="inlineStr"><is><t%s>%s</t></is></c>' % (
+            column_letter, row_number, style, space, escape(value)
+        )
+
+    def _get_workbook(self, template):
+        workbook = template.workbook
+        if self.title != self.sheet_name:
+            workbook = re.sub(
+                r'(<sheet\b[^>]*?\sname=)"%s"' % re.escape(escape(self.sheet_name, {'"': '&quot;'})),
+                lambda match: match.group(1) + _quote_attribute(self.title),
+                workbook, count=1,
+            )
+        if self.defined_names:
+            defined_names = ''.join(
+                '<definedName name=%s>%s</definedName>' % (_quote_attribute(name), escape(reference))
+                for name, reference in self.defined_names
+            )
+            if '<definedNames>' in workbook:
+                workbook = workbook.replace('<definedNames>', '<definedNames>' + defined_names, 1)
+            else:
+                workbook = _insert_after_sheets(workbook, '<definedNames>%s</definedNames>' % defined_names)
+        if self.has_formulas:
+            # like openpyxl, formulas are written without values so must be calculated when the workbook is opened
+            calculation = re.search(r'<calcPr\b[^>]*?/?>', workbook)
+            if not calculation:
+                workbook = _insert_after_sheets(workbook, '<calcPr fullCalcOnLoad="1"/>', after_defined_names=True)
+            elif 'fullCalcOnLoad=' not in calculation.group():
+                workbook = workbook.replace('<calcPr', '<calcPr fullCalcOnLoad="1"', 1)
+        return workbook
+
+
+def _insert_after_sheets(workbook, xml, after_defined_names=False):
+    # workbook parts that can come between sheets and the inserted element
+    preceding_tags = ['sheets', 'functionGroups', 'externalReferences']
+    if after_defined_names:
+        preceding_tags.append('definedNames')
+    position = max(
+        workbook.rindex('</%s>' % tag) + len(tag) + 3
+        for tag in preceding_tags
+        if '</%s>' % tag in workbook
+    )
+    return workbook[:position] + xml + workbook[position:]
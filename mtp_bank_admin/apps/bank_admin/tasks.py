@@ -0,0 +1,34 @@
+from django.conf import settings
+from mtp_common.auth import api_client
+from mtp_common.spooling import spoolable, spooler
+
+from .generation import (
+    STATUS_PENDING, STATUS_READY, generate_file, get_file_generation_status, mark_file_generation_pending
+)
+
+
+@spoolable()
+def generate_file_in_background(label, receipt_date, profile=False):
+    api_session = api_client.get_authenticated_api_session(
+        settings.BANK_ADMIN_USERNAME,
+        settings.BANK_ADMIN_PASSWORD
+    )
+    generate_file(api_session, label, receipt_date, profile=profile)
+
+
+def start_file_generation(label, receipt_date, profile=False):
+    """
+    Schedules generation of a file in the uWSGI spooler unless it is already cached or being generated
+    :param profile: write a profile report of the file's generation
+    :return: True if the file is not ready yet and the caller should wait for it,
+        False if the file can be served immediately or the spooler is not available
+    """
+    if not spooler.installed:
+        return False
+    status = get_file_generation_status(label, receipt_date)
+    if status and status['status'] == STATUS_READY:
+        return False
+    if not status or status['status'] != STATUS_PENDING:
+        mark_file_generation_pending(label, receipt_date)
+        generate_file_in_background(label, receipt_date, profile=profile)
+    return True
@@ -1,10 +1,13 @@
 from collections import defaultdict
 from datetime import date, datetime, timedelta, timezone
+import io
 import logging
 import os
 from unittest import mock, skipUnless
 from urllib.parse import quote_plus
+import zipfile
 
+from django.conf import settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 from mtp_common.auth.api_client import get_api_session
@@ -18,10 +21,11 @@ from .utils import (
     get_test_transactions, get_test_credits, temp_file, api_url,
     mock_bank_holidays, BankAdminTestCase
 )
-from bank_admin import adi, adi_config
+from bank_admin import adi, adi_config, ADI_JOURNAL_LABEL
 from bank_admin.exceptions import EmptyFileError, EarlyReconciliationError
-from bank_admin.types import PaymentType
-from bank_admin.utils import set_worldpay_cutoff
+from bank_admin.prisons import PrisonRegistry
+from bank_admin.types import PaymentType, RecordType
+from bank_admin.utils import get_cached_file_path, set_worldpay_cutoff
 
 
 def get_cell_value(journal_ws, field, row):
@@ -344,6 +348,34 @@ class AdiPaymentFileGenerationTestCase(BankAdminTestCase):
             journal_ws = wb['130916']
             self.assertTrue('JS' in journal_ws[adi_config.ADI_BATCH_NAME_CELL].value)
 
+    @responses.activate
+    def test_cached_journal_personalised_in_place(self):
+        exceldata, _ = self._generate_test_adi_journal()
+        filepath = get_cached_file_path(ADI_JOURNAL_LABEL, date(2016, 9, 13), extension='xlsm')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(exceldata)
+
+        personalised_data = adi.get_adi_journal_file(None, date(2016, 9, 13), user=self.get_user())
+
+        journal_ws = load_workbook(io.BytesIO(exceldata))['130916']
+        personalised_ws = load_workbook(io.BytesIO(personalised_data))['130916']
+        batch_name = personalised_ws[adi_config.ADI_BATCH_NAME_CELL]
+        self.assertIn('<initials>', journal_ws[adi_config.ADI_BATCH_NAME_CELL].value)
+        self.assertEqual(batch_name.value, adi.get_batch_name(self.get_user()))
+        self.assertTrue(batch_name.value.endswith('/JS'))
+        self.assertEqual(batch_name.style_id, journal_ws[adi_config.ADI_BATCH_NAME_CELL].style_id)
+
+        with zipfile.ZipFile(io.BytesIO(exceldata)) as package, \
+                zipfile.ZipFile(io.BytesIO(personalised_data)) as personalised_package:
+            self.assertIsNone(personalised_package.testzip())
+            self.assertEqual(personalised_package.namelist(), package.namelist())
+            changed_members = [
+                member for member in package.namelist()
+                if package.read(member) != personalised_package.read(member)
+            ]
+        self.assertEqual(changed_members, ['xl/worksheets/sheet4.xml'])
+
     @responses.activate
     @mock.patch('bank_admin.adi.date')
     def test_accounting_date_is_download_date(self, mock_date):
@@ -384,3 +416,75 @@ class AdiPaymentFileGenerationTestCase(BankAdminTestCase):
     def test_early_reconciliation_raises_error(self):
         with self.assertRaises(EarlyReconciliationError):
             self._generate_test_adi_journal(receipt_date=date.today())
+
+
+class AdiCreditAggregationTestCase(BankAdminTestCase):
+    def test_credits_summed_in_pence(self):
+        credits = [
+            {'prison': 'BPR', 'amount': 10, 'source': 'online', 'reconciliation_code': '1001'},
+            {'prison': 'MPR', 'amount': 20, 'source': 'online', 'reconciliation_code': '1001'},
+            {'prison': 'NPR', 'amount': 30, 'source': 'online', 'reconciliation_code': ''},
+            {'prison': 'MPR', 'amount': 1999, 'source': 'bank_transfer', 'reconciliation_code': '900001'},
+            {'prison': 'BPR', 'amount': 5001, 'source': 'bank_transfer', 'reconciliation_code': '900002'},
+        ]
+
+        debit_card_batches, prison_totals, prison_transactions = adi.aggregate_credits(
+            credits, PrisonRegistry(TEST_PRISONS), '13/09/2016'
+        )
+
+        self.assertEqual(debit_card_batches, {'1001': 30, '13/09/2016 - Card payment': 30})
+        self.assertEqual(prison_totals, {'048': 5011, '067': 2049})
+        self.assertEqual(prison_transactions, {'067': [credits[3]], '048': [credits[4]]})
+        self.assertTrue(all(isinstance(total, int) for total in prison_totals.values()))
+        self.assertEqual(adi.to_pounds(prison_totals['067']), 20.49)
+
+
+class AdiRowTemplateTestCase(BankAdminTestCase):
+    def test_row_templates_fill_static_and_context_values(self):
+        journal = adi.AdiJournal(
+            settings.ADI_TEMPLATE_FILEPATH,
+            adi_config.ADI_JOURNAL_SHEET,
+            adi_config.ADI_JOURNAL_START_ROW,
+            adi_config.ADI_JOURNAL_FIELDS
+        )
+        context = {
+            'reconciliation_code': '900001', 'prison_ledger_code': '048', 'prison_name': 'Big Prison',
+            'date': '13/09/2016', 'reference': 'John Smith',
+        }
+        holding_account = settings.PRISONER_MONEY_HOLDING_ACCOUNT
+        # cost_centre, account, debit, credit and description vary by payment and record type
+        expected_rows = {
+            (PaymentType.payment, RecordType.debit): ('99999999', holding_account, 12.5, None, '900001'),
+            (PaymentType.payment, RecordType.credit): (
+                '048', '2617902085', None, 12.5, 'Big Prison MTP Total 13/09/2016'
+            ),
+            (PaymentType.refund, RecordType.debit): ('99999999', holding_account, 12.5, None, '900001'),
+            (PaymentType.refund, RecordType.credit): (
+                '99999999', holding_account, None, 12.5, 'MTP Refund File 13/09/2016'
+            ),
+            (PaymentType.reject, RecordType.debit): ('99999999', holding_account, 12.5, None, '900001'),
+            (PaymentType.reject, RecordType.credit): (
+                '10209200', '1816902028', None, 12.5, '13/09/2016 - John Smith'
+            ),
+        }
+        for payment_type in PaymentType:
+            for record_type in RecordType:
+                row = journal.current_row
+                journal.add_payment_row(12.5, payment_type, record_type, **context)
+                cost_centre, account, debit, credit, description = expected_rows[(payment_type, record_type)]
+                expected_values = {
+                    'upload': 'O', 'entity': '0210', 'cost_centre': cost_centre, 'account': account,
+                    'objective': '0000000', 'analysis': '00000000', 'intercompany': '0000', 'spare': '0000000',
+                    'debit': debit, 'credit': credit, 'description': description,
+                    'resolution': None, 'messages': None,
+                }
+                self.assertEqual(set(expected_values), set(adi_config.ADI_JOURNAL_FIELDS))
+                for field, expected_value in expected_values.items():
+                    self.assertEqual(
+                        get_cell_value(journal.journal_ws, field, row), expected_value,
+                        (payment_type, record_type, field)
+                    )
+
+        self.assertEqual(len(journal.row_layout.row_templates), len(PaymentType) * len(RecordType))
+        journal.add_payment_row(1, PaymentType.payment, RecordType.debit, reconciliation_code='900002')
+        self.assertEqual(len(journal.row_layout.row_templates), len(PaymentType) * len(RecordType))
@@ -0,0 +1,110 @@
+import json
+from unittest import mock
+
+from django.test import override_settings
+from mtp_common.auth.api_client import get_api_session
+from mtp_common.auth.exceptions import HttpClientError, HttpServerError
+from mtp_common.auth.test_utils import generate_tokens
+from mtp_common.test_utils import silence_logger
+import requests
+import responses
+
+from bank_admin.api import RetryBudget, get_with_retries, retrieve_all_pages_for_path
+from bank_admin.utils import retrieve_all_pages_concurrently
+from .utils import api_url, get_query_dict, BankAdminTestCase
+
+
+@override_settings(REQUEST_RETRY_BUDGET=3, REQUEST_RETRY_BASE_DELAY=1, REQUEST_RETRY_MAX_DELAY=3,
+                   REQUEST_PAGE_SIZE=10)
+@mock.patch('bank_admin.api.random.uniform', side_effect=lambda low, high: high)
+@mock.patch('bank_admin.api.time.sleep')
+class RetryTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api_session = get_api_session(mock.MagicMock(
+            user=mock.MagicMock(
+                token=generate_tokens()
+            )
+        ))
+        logger_context = silence_logger()
+        logger_context.__enter__()
+        self.addCleanup(logger_context.__exit__, None, None, None)
+
+    def mock_pages(self, count, failures):
+        """
+        Mocks a list of `count` items where requests for the given offsets fail once each
+        """
+        failures = list(failures)
+
+        def page_callback(request):
+            offset = int(get_query_dict(request.url)['offset'])
+            if offset in failures:
+                failures.remove(offset)
+                return 503, {}, ''
+            results = [{'id': i} for i in range(offset, min(offset + 10, count))]
+            return 200, {}, json.dumps({'count': count, 'results': results})
+
+        responses.add_callback(responses.GET, api_url('/credits/'), callback=page_callback)
+
+    def requested_offsets(self):
+        return [int(get_query_dict(call.request.url)['offset']) for call in responses.calls]
+
+    @responses.activate
+    def test_transient_errors_retried_with_backoff(self, mocked_sleep, _):
+        responses.add(responses.GET, api_url('/balances/'), body=requests.exceptions.ConnectionError())
+        responses.add(responses.GET, api_url('/balances/'), status=502)
+        responses.add(responses.GET, api_url('/balances/'), json={'results': []})
+
+        response = get_with_retries(self.api_session, 'balances/')
+
+        self.assertEqual(response.json(), {'results': []})
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(mocked_sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+    def test_backoff_capped(self, mocked_sleep, _):
+        budget = RetryBudget(retries=4)
+        self.assertEqual([budget.spend() for _ in range(5)], [1, 2, 3, 3, None])
+
+    @responses.activate
+    def test_client_errors_not_retried(self, mocked_sleep, _):
+        responses.add(responses.GET, api_url('/balances/'), status=400)
+
+        with self.assertRaises(HttpClientError):
+            get_with_retries(self.api_session, 'balances/')
+        self.assertEqual(len(responses.calls), 1)
+        mocked_sleep.assert_not_called()
+
+    @responses.activate
+    def test_gives_up_when_budget_spent(self, mocked_sleep, _):
+        responses.add(responses.GET, api_url('/balances/'), status=503)
+
+        with self.assertRaises(HttpServerError):
+            get_with_retries(self.api_session, 'balances/')
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_pages_resume_from_failed_offset(self, mocked_sleep, _):
+        self.mock_pages(25, failures=[10, 20])
+
+        results = retrieve_all_pages_for_path(self.api_session, 'credits/')
+
+        self.assertEqual(results, [{'id': i} for i in range(25)])
+        self.assertEqual(self.requested_offsets(), [0, 10, 10, 20, 20])
+
+    @responses.activate
+    def test_budget_shared_by_all_pages(self, mocked_sleep, _):
+        self.mock_pages(50, failures=[10, 20, 30, 40])
+
+        with self.assertRaises(HttpServerError):
+            retrieve_all_pages_for_path(self.api_session, 'credits/')
+        self.assertEqual(mocked_sleep.call_count, 3)
+
+    @responses.activate
+    @override_settings(REQUEST_PAGE_CONCURRENCY=3)
+    def test_concurrent_pages_retried_individually(self, mocked_sleep, _):
+        self.mock_pages(45, failures=[20, 40])
+
+        results = retrieve_all_pages_concurrently(self.api_session, 'credits/')
+
+        self.assertEqual(results, [{'id': i} for i in range(45)])
+        self.assertEqual(sorted(self.requested_offsets()), [0, 10, 20, 20, 30, 40, 40])
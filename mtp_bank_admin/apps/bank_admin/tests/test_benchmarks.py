@@ -0,0 +1,92 @@
+import io
+import json
+import os
+import tempfile
+from unittest import skipUnless
+
+from django.core.management import CommandError, call_command
+import responses
+
+from bank_admin import ADI_JOURNAL_LABEL, ACCESSPAY_LABEL, MT940_STMT_LABEL, DISBURSEMENTS_LABEL
+from bank_admin.benchmarks import (
+    BENCHMARK_BASELINE_PATH, BENCHMARK_DATE, BenchmarkResult, find_regressions, run_benchmarks, save_baseline
+)
+from bank_admin.datasets import DailySnapshot
+from bank_admin.utils import RECONCILED_LABEL, get_cached_file_path
+from .utils import mock_bank_holidays, BankAdminTestCase
+
+
+class BenchmarkTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.baseline_path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+
+    @responses.activate
+    def test_all_files_benchmarked_from_snapshot(self):
+        mock_bank_holidays()
+        marker_path = get_cached_file_path(RECONCILED_LABEL, BENCHMARK_DATE)
+        os.makedirs(os.path.dirname(marker_path))
+        with open(marker_path, 'w') as f:
+            f.write('reconciled')
+
+        results = run_benchmarks(volumes=[100])
+
+        self.assertEqual(
+            [result.label for result in results],
+            [ADI_JOURNAL_LABEL, MT940_STMT_LABEL, ACCESSPAY_LABEL, DISBURSEMENTS_LABEL]
+        )
+        for result in results:
+            self.assertEqual(result.volume, 100)
+            self.assertGreater(result.seconds, 0)
+            self.assertGreater(result.peak_memory, 0)
+            self.assertGreater(result.records_per_second, 0)
+        # synthetic data is kept out of the real file cache
+        self.assertFalse(os.path.exists(DailySnapshot(BENCHMARK_DATE).path))
+        self.assertTrue(os.path.exists(marker_path))
+        self.assertEqual(get_cached_file_path(RECONCILED_LABEL, BENCHMARK_DATE), marker_path)
+
+    def test_regressions_found_against_baseline(self):
+        save_baseline([
+            BenchmarkResult(ADI_JOURNAL_LABEL, 1000, 1.0, 1000000),
+            BenchmarkResult(MT940_STMT_LABEL, 1000, 1.0, 1000000),
+        ], self.baseline_path)
+        with open(self.baseline_path) as f:
+            baseline = json.load(f)
+        self.assertEqual(baseline[ADI_JOURNAL_LABEL]['1000']['records_per_second'], 1000)
+
+        results = [
+            BenchmarkResult(ADI_JOURNAL_LABEL, 1000, 1.2, 1300000),
+            BenchmarkResult(MT940_STMT_LABEL, 1000, 1.3, 900000),
+            BenchmarkResult(MT940_STMT_LABEL, 10000, 100.0, 1000000),
+        ]
+        regressions = find_regressions(results, baseline, tolerance=0.25)
+        self.assertEqual(
+            [(result.label, measure, expected) for result, measure, expected in regressions],
+            [(ADI_JOURNAL_LABEL, 'peak_memory', 1000000), (MT940_STMT_LABEL, 'seconds', 1.0)]
+        )
+
+    @responses.activate
+    def test_command_saves_and_compares_baseline(self):
+        mock_bank_holidays()
+        options = dict(volumes=[50], files=[ACCESSPAY_LABEL], baseline=self.baseline_path, stdout=io.StringIO())
+
+        call_command('benchmark_file_generation', save_baseline=True, **options)
+        with open(self.baseline_path) as f:
+            self.assertEqual(list(json.load(f)[ACCESSPAY_LABEL]), ['50'])
+
+        with open(self.baseline_path, 'w') as f:
+            json.dump({ACCESSPAY_LABEL: {'50': {'seconds': 0, 'peak_memory': 0, 'records_per_second': 0}}}, f)
+        with self.assertRaises(CommandError):
+            call_command('benchmark_file_generation', fail_on_regression=True, stderr=io.StringIO(), **options)
+
+    @skipUnless(os.environ.get('RUN_BENCHMARKS'), 'Enable to benchmark file generation at full volumes')
+    def test_no_regressions_at_full_volumes(self):
+        # bank holidays are downloaded for real since mocking them would not affect timings
+        stdout, stderr = io.StringIO(), io.StringIO()
+        try:
+            call_command(
+                'benchmark_file_generation', baseline=BENCHMARK_BASELINE_PATH, fail_on_regression=True,
+                stdout=stdout, stderr=stderr,
+            )
+        except CommandError as e:
+            self.fail('%s\n%s%s' % (e, stdout.getvalue(), stderr.getvalue()))
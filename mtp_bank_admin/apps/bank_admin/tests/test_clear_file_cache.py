@@ -0,0 +1,57 @@
+from datetime import date
+import os
+import time
+from unittest import mock
+
+from django.core.management import call_command
+
+from bank_admin import ADI_JOURNAL_LABEL, MT940_STMT_LABEL
+from bank_admin.datasets import DailySnapshot
+from bank_admin.utils import FILE_CACHE_PATH, RECONCILED_LABEL, get_cached_file_path
+from .utils import BankAdminTestCase
+
+PATH = 'bank_admin.management.commands.clear_file_cache'
+
+
+@mock.patch(f'{PATH}.get_preceding_workday_list', return_value=[date(2016, 12, 23), date(2016, 12, 22)])
+class ClearFileCacheTestCase(BankAdminTestCase):
+    def cache_file(self, filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(b'cached')
+        return filepath
+
+    def test_only_dates_before_preceding_workdays_removed(self, mocked_workdays):
+        kept = [
+            self.cache_file(get_cached_file_path(ADI_JOURNAL_LABEL, date(2016, 12, 22), extension='xlsm')),
+            self.cache_file(get_cached_file_path(MT940_STMT_LABEL, date(2016, 12, 23), extension='status')),
+            self.cache_file(get_cached_file_path(RECONCILED_LABEL, date(2016, 12, 24))),
+            self.cache_file(DailySnapshot(date(2016, 12, 22)).get_source_path('credits')),
+            self.cache_file(os.path.join(FILE_CACHE_PATH, MT940_STMT_LABEL, 'recent.tmp')),
+        ]
+        removed = [
+            self.cache_file(get_cached_file_path(ADI_JOURNAL_LABEL, date(2016, 12, 21), extension='xlsm')),
+            self.cache_file(get_cached_file_path(RECONCILED_LABEL, date(2016, 11, 30))),
+            self.cache_file(os.path.join(FILE_CACHE_PATH, RECONCILED_LABEL, '.20161130.lock')),
+            DailySnapshot(date(2016, 11, 30)).path,
+            self.cache_file(os.path.join(FILE_CACHE_PATH, MT940_STMT_LABEL, 'old.tmp')),
+        ]
+        self.cache_file(DailySnapshot(date(2016, 11, 30)).get_source_path('credits'))
+        old = time.time() - 2 * 24 * 60 * 60
+        os.utime(removed[-1], (old, old))
+
+        call_command('clear_file_cache')
+
+        mocked_workdays.assert_called_once_with(20, offset=2)
+        for path in kept:
+            self.assertTrue(os.path.exists(path), msg='%s should be kept' % path)
+        for path in removed:
+            self.assertFalse(os.path.exists(path), msg='%s should be removed' % path)
+
+    def test_whole_cache_removed(self, mocked_workdays):
+        self.cache_file(get_cached_file_path(ADI_JOURNAL_LABEL, date(2016, 12, 22), extension='xlsm'))
+
+        call_command('clear_file_cache', all=True)
+
+        mocked_workdays.assert_not_called()
+        self.assertFalse(os.path.exists(FILE_CACHE_PATH))
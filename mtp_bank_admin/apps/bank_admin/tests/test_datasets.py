@@ -0,0 +1,132 @@
+from datetime import date
+import gzip
+import json
+import os
+from unittest import mock
+
+from mtp_common.auth.api_client import get_api_session
+from mtp_common.auth.test_utils import generate_tokens
+import responses
+
+from bank_admin.datasets import DailyDataset, DailySnapshot
+from .utils import (
+    TEST_PRISONS, api_url, get_query_dict, mock_balance, mock_bank_holidays, mock_list_prisons,
+    BankAdminTestCase,
+)
+
+
+class DailyDatasetTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api_session = get_api_session(mock.MagicMock(
+            user=mock.MagicMock(
+                token=generate_tokens()
+            )
+        ))
+
+    def mock_transactions(self):
+        def transactions_callback(request):
+            status = get_query_dict(request.url).get('status')
+            if status == 'refundable':
+                results = [{'id': 1, 'category': 'credit'}]
+            else:
+                results = [{'id': 1, 'category': 'credit'}, {'id': 2, 'category': 'debit'}]
+            return 200, {}, json.dumps({'count': len(results), 'results': results})
+
+        mock_bank_holidays()
+        responses.add_callback(responses.GET, api_url('/transactions/'), callback=transactions_callback)
+
+    def api_calls(self):
+        return [call for call in responses.calls if call.request.url.startswith(api_url('/'))]
+
+    def transaction_requests(self):
+        return [
+            get_query_dict(call.request.url)
+            for call in responses.calls
+            if '/transactions/' in call.request.url
+        ]
+
+    @responses.activate
+    def test_each_query_loaded_once_per_date(self):
+        self.mock_transactions()
+
+        refundable = DailyDataset(self.api_session, date(2016, 9, 13)).transactions('refundable')
+        refundable_again = DailyDataset(self.api_session, date(2016, 9, 13)).transactions('refundable')
+        everything = DailyDataset(self.api_session, date(2016, 9, 13)).transactions()
+
+        self.assertEqual(refundable, refundable_again)
+        self.assertEqual([t['id'] for t in refundable], [1])
+        self.assertEqual([t['id'] for t in everything], [1, 2])
+        requests = self.transaction_requests()
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0]['status'], 'refundable')
+        self.assertEqual(requests[0]['received_at__gte'], '2016-09-13 00:00:00+00:00')
+        self.assertEqual(requests[0]['received_at__lt'], '2016-09-14 00:00:00+00:00')
+        self.assertNotIn('status', requests[1])
+
+    @responses.activate
+    def test_dates_loaded_separately(self):
+        self.mock_transactions()
+
+        DailyDataset(self.api_session, date(2016, 9, 13)).transactions()
+        DailyDataset(self.api_session, date(2016, 9, 14)).transactions()
+
+        self.assertEqual(len(self.transaction_requests()), 2)
+
+    @responses.activate
+    def test_categories_partitioned_locally(self):
+        self.mock_transactions()
+
+        dataset = DailyDataset(self.api_session, date(2016, 9, 13))
+        self.assertEqual([t['id'] for t in dataset.transactions_with_category('credit')], [1])
+        self.assertEqual([t['id'] for t in dataset.transactions_with_category('debit')], [2])
+
+        self.assertEqual(len(self.transaction_requests()), 1)
+
+    @responses.activate
+    def test_sources_saved_in_compressed_snapshot(self):
+        self.mock_transactions()
+        mock_list_prisons()
+        mock_balance()
+
+        dataset = DailyDataset(self.api_session, date(2016, 9, 13))
+        dataset.transactions()
+        dataset.prison_registry()
+        dataset.last_balance()
+
+        self.assertEqual(
+            sorted(os.listdir(dataset.snapshot.path)),
+            ['last_balance.json.gz', 'prisons.json.gz', 'transactions-all.json.gz']
+        )
+        with gzip.open(dataset.snapshot.get_source_path('prisons'), 'rt') as f:
+            self.assertEqual(json.load(f), TEST_PRISONS)
+
+    @responses.activate
+    def test_sources_rebuilt_from_snapshot(self):
+        self.mock_transactions()
+        mock_list_prisons()
+
+        dataset = DailyDataset(self.api_session, date(2016, 9, 13))
+        transactions = dataset.transactions()
+        prison_registry = dataset.prison_registry()
+        calls = len(self.api_calls())
+
+        dataset = DailyDataset(self.api_session, date(2016, 9, 13))
+        self.assertEqual(dataset.transactions(), transactions)
+        self.assertEqual(dataset.prison_registry().by_ledger_code, prison_registry.by_ledger_code)
+        self.assertEqual(len(self.api_calls()), calls)
+
+    def test_missing_last_balance_saved(self):
+        snapshot = DailySnapshot(date(2016, 9, 13))
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(snapshot.get('last_balance', loader))
+        self.assertIsNone(DailySnapshot(date(2016, 9, 13)).get('last_balance', loader))
+        loader.assert_called_once()
+
+    def test_corrupt_snapshot_ignored(self):
+        snapshot = DailySnapshot(date(2016, 9, 13))
+        os.makedirs(snapshot.path, exist_ok=True)
+        with open(snapshot.get_source_path('credits'), 'wb') as f:
+            f.write(b'not gzip')
+        self.assertEqual(snapshot.get('credits', lambda: [{'id': 1}]), [{'id': 1}])
+        self.assertEqual(DailySnapshot(date(2016, 9, 13)).get('credits', None), [{'id': 1}])
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import os
+import threading
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import override_settings
+
+from bank_admin import ADI_JOURNAL_LABEL, ACCESSPAY_LABEL, MT940_STMT_LABEL, DISBURSEMENTS_LABEL
+from bank_admin.exceptions import EmptyFileError
+from bank_admin.generation import FILE_GENERATORS, _write_status
+from bank_admin.management.commands.prewarm_file_cache import RequestLimitedSession
+from bank_admin.utils import get_cached_file_path
+from .utils import BankAdminTestCase
+
+PATH = 'bank_admin.management.commands.prewarm_file_cache'
+
+
+@mock.patch(f'{PATH}.get_preceding_workday_list', return_value=[date(2016, 12, 23), date(2016, 12, 22)])
+@mock.patch(f'{PATH}.api_client.get_authenticated_api_session')
+class PrewarmFileCacheTestCase(BankAdminTestCase):
+    def cache_file(self, label, receipt_date, extension=None):
+        filepath = get_cached_file_path(label, receipt_date, extension=extension)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(b'cached')
+
+    @mock.patch(f'{PATH}.generate_file')
+    def test_only_missing_files_generated(self, mocked_generate_file, mocked_api_session, mocked_workdays):
+        self.cache_file(ADI_JOURNAL_LABEL, date(2016, 12, 23), extension='xlsm')
+        self.cache_file(MT940_STMT_LABEL, date(2016, 12, 22))
+        _write_status(DISBURSEMENTS_LABEL, date(2016, 12, 22), {'status': 'failed', 'error': 'EmptyFileError'})
+        _write_status(DISBURSEMENTS_LABEL, date(2016, 12, 23), {'status': 'failed', 'error': 'error'})
+
+        with override_settings(SHOW_ACCESS_PAY_REFUNDS=False):
+            call_command('prewarm_file_cache', workers=2)
+
+        mocked_workdays.assert_called_once_with(20, offset=2)
+        generated = {call.args[1:] for call in mocked_generate_file.call_args_list}
+        self.assertEqual(generated, {
+            (MT940_STMT_LABEL, date(2016, 12, 23)),
+            (DISBURSEMENTS_LABEL, date(2016, 12, 23)),
+            (ADI_JOURNAL_LABEL, date(2016, 12, 22)),
+        })
+
+    @mock.patch(f'{PATH}.generate_file')
+    def test_refunds_generated_when_shown(self, mocked_generate_file, mocked_api_session, mocked_workdays):
+        with override_settings(SHOW_ACCESS_PAY_REFUNDS=True):
+            call_command('prewarm_file_cache', days=5)
+
+        mocked_workdays.assert_called_once_with(5, offset=2)
+        generated_labels = {call.args[1] for call in mocked_generate_file.call_args_list}
+        self.assertIn(ACCESSPAY_LABEL, generated_labels)
+        self.assertEqual(mocked_generate_file.call_count, 8)
+
+    def test_failures_recorded(self, mocked_api_session, mocked_workdays):
+        generators = {label: mock.Mock(side_effect=EmptyFileError) for label in FILE_GENERATORS}
+        with mock.patch.dict(FILE_GENERATORS, {
+            label: generator._replace(function=generators[label])
+            for label, generator in FILE_GENERATORS.items()
+        }):
+            call_command('prewarm_file_cache')
+            call_command('prewarm_file_cache')
+
+        # dates with nothing to download are not tried again
+        for generator in generators.values():
+            self.assertEqual(generator.call_count, 2)
+
+    @mock.patch(f'{PATH}.generate_file')
+    def test_api_requests_limited_across_workers(self, mocked_generate_file, mocked_api_session, mocked_workdays):
+        call_command('prewarm_file_cache', workers=4, max_requests=2)
+
+        api_session = mocked_generate_file.call_args.args[0]
+        self.assertIsInstance(api_session, RequestLimitedSession)
+        self.assertIs(api_session.api_session, mocked_api_session.return_value)
+
+    def test_limited_session(self, mocked_api_session, mocked_workdays):
+        lock = threading.Lock()
+        concurrency = {'current': 0, 'max': 0}
+
+        def get(path):
+            with lock:
+                concurrency['current'] += 1
+                concurrency['max'] = max(concurrency['max'], concurrency['current'])
+            threading.Event().wait(0.01)
+            with lock:
+                concurrency['current'] -= 1
+            return path
+
+        api_session = RequestLimitedSession(mock.Mock(get=get), 2)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            self.assertEqual(list(executor.map(api_session.get, range(12))), list(range(12)))
+        self.assertEqual(concurrency['max'], 2)
+        # other requests are not limited
+        api_session.post('transactions/reconcile/')
+        api_session.api_session.post.assert_called_once_with('transactions/reconcile/')
@@ -0,0 +1,77 @@
+from unittest import mock
+
+from django.test import override_settings
+from mtp_common.auth.api_client import get_api_session
+from mtp_common.auth.test_utils import generate_tokens
+import requests
+import responses
+
+from bank_admin.prisons import get_prison_registry
+from .utils import TEST_PRISONS, api_url, mock_list_prisons, BankAdminTestCase
+
+
+@override_settings(PRISON_CACHE_TTL=60)
+class PrisonRegistryTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api_session = get_api_session(mock.MagicMock(
+            user=mock.MagicMock(
+                token=generate_tokens()
+            )
+        ))
+
+    def prison_requests(self):
+        return [call for call in responses.calls if '/prisons/' in call.request.url]
+
+    @responses.activate
+    def test_indexes(self):
+        mock_list_prisons()
+        registry = get_prison_registry(self.api_session)
+
+        self.assertEqual(set(registry.by_nomis_id), {prison['nomis_id'] for prison in TEST_PRISONS})
+        self.assertEqual(registry.by_ledger_code['048']['nomis_id'], 'BPR')
+        # last prison listed wins when ledger codes are shared
+        self.assertEqual(registry.by_ledger_code['067']['nomis_id'], 'NPR')
+        self.assertEqual(set(registry.private_estate), {'PR1', 'PR2'})
+        self.assertEqual(registry.private_estate_ledger_codes, {'10101000'})
+
+    @responses.activate
+    def test_loaded_once_per_ttl(self):
+        mock_list_prisons()
+        with mock.patch('bank_admin.prisons.time.time', return_value=1000):
+            first_registry = get_prison_registry(self.api_session)
+        with mock.patch('bank_admin.prisons.time.time', return_value=1059):
+            second_registry = get_prison_registry(self.api_session)
+        self.assertIs(first_registry, second_registry)
+        self.assertEqual(len(self.prison_requests()), 1)
+
+        with mock.patch('bank_admin.prisons.time.time', return_value=1060):
+            third_registry = get_prison_registry(self.api_session)
+        self.assertIsNot(first_registry, third_registry)
+        self.assertEqual(len(self.prison_requests()), 2)
+
+    @responses.activate
+    def test_refresh_forced(self):
+        mock_list_prisons()
+        get_prison_registry(self.api_session)
+        get_prison_registry(self.api_session, refresh=True)
+        self.assertEqual(len(self.prison_requests()), 2)
+
+    @responses.activate
+    def test_stale_copy_used_if_revalidation_fails(self):
+        mock_list_prisons()
+        with mock.patch('bank_admin.prisons.time.time', return_value=1000):
+            first_registry = get_prison_registry(self.api_session)
+
+        responses.replace(responses.GET, api_url('/prisons/'), body=requests.exceptions.ConnectionError())
+        with mock.patch('bank_admin.prisons.time.time', return_value=2000), \
+                mock.patch('bank_admin.prisons.logger') as mocked_logger:
+            second_registry = get_prison_registry(self.api_session)
+        self.assertIs(first_registry, second_registry)
+        mocked_logger.exception.assert_called_once()
+
+    @responses.activate
+    def test_error_raised_without_cached_copy(self):
+        responses.add(responses.GET, api_url('/prisons/'), body=requests.exceptions.ConnectionError())
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            get_prison_registry(self.api_session)
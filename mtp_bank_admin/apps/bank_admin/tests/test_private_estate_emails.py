@@ -1,7 +1,9 @@
 import datetime
 from datetime import timezone
+import shutil
 from unittest import mock
 
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import SimpleTestCase, override_settings
 from mtp_common.auth.api_client import MoJOAuth2Session
@@ -18,8 +20,15 @@ def mock_api_session(mocked_api_session):
     mocked_api_session.return_value = mock_session
 
 
-@override_settings(GOVUK_NOTIFY_REPLY_TO_STAFF='test-1234567-1234567', EMAILS_URL='http://localhost:8006')
+@override_settings(GOVUK_NOTIFY_REPLY_TO_STAFF='test-1234567-1234567', EMAILS_URL='http://localhost:8006',
+                   REQUEST_RETRY_BUDGET=0)
 class PrivateEstateEmailTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # prison list is cached across the process and reconciled days are remembered in the file cache
+        cache.clear()
+        shutil.rmtree('local_files/cache/', ignore_errors=True)
+
     @mock.patch('bank_admin.management.commands.send_private_estate_emails.api_client.get_authenticated_api_session')
     @mock.patch('bank_admin.management.commands.send_private_estate_emails.timezone')
     def test_not_scheduled_on_weekend_or_bank_holiday(self, mocked_timezone, mocked_api_session):
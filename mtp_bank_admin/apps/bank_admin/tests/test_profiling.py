@@ -0,0 +1,118 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.test.client import RequestFactory
+from mtp_common.auth.models import MojUser
+import responses
+
+from bank_admin import ADI_JOURNAL_LABEL, ACCESSPAY_LABEL
+from bank_admin.benchmarks import BenchmarkApiSession, build_sources
+from bank_admin.datasets import DailySnapshot
+from bank_admin.generation import generate_file
+from bank_admin.profiling import GenerationProfile, profile_file_generation, profile_stage, profiling_requested
+from .utils import mock_bank_holidays, BankAdminTestCase
+
+
+class ProfilingTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_path, ignore_errors=True)
+        settings_override = override_settings(FILE_GENERATION_PROFILE_PATH=self.profile_path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def prepare_snapshot(self, receipt_date):
+        mock_bank_holidays()
+        DailySnapshot(receipt_date).replace(build_sources(50, receipt_date))
+
+    def reports(self, label):
+        try:
+            filenames = sorted(os.listdir(os.path.join(self.profile_path, label)))
+        except FileNotFoundError:
+            return []
+        return [
+            open(os.path.join(self.profile_path, label, filename)).read()
+            for filename in filenames
+            if filename.endswith('.txt')
+        ]
+
+    @responses.activate
+    def test_generation_stages_reported(self):
+        self.prepare_snapshot(date(2016, 9, 13))
+
+        generate_file(BenchmarkApiSession(), ADI_JOURNAL_LABEL, date(2016, 9, 13), profile=True)
+
+        reports = self.reports(ADI_JOURNAL_LABEL)
+        self.assertEqual(len(reports), 1)
+        report = reports[0]
+        self.assertIn('Profile of ADI_JOURNAL file for 2016-09-13', report)
+        stage_names = [line.split('  ')[0] for line in report.splitlines()]
+        for stage in ('reconciliation', 'rows', 'render rows', 'save workbook'):
+            self.assertIn(stage, stage_names)
+        self.assertIn('Generating thread by cumulative time, including tracemalloc snapshots:', report)
+        self.assertEqual(len(os.listdir(os.path.join(self.profile_path, ADI_JOURNAL_LABEL))), 2)
+
+    @responses.activate
+    def test_not_profiled_unless_enabled(self):
+        self.prepare_snapshot(date(2016, 9, 13))
+
+        generate_file(BenchmarkApiSession(), ADI_JOURNAL_LABEL, date(2016, 9, 13))
+        self.assertEqual(self.reports(ADI_JOURNAL_LABEL), [])
+
+        with override_settings(PROFILE_FILE_GENERATION=True):
+            generate_file(BenchmarkApiSession(), ACCESSPAY_LABEL, date(2016, 9, 13))
+        self.assertEqual(len(self.reports(ACCESSPAY_LABEL)), 1)
+
+    def test_api_loading_and_failures_reported(self):
+        snapshot = DailySnapshot(date(2016, 9, 13))
+
+        with self.assertRaises(ValueError):
+            with profile_file_generation(ACCESSPAY_LABEL, date(2016, 9, 13), enabled=True) as profile:
+                snapshot.get('transactions:refundable', lambda: [{'id': 1}])
+                with profile_stage('rows'):
+                    raise ValueError
+
+        self.assertEqual(
+            [stage.name for stage in profile.stages], ['read snapshot', 'api: transactions:refundable', 'rows']
+        )
+        report = self.reports(ACCESSPAY_LABEL)[0]
+        self.assertIn('failed with ValueError', report)
+
+    def test_nothing_reported_without_stages(self):
+        with profile_file_generation(ACCESSPAY_LABEL, date(2016, 9, 13), enabled=True) as profile:
+            # nested profiles are ignored
+            self.assertNotIsInstance(
+                profile_file_generation(ACCESSPAY_LABEL, date(2016, 9, 13), enabled=True), GenerationProfile
+            )
+        self.assertIsNone(profile.report_path)
+        self.assertEqual(self.reports(ACCESSPAY_LABEL), [])
+
+    def test_profiling_requested_by_user_administrators(self):
+        def request(permissions, query_string=''):
+            request = RequestFactory().get('/?%s' % query_string)
+            request.user = MojUser(1, '', {'username': 'jsmith', 'permissions': permissions})
+            return request
+
+        self.assertTrue(profiling_requested(request(['auth.change_user'], 'profile')))
+        self.assertFalse(profiling_requested(request(['auth.change_user'])))
+        self.assertFalse(profiling_requested(request([], 'profile')))
+        with override_settings(PROFILE_FILE_GENERATION=True):
+            self.assertTrue(profiling_requested(request([])))
+
+    @responses.activate
+    @mock.patch('bank_admin.management.commands.api_client.get_authenticated_api_session')
+    def test_command_option(self, mocked_api_session):
+        mocked_api_session.return_value = BenchmarkApiSession()
+        self.prepare_snapshot(date(2016, 9, 13))
+
+        call_command('create_refund_file', date='2016-09-13', profile=True)
+
+        reports = self.reports(ACCESSPAY_LABEL)
+        self.assertEqual(len(reports), 1)
+        self.assertIn('rows', reports[0])
@@ -0,0 +1,62 @@
+from datetime import date
+
+from bank_admin import adi, adi_config, disbursements, disbursements_config
+from bank_admin.prisons import PrisonRegistry
+from .utils import TEST_BANK_ACCOUNT, TEST_PRISONS, BankAdminTestCase
+
+
+class JournalRowTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        credits = [
+            {'prison': 'BPR', 'amount': 1250, 'source': 'online', 'reconciliation_code': '1001'},
+            {'prison': 'BPR', 'amount': 500, 'source': 'bank_transfer', 'reconciliation_code': '900001'},
+        ]
+        rejected_transactions = [{
+            'amount': 300, 'ref_code': 900002, 'sender_name': 'John Smith',
+            'reference': 'A1234BC', 'sender_sort_code': '112233', 'sender_account_number': '12345678',
+            'sender_roll_number': None,
+        }]
+        self.adi_rows = adi.get_adi_journal_rows(
+            date(2016, 9, 13), credits, [], rejected_transactions, PrisonRegistry(TEST_PRISONS)
+        )
+        self.adi_fields = list(adi_config.ADI_JOURNAL_FIELDS)
+
+    def test_adi_rows_computed_without_workbook(self):
+        self.assertEqual(len(self.adi_rows), 5)
+        rows = [row.as_dict(self.adi_fields) for row in self.adi_rows]
+        self.assertEqual(
+            [(row['debit'], row['credit'], row['description']) for row in rows],
+            [
+                (12.5, None, '1001'),
+                (5.0, None, '900001'),
+                (None, 17.5, 'Big Prison MTP Total 13/09/2016'),
+                (3.0, None, '900002'),
+                (None, 3.0, '13/09/2016 - %s' % adi.get_full_narrative({
+                    'sender_name': 'John Smith', 'reference': 'A1234BC', 'sender_sort_code': '112233',
+                    'sender_account_number': '12345678', 'sender_roll_number': None,
+                })),
+            ]
+        )
+        self.assertEqual(rows[2]['cost_centre'], '048')
+
+    def test_bank_details_unset_for_cheques(self):
+        layout = disbursements.DisbursementRowLayout(disbursements_config.DISBURSEMENT_FIELDS)
+        fields = list(disbursements_config.DISBURSEMENT_FIELDS)
+        context = dict(
+            TEST_BANK_ACCOUNT, id=100, amount_pounds='12.50', recipient_first_name='Stan', recipient_last_name='White',
+            roll_number='', date='13/09/2016', invoice_number='PMD1000100', description='', prison_ledger_code='048',
+            creator='J Smith', confirmer='P Vance', address_line1='', address_line2='', city='', postcode='',
+            recipient_email='',
+        )
+
+        cheque = layout.disbursement_row(payment_method=disbursements.PAYMENT_METHODS['cheque'], **context)
+        self.assertEqual(set(fields) - set(cheque.as_dict(fields)), set(disbursements_config.BANK_DETAILS_FIELDS))
+
+        bank_transfer = layout.disbursement_row(
+            payment_method=disbursements.PAYMENT_METHODS['bank_transfer'], **context
+        ).as_dict(fields)
+        self.assertEqual(bank_transfer['sort_code'], TEST_BANK_ACCOUNT['sort_code'])
+        self.assertEqual(bank_transfer['account_name'], 'Stan White')
+        self.assertEqual(bank_transfer['total_amount'], '12.50')
+        self.assertEqual(len(layout.row_templates), 2)
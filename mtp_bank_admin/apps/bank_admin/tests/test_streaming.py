@@ -0,0 +1,127 @@
+from copy import copy
+from datetime import date
+import io
+from unittest import mock
+import zipfile
+
+from django.conf import settings
+from django.test import override_settings
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import IllegalCharacterError
+
+from bank_admin import adi, adi_config, disbursements, disbursements_config
+from bank_admin.prisons import PrisonRegistry
+from bank_admin.rendering import JournalRow
+from bank_admin.streaming import StreamingJournal
+from bank_admin.types import PaymentType
+from .utils import (
+    TEST_PRISONS, get_private_estate_batches, get_test_credits, get_test_disbursements,
+    get_test_transactions, BankAdminTestCase
+)
+
+
+class StreamingJournalTestCase(BankAdminTestCase):
+    def assertWorkbooksEquivalent(self, expected, actual, sheet_name, start_row):  # noqa: N802
+        expected = load_workbook(io.BytesIO(expected), keep_vba=True)
+        actual = load_workbook(io.BytesIO(actual), keep_vba=True)
+        self.assertEqual(actual.sheetnames, expected.sheetnames)
+        self.assertEqual(
+            {name: defined_name.attr_text for name, defined_name in actual.defined_names.items()},
+            {name: defined_name.attr_text for name, defined_name in expected.defined_names.items()},
+        )
+        self.assertIsNotNone(actual.vba_archive)
+
+        expected_ws, actual_ws = expected[sheet_name], actual[sheet_name]
+        self.assertEqual(actual_ws.max_row, expected_ws.max_row)
+        for expected_row, actual_row in zip(
+            expected_ws.iter_rows(min_row=start_row), actual_ws.iter_rows(min_row=start_row)
+        ):
+            for expected_cell, actual_cell in zip(expected_row, actual_row):
+                self.assertEqual(actual_cell.value, expected_cell.value, msg=actual_cell.coordinate)
+                self.assertEqual(actual_cell.number_format, expected_cell.number_format, msg=actual_cell.coordinate)
+                for attribute in ('font', 'fill', 'border', 'alignment', 'protection'):
+                    self.assertEqual(
+                        copy(getattr(actual_cell, attribute)), copy(getattr(expected_cell, attribute)),
+                        msg='%s %s' % (actual_cell.coordinate, attribute)
+                    )
+
+    def render_with_each_renderer(self, render):
+        with override_settings(STREAM_JOURNAL_WORKBOOKS=False):
+            expected = render()
+        with override_settings(STREAM_JOURNAL_WORKBOOKS=True):
+            actual = render()
+        return expected, actual
+
+    @mock.patch('bank_admin.adi.date')
+    def test_adi_journal_matches_openpyxl_rendering(self, mock_date):
+        mock_date.today.return_value = date(2016, 9, 14)
+        rows = adi.get_adi_journal_rows(
+            date(2016, 9, 13),
+            get_test_credits(40)['results'],
+            get_test_transactions(PaymentType.refund, 5)['results'],
+            get_test_transactions(PaymentType.reject, 5)['results'],
+            PrisonRegistry(TEST_PRISONS),
+        )
+
+        expected, actual = self.render_with_each_renderer(lambda: adi.render_adi_journal(rows, date(2016, 9, 13)))
+
+        self.assertWorkbooksEquivalent(expected, actual, '130916', adi_config.ADI_JOURNAL_START_ROW)
+        journal_ws = load_workbook(io.BytesIO(actual))['130916']
+        self.assertEqual(journal_ws[adi_config.ADI_BATCH_NAME_CELL].value, adi.get_batch_name())
+        self.assertEqual(journal_ws[adi_config.ADI_DATE_CELL].value, '14/09/16')
+        self.assertTrue(journal_ws['%s%d' % (
+            adi_config.ADI_JOURNAL_FIELDS['debit']['column'], adi_config.ADI_JOURNAL_START_ROW + len(rows)
+        )].value.startswith('=SUM('))
+
+    def test_disbursements_journal_matches_openpyxl_rendering(self):
+        rows = disbursements.get_disbursements_journal_rows(
+            date(2016, 9, 13),
+            get_private_estate_batches()['results'],
+            get_test_disbursements(20)['results'],
+            PrisonRegistry(TEST_PRISONS),
+        )
+
+        expected, actual = self.render_with_each_renderer(lambda: disbursements.render_disbursements_journal(rows))
+
+        self.assertWorkbooksEquivalent(
+            expected, actual,
+            disbursements_config.DISBURSEMENTS_JOURNAL_SHEET, disbursements_config.DISBURSEMENTS_JOURNAL_START_ROW
+        )
+
+    def test_template_parts_copied_unchanged(self):
+        journal = StreamingJournal(
+            settings.DISBURSEMENT_TEMPLATE_FILEPATH,
+            disbursements_config.DISBURSEMENTS_JOURNAL_SHEET,
+            disbursements_config.DISBURSEMENTS_JOURNAL_START_ROW,
+            disbursements_config.DISBURSEMENT_FIELDS,
+        )
+        journal.add_row(JournalRow(('value',) * len(disbursements_config.DISBURSEMENT_FIELDS)))
+
+        with zipfile.ZipFile(settings.DISBURSEMENT_TEMPLATE_FILEPATH) as template, \
+                zipfile.ZipFile(io.BytesIO(journal.create_file())) as package:
+            self.assertIsNone(package.testzip())
+            self.assertEqual(set(package.namelist()), set(template.namelist()))
+            self.assertEqual(package.read('xl/vbaProject.bin'), template.read('xl/vbaProject.bin'))
+            vba_project = package.getinfo('xl/vbaProject.bin')
+            template_vba_project = template.getinfo('xl/vbaProject.bin')
+            self.assertEqual(vba_project.compress_type, template_vba_project.compress_type)
+            self.assertEqual(vba_project.date_time, template_vba_project.date_time)
+
+    def test_strings_written_as_openpyxl_would(self):
+        journal = StreamingJournal(
+            settings.ADI_TEMPLATE_FILEPATH,
+            adi_config.ADI_JOURNAL_SHEET,
+            adi_config.ADI_JOURNAL_START_ROW,
+            adi_config.ADI_JOURNAL_FIELDS,
+        )
+        journal.set_field('description', ' <Smith & Sons> ')
+        journal.next_row()
+        journal.set_field('description', '=')
+        journal_ws = load_workbook(io.BytesIO(journal.create_file()))[adi_config.ADI_JOURNAL_SHEET]
+        column = adi_config.ADI_JOURNAL_FIELDS['description']['column']
+        self.assertEqual(journal_ws['%s%d' % (column, adi_config.ADI_JOURNAL_START_ROW)].value, ' <Smith & Sons> ')
+        self.assertEqual(journal_ws['%s%d' % (column, adi_config.ADI_JOURNAL_START_ROW + 1)].value, '=')
+
+        journal.set_field('description', 'Smith\x07')
+        with self.assertRaises(IllegalCharacterError):
+            journal.create_file()
@@ -1,15 +1,30 @@
 from datetime import date, datetime, timezone
+import copyreg
+import json
+import os
+import shutil
+import tempfile
+import threading
 from unittest import mock
 
+from django.conf import settings
+from django.test import override_settings
 from mtp_common.auth.api_client import get_api_session
 from mtp_common.auth.test_utils import generate_tokens
+from mtp_common.dates import WorkdayChecker
+from openpyxl import load_workbook
+from openpyxl.utils.indexed_list import IndexedList
 import requests
 import responses
 
+from bank_admin import adi_config
+from bank_admin.exceptions import EmptyFileError
 from bank_admin.utils import (
-    RECONCILE_MAX_ATTEMPTS, RECONCILE_RETRY_DELAY, WorkdayChecker, reconcile_for_date,
+    RECONCILE_MAX_ATTEMPTS, RECONCILE_RETRY_DELAY, Journal, TemplatePool,
+    get_cached_file_path, get_or_create_file, reconcile_for_date, retrieve_all_pages_concurrently,
+    run_concurrently,
 )
-from .utils import mock_bank_holidays, api_url, BankAdminTestCase
+from .utils import mock_bank_holidays, api_url, get_query_dict, BankAdminTestCase
 
 
 class ReconcileForDateTestCase(BankAdminTestCase):
@@ -115,6 +130,78 @@ class ReconcileForDateTestCase(BankAdminTestCase):
         self.assertEqual(len(reconcile_calls), RECONCILE_MAX_ATTEMPTS)
         self.assertEqual(mocked_sleep.call_count, RECONCILE_MAX_ATTEMPTS - 1)
 
+        # failed days are not remembered
+        responses.add(responses.POST, api_url('/transactions/reconcile/'), status=200)
+        reconcile_for_date(self.api_session, date(2016, 9, 15))
+        reconcile_calls = [c for c in responses.calls if 'transactions/reconcile/' in c.request.url]
+        self.assertEqual(len(reconcile_calls), RECONCILE_MAX_ATTEMPTS + 1)
+
+    @responses.activate
+    @override_settings(RECONCILE_CONCURRENCY=3)
+    def test_weekend_days_reconciled_concurrently(self):
+        mock_bank_holidays()
+        all_days_in_flight = threading.Barrier(3, timeout=5)
+
+        def reconcile_callback(request):
+            all_days_in_flight.wait()
+            return 200, {}, ''
+
+        responses.add_callback(responses.POST, api_url('/transactions/reconcile/'), callback=reconcile_callback)
+
+        start_date, end_date = reconcile_for_date(self.api_session, date(2016, 10, 7))
+
+        self.assertEqual(len(responses.calls), 4)  # includes bank holidays
+        self.assertEqual(start_date, datetime(2016, 10, 7, 0, 0, tzinfo=timezone.utc))
+        self.assertEqual(end_date, datetime(2016, 10, 10, 0, 0, tzinfo=timezone.utc))
+
+    @responses.activate
+    @mock.patch('bank_admin.utils.logger')
+    def test_failed_days_reported_together(self, mocked_logger):
+        mock_bank_holidays()
+
+        def reconcile_callback(request):
+            if json.loads(request.body)['received_at__gte'].startswith('2016-10-08'):
+                return 200, {}, ''
+            return 500, {}, ''
+
+        responses.add_callback(responses.POST, api_url('/transactions/reconcile/'), callback=reconcile_callback)
+
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            reconcile_for_date(self.api_session, date(2016, 10, 7))
+        mocked_logger.error.assert_called_once()
+        self.assertIn('2016-10-09', context.exception.__notes__[0])
+
+        # the successful day is not reconciled again
+        responses.calls.reset()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            reconcile_for_date(self.api_session, date(2016, 10, 7))
+        reconcile_calls = [c for c in responses.calls if 'transactions/reconcile/' in c.request.url]
+        self.assertEqual(len(reconcile_calls), 2)
+
+    @responses.activate
+    def test_reconciled_days_remembered(self):
+        mock_bank_holidays()
+        responses.add(responses.POST, api_url('/transactions/reconcile/'), status=200)
+
+        reconcile_for_date(self.api_session, date(2016, 10, 7))
+        # Monday's window does not overlap, Friday's is already reconciled
+        reconcile_for_date(self.api_session, date(2016, 10, 10))
+        reconcile_for_date(self.api_session, date(2016, 10, 7))
+
+        reconcile_calls = [c for c in responses.calls if 'transactions/reconcile/' in c.request.url]
+        self.assertEqual(len(reconcile_calls), 4)
+
+    @responses.activate
+    def test_forced_reconcile_posts_again(self):
+        mock_bank_holidays()
+        responses.add(responses.POST, api_url('/transactions/reconcile/'), status=200)
+
+        reconcile_for_date(self.api_session, date(2016, 9, 15))
+        reconcile_for_date(self.api_session, date(2016, 9, 15), force=True)
+
+        reconcile_calls = [c for c in responses.calls if 'transactions/reconcile/' in c.request.url]
+        self.assertEqual(len(reconcile_calls), 2)
+
 
 class WorkdayCheckerTestCase(BankAdminTestCase):
     @classmethod
@@ -163,3 +250,236 @@ class WorkdayCheckerTestCase(BankAdminTestCase):
         with responses.RequestsMock() as rsps:
             previous_day = self.make_checker(rsps).get_previous_workday(date(2016, 12, 28))
         self.assertEqual(previous_day, date(2016, 12, 23))
+
+
+class TemplatePoolTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.template_dir = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.template_dir, 'template.xlsm')
+        shutil.copy(settings.ADI_TEMPLATE_FILEPATH, self.template_path)
+        self.pool = TemplatePool()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_template_parsed_once(self):
+        with mock.patch('bank_admin.utils.load_workbook', wraps=load_workbook) as mocked_load_workbook:
+            wb1 = self.pool.load_workbook(self.template_path)
+            wb2 = self.pool.load_workbook(self.template_path)
+        self.assertEqual(mocked_load_workbook.call_count, 1)
+        self.assertEqual(wb1.sheetnames, wb2.sheetnames)
+        self.assertIsNotNone(wb1.vba_archive)
+
+    def test_copies_are_isolated(self):
+        wb1 = self.pool.load_workbook(self.template_path)
+        wb1['WebADI']['B30'] = 'changed'
+        wb1['WebADI'].title = 'renamed'
+        wb2 = self.pool.load_workbook(self.template_path)
+        self.assertIn('WebADI', wb2.sheetnames)
+        self.assertIsNone(wb2['WebADI']['B30'].value)
+
+    def test_styles_survive_copying_without_global_pickling_changes(self):
+        template_wb = load_workbook(self.template_path, keep_vba=True)
+        wb = self.pool.load_workbook(self.template_path)
+        self.assertEqual(len(wb._cell_styles), len(template_wb._cell_styles))
+        self.assertEqual(wb._fonts.index(template_wb._fonts[1]), 1)
+        self.assertNotIn(IndexedList, copyreg.dispatch_table)
+
+    def test_touched_template_not_reparsed(self):
+        self.pool.load_workbook(self.template_path)
+        stat = os.stat(self.template_path)
+        os.utime(self.template_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with mock.patch('bank_admin.utils.load_workbook', wraps=load_workbook) as mocked_load_workbook:
+            self.pool.load_workbook(self.template_path)
+        mocked_load_workbook.assert_not_called()
+
+    def test_changed_template_reparsed(self):
+        self.pool.load_workbook(self.template_path)
+        shutil.copy(settings.DISBURSEMENT_TEMPLATE_FILEPATH, self.template_path)
+        stat = os.stat(self.template_path)
+        os.utime(self.template_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        wb = self.pool.load_workbook(self.template_path)
+        self.assertIn('Data', wb.sheetnames)
+
+
+class JournalStyleTestCase(BankAdminTestCase):
+    def make_journal(self):
+        return Journal(
+            settings.ADI_TEMPLATE_FILEPATH,
+            adi_config.ADI_JOURNAL_SHEET,
+            adi_config.ADI_JOURNAL_START_ROW,
+            adi_config.ADI_JOURNAL_FIELDS,
+        )
+
+    def test_field_style_applied(self):
+        journal = self.make_journal()
+        cell = journal.set_field('upload', 'O')
+        self.assertEqual(cell.font.name, 'Wingdings')
+        self.assertEqual(cell.border.left.color.rgb, '00C7C7C7')
+        self.assertIsNone(cell.fill.fill_type)
+
+    def test_extra_style_merged(self):
+        journal = self.make_journal()
+        cell = journal.set_field('upload', 'Totals:', extra_style=dict(
+            adi_config.ADI_FINAL_ROW_STYLE,
+            font={'name': 'Arial', 'bold': True},
+        ))
+        self.assertEqual(cell.font.name, 'Arial')
+        self.assertTrue(cell.font.bold)
+        self.assertEqual(cell.fill.fill_type, 'solid')
+        self.assertEqual(cell.border.top.color.rgb, '00C7C7C7')
+        # left border comes from the field's own style
+        self.assertEqual(cell.border.left.color.rgb, '00C7C7C7')
+
+    def test_rows_share_styles(self):
+        journal = self.make_journal()
+        journal.next_row()
+        first_cell = journal.set_field('description', 'first')
+        journal.next_row()
+        second_cell = journal.set_field('description', 'second')
+        self.assertEqual(first_cell.style_id, second_cell.style_id)
+        self.assertIsNot(first_cell._style, second_cell._style)
+        self.assertIs(
+            Journal.compile_style(adi_config.ADI_FINAL_ROW_STYLE),
+            Journal.compile_style(dict(adi_config.ADI_FINAL_ROW_STYLE)),
+        )
+
+
+class GetOrCreateFileTestCase(BankAdminTestCase):
+    def test_streamed_file_written_to_cache(self):
+        def create_file(output):
+            journal = Journal(
+                settings.ADI_TEMPLATE_FILEPATH,
+                adi_config.ADI_JOURNAL_SHEET,
+                adi_config.ADI_JOURNAL_START_ROW,
+                adi_config.ADI_JOURNAL_FIELDS,
+            )
+            journal.set_field('description', 'streamed')
+            journal.create_file(output)
+
+        filepath = get_or_create_file('TEST', date(2016, 9, 13), create_file, file_extension='xlsm', stream=True)
+
+        self.assertEqual(filepath, get_cached_file_path('TEST', date(2016, 9, 13), extension='xlsm'))
+        wb = load_workbook(filepath)
+        cell = '%s%s' % (adi_config.ADI_JOURNAL_FIELDS['description']['column'], adi_config.ADI_JOURNAL_START_ROW)
+        self.assertEqual(wb[adi_config.ADI_JOURNAL_SHEET][cell].value, 'streamed')
+
+    def test_failed_stream_leaves_no_cached_file(self):
+        def create_file(output):
+            output.write(b'partial')
+            raise EmptyFileError
+
+        with self.assertRaises(EmptyFileError):
+            get_or_create_file('TEST', date(2016, 9, 13), create_file, stream=True)
+        self.assertFalse(os.path.exists(get_cached_file_path('TEST', date(2016, 9, 13))))
+
+    def test_failed_generation_leaves_no_temporary_files(self):
+        def create_file():
+            raise EmptyFileError
+
+        with self.assertRaises(EmptyFileError):
+            get_or_create_file('TEST', date(2016, 9, 13), create_file)
+        dirname = os.path.dirname(get_cached_file_path('TEST', date(2016, 9, 13)))
+        self.assertFalse([name for name in os.listdir(dirname) if name.endswith('.tmp')])
+
+    def test_concurrent_callers_share_one_generation(self):
+        started = threading.Event()
+        release = threading.Event()
+        create_file = mock.Mock()
+
+        def slow_create_file():
+            create_file()
+            started.set()
+            release.wait(5)
+            return 'generated'
+
+        results = []
+
+        def get_file():
+            results.append(get_or_create_file('TEST', date(2016, 9, 13), slow_create_file))
+
+        threads = [threading.Thread(target=get_file) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # waiting callers must not see a partially written file
+        self.assertFalse(os.path.exists(get_cached_file_path('TEST', date(2016, 9, 13))))
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        create_file.assert_called_once()
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(results), 3)
+        with open(results[0]) as f:
+            self.assertEqual(f.read(), 'generated')
+
+
+@override_settings(REQUEST_PAGE_SIZE=10, REQUEST_PAGE_CONCURRENCY=3)
+class RetrieveAllPagesConcurrentlyTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api_session = get_api_session(mock.MagicMock(
+            user=mock.MagicMock(
+                token=generate_tokens()
+            )
+        ))
+
+    def mock_pages(self, count, page_size=10):
+        def page_callback(request):
+            query = get_query_dict(request.url)
+            offset = int(query['offset'])
+            limit = min(int(query['limit']), page_size)
+            results = [{'id': i} for i in range(offset, min(offset + limit, count))]
+            return 200, {}, json.dumps({'count': count, 'results': results})
+
+        responses.add_callback(responses.GET, api_url('/credits/'), callback=page_callback)
+
+    @responses.activate
+    def test_single_page(self):
+        self.mock_pages(5)
+        results = retrieve_all_pages_concurrently(self.api_session, 'credits/')
+        self.assertEqual(results, [{'id': i} for i in range(5)])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_pages_loaded_in_order(self):
+        self.mock_pages(95)
+        results = retrieve_all_pages_concurrently(self.api_session, 'credits/', status='refundable')
+        self.assertEqual(results, [{'id': i} for i in range(95)])
+        self.assertEqual(len(responses.calls), 10)
+        offsets = sorted(int(get_query_dict(call.request.url)['offset']) for call in responses.calls)
+        self.assertEqual(offsets, list(range(0, 95, 10)))
+        self.assertTrue(all(
+            get_query_dict(call.request.url)['status'] == 'refundable'
+            for call in responses.calls
+        ))
+
+    @responses.activate
+    def test_capped_page_size(self):
+        self.mock_pages(25, page_size=4)
+        results = retrieve_all_pages_concurrently(self.api_session, 'credits/')
+        self.assertEqual(results, [{'id': i} for i in range(25)])
+        self.assertEqual(len(responses.calls), 7)
+
+
+class RunConcurrentlyTestCase(BankAdminTestCase):
+    def test_calls_overlap_and_results_ordered(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def call(value):
+            barrier.wait()
+            return value
+
+        results = run_concurrently(*(lambda value=value: call(value) for value in range(3)))
+        self.assertEqual(results, [0, 1, 2])
+
+    def test_errors_propagated(self):
+        def fail():
+            raise EmptyFileError
+
+        with self.assertRaises(EmptyFileError):
+            run_concurrently(lambda: 1, fail)
@@ -1,21 +1,28 @@
 from datetime import date, datetime, timedelta, timezone
+import io
+import json
 import logging
+import os
 from unittest import mock
 from urllib.parse import quote_plus
 
 from django.conf import settings
-from django.test import override_settings
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
 from django.urls import reverse
 from django.utils.encoding import escape_uri_path
+from django.utils.http import http_date
 from django.utils.translation import gettext_lazy as _
+from mtp_common.auth.api_client import MoJOAuth2Session
 from mtp_common.auth.exceptions import Forbidden
 from mtp_common.auth.test_utils import generate_tokens
+from mtp_common.spooling import spooler
 from mtp_common.test_utils import silence_logger
 import responses
 
 from .utils import (
     get_test_transactions, get_test_credits, NO_TRANSACTIONS,
-    mock_balance, api_url, mock_bank_holidays, mock_list_prisons,
+    mock_balance, api_url, get_query_dict, mock_bank_holidays, mock_list_prisons,
     BankAdminTestCase, get_test_disbursements
 )
 from .test_refund import REFUND_TRANSACTIONS, expected_output
@@ -23,8 +30,10 @@ from .test_statement import mock_test_transactions
 from bank_admin import (
     ADI_JOURNAL_LABEL, ACCESSPAY_LABEL, MT940_STMT_LABEL, DISBURSEMENTS_LABEL
 )
+from bank_admin.decorators import conditional_file_download
 from bank_admin.types import PaymentType
-from bank_admin.utils import set_worldpay_cutoff
+from bank_admin.utils import get_cached_file_path, get_file_validators, set_worldpay_cutoff
+from bank_admin.views import file_download_response, record_download
 
 
 def mock_missing_download_check():
@@ -184,6 +193,71 @@ class DashboardButtonVisibilityTestCase(BankAdminViewTestCase):
         self.assertNotContains(response, reverse('bank_admin:download_refund_file'))
 
 
+class DashboardMissingDownloadsTestCase(BankAdminViewTestCase):
+    @mock.patch('mtp_common.auth.backends.api_client')
+    def login(self, mock_api_client):
+        mock_api_client.authenticate.return_value = {
+            'pk': 5,
+            'token': generate_tokens(),
+            'user_data': {
+                'first_name': 'Sam',
+                'last_name': 'Hall',
+                'username': 'shall',
+                'permissions': [
+                    'transaction.view_bank_details_transaction', 'credit.view_any_credit',
+                    'transaction.view_transaction', 'disbursement.view_disbursement',
+                ]
+            }
+        }
+        self.client.post(reverse('login'), data={'username': 'shall', 'password': 'pass'})
+
+    def missing_download_requests(self):
+        return [
+            get_query_dict(call.request.url)
+            for call in responses.calls
+            if '/file-downloads/missing/' in call.request.url
+        ]
+
+    @responses.activate
+    def test_missing_downloads_loaded_once_per_label(self):
+        self.login()
+        mock_bank_holidays()
+        responses.add(
+            responses.GET, api_url('/file-downloads/missing/'),
+            json={'missing_dates': ['2014-12-11']}
+        )
+
+        response = self.client.get(reverse('bank_admin:dashboard'))
+        self.assertEqual(response.context['missed_adi_journals'], [date(2014, 12, 11)])
+        self.assertEqual(response.context['missed_disbursements'], [date(2014, 12, 11)])
+        self.assertEqual(
+            sorted(query['label'] for query in self.missing_download_requests()),
+            sorted([ACCESSPAY_LABEL, ADI_JOURNAL_LABEL, MT940_STMT_LABEL, DISBURSEMENTS_LABEL])
+        )
+        self.assertEqual(len(self.missing_download_requests()[0]['date']), 20)
+
+        response = self.client.get(reverse('bank_admin:dashboard'))
+        self.assertEqual(response.context['missed_statements'], [date(2014, 12, 11)])
+        self.assertEqual(len(self.missing_download_requests()), 4)
+
+    @responses.activate
+    def test_missing_downloads_reloaded_after_download(self):
+        self.login()
+        mock_bank_holidays()
+        responses.add(
+            responses.GET, api_url('/file-downloads/missing/'),
+            json={'missing_dates': ['2014-12-11']}
+        )
+
+        self.client.get(reverse('bank_admin:dashboard'))
+        api_session = mock.MagicMock()
+        record_download(api_session, ADI_JOURNAL_LABEL, date(2014, 12, 11))
+        api_session.post.assert_called_once()
+        self.client.get(reverse('bank_admin:dashboard'))
+
+        self.assertEqual(len(self.missing_download_requests()), 8)
+
+
 class DownloadRefundFileViewTestCase(BankAdminViewTestCase):
 
     def _set_returned_refunds(self):
@@ -230,7 +304,7 @@ class DownloadRefundFileViewTestCase(BankAdminViewTestCase):
         self.assertEqual('text/plain', response['Content-Type'])
         self.assertEqual(
             expected_output().encode('utf8'),
-            response.content
+            b''.join(response.streaming_content)
         )
 
     @responses.activate
@@ -865,3 +939,324 @@ class DownloadDisbursementsFileErrorViewTestCase(BankAdminViewTestCase):
         self.assertContains(response,
                             _("'receipt_date' parameter required"),
                             status_code=400)
+
+
+@mock.patch.object(spooler, 'installed', True)
+class BackgroundFileGenerationViewTestCase(BankAdminViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.download_url = reverse('bank_admin:download_bank_statement') + '?receipt_date=2014-12-11'
+        self.status_url = self.get_status_url(MT940_STMT_LABEL)
+        self.scheduled_tasks = []
+        schedule_mock = mock.patch.object(
+            spooler, 'schedule',
+            side_effect=lambda task, args, kwargs: self.scheduled_tasks.append((task, args, kwargs))
+        )
+        schedule_mock.start()
+        self.addCleanup(schedule_mock.stop)
+
+    def get_status_url(self, label):
+        return reverse('bank_admin:file_generation_status') + '?label=%s&receipt_date=2014-12-11' % label
+
+    def run_scheduled_tasks(self):
+        api_session = MoJOAuth2Session()
+        api_session.token = generate_tokens()
+        with mock.patch('bank_admin.tasks.api_client.get_authenticated_api_session', return_value=api_session):
+            for task, args, kwargs in self.scheduled_tasks:
+                task.func(*args, **kwargs)
+        self.scheduled_tasks = []
+
+    def mock_bank_statement(self):
+        responses.add(responses.POST, api_url('/transactions/reconcile/'), status=200)
+        mock_test_transactions()
+        mock_balance()
+        responses.add(responses.POST, api_url('/file-downloads/'), status=200)
+        mock_bank_holidays()
+
+    @responses.activate
+    def test_file_generated_in_background(self):
+        self.login()
+        self.mock_bank_statement()
+
+        response = self.client.get(self.download_url)
+        self.assertRedirects(response, self.status_url, fetch_redirect_response=False)
+        self.assertEqual(len(self.scheduled_tasks), 1)
+        self.assertEqual(self.scheduled_tasks[0][1], (MT940_STMT_LABEL, date(2014, 12, 11)))
+        self.assertFalse([call for call in responses.calls if '/transactions/' in call.request.url])
+
+        # pending generation is not scheduled again
+        response = self.client.get(self.download_url)
+        self.assertRedirects(response, self.status_url, fetch_redirect_response=False)
+        self.assertEqual(len(self.scheduled_tasks), 1)
+
+        response = self.client.get(self.status_url)
+        self.assertContains(response, _('Your file is being prepared'))
+        self.assertEqual(response['Refresh'], str(settings.FILE_GENERATION_POLL_INTERVAL))
+        response = self.client.get(self.status_url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['status'], 'pending')
+
+        self.run_scheduled_tasks()
+
+        response = self.client.get(self.status_url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), {
+            'status': 'ready', 'message': None, 'download_url': self.download_url,
+        })
+        response = self.client.get(self.status_url)
+        self.assertRedirects(response, self.download_url, fetch_redirect_response=False)
+        response = self.client.get(self.download_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertFalse(self.scheduled_tasks)
+
+    @responses.activate
+    def test_failed_generation_reported(self):
+        self.login()
+        mock_bank_holidays()
+        responses.add(responses.POST, api_url('/transactions/reconcile/'), status=200)
+        responses.add(responses.GET, api_url('/transactions/'), json=NO_TRANSACTIONS)
+        responses.add(responses.GET, api_url('/balances/'), json={'count': 0, 'results': []})
+
+        response = self.client.get(reverse('bank_admin:download_adi_journal') + '?receipt_date=2014-12-11')
+        status_url = self.get_status_url(ADI_JOURNAL_LABEL)
+        self.assertRedirects(response, status_url, fetch_redirect_response=False)
+        responses.add(responses.GET, api_url('/credits/'), json=NO_TRANSACTIONS)
+        mock_list_prisons()
+        self.run_scheduled_tasks()
+
+        response = self.client.get(status_url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['status'], 'failed')
+        self.assertEqual(response.json()['message'], _('No transactions available'))
+
+        responses.add(responses.POST, api_url('/file-downloads/'), status=200)
+        mock_missing_download_check()
+        response = self.client.get(status_url, follow=True)
+        self.assertRedirects(response, reverse('bank_admin:dashboard'))
+        self.assertContains(response, _('No transactions available'))
+        # empty file is recorded as downloaded so it is not listed as missed
+        download_calls = [call for call in responses.calls if call.request.url == api_url('/file-downloads/')]
+        self.assertEqual(len(download_calls), 1)
+        self.assertEqual(
+            json.loads(download_calls[0].request.body),
+            {'label': ADI_JOURNAL_LABEL, 'date': '2014-12-11'},
+        )
+        # failure is only reported once and downloading again restarts generation
+        response = self.client.get(status_url)
+        self.assertRedirects(
+            response, reverse('bank_admin:download_adi_journal') + '?receipt_date=2014-12-11',
+            fetch_redirect_response=False,
+        )
+
+    def test_unknown_label(self):
+        self.login()
+        response = self.client.get(self.get_status_url('UNKNOWN'))
+        self.assertEqual(response.status_code, 400)
+
+
+class FileDownloadResponseTestCase(BankAdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filepath = get_cached_file_path(MT940_STMT_LABEL, date(2014, 12, 11))
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        with open(self.filepath, 'wb') as f:
+            f.write(b'0123456789')
+
+    def get_response(self, file_validators=None, **headers):
+        request = RequestFactory().get('/', headers=headers)
+        if file_validators:
+            request.file_validators = file_validators
+        return file_download_response(request, open(self.filepath, 'rb'), 'statement.txt', 'text/plain')
+
+    def test_whole_file_streamed(self):
+        response = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="statement.txt"')
+
+    def test_byte_ranges(self):
+        for range_header, content_range, content in [
+            ('bytes=2-5', 'bytes 2-5/10', b'2345'),
+            ('bytes=7-', 'bytes 7-9/10', b'789'),
+            ('bytes=-3', 'bytes 7-9/10', b'789'),
+            ('bytes=8-20', 'bytes 8-9/10', b'89'),
+        ]:
+            response = self.get_response(Range=range_header)
+            self.assertEqual(response.status_code, 206, range_header)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content)
+            response.close()
+
+    def test_unsupported_ranges_ignored(self):
+        for range_header in ['bytes=0-1,4-5', 'lines=1-2', 'bytes=-']:
+            response = self.get_response(Range=range_header)
+            self.assertEqual(response.status_code, 200, range_header)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_ranges_only_sent_if_unchanged(self):
+        etag, last_modified = get_file_validators(self.filepath)
+        for if_range in [etag, http_date(last_modified)]:
+            response = self.get_response(file_validators=(etag, last_modified), Range='bytes=7-', If_Range=if_range)
+            self.assertEqual(response.status_code, 206, if_range)
+            self.assertEqual(b''.join(response.streaming_content), b'789')
+
+        for file_validators, if_range in [
+            # file has been regenerated
+            ((etag, last_modified), '"0123"'),
+            ((etag, last_modified), http_date(last_modified - 60)),
+            ((etag, last_modified), 'W/%s' % etag),
+            # file was generated by this request
+            (None, etag),
+            # personalised files cannot be resumed
+            (('W/%s' % etag, last_modified), 'W/%s' % etag),
+            (('W/%s' % etag, last_modified), http_date(last_modified)),
+        ]:
+            response = self.get_response(file_validators=file_validators, Range='bytes=7-', If_Range=if_range)
+            self.assertEqual(response.status_code, 200, if_range)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_unsatisfiable_range(self):
+        response = self.get_response(Range='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    @override_settings(FILE_DOWNLOAD_OFFLOAD_HEADER='X-Accel-Redirect',
+                       FILE_DOWNLOAD_OFFLOAD_PREFIX='/protected-files/')
+    def test_offloaded_to_web_server(self):
+        response = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-files/%s/20141211' % MT940_STMT_LABEL)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="statement.txt"')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(FILE_DOWNLOAD_OFFLOAD_HEADER='X-Sendfile')
+    def test_offloaded_with_absolute_path(self):
+        response = self.get_response()
+        self.assertEqual(response['X-Sendfile'], os.path.abspath(self.filepath))
+
+    @override_settings(FILE_DOWNLOAD_OFFLOAD_HEADER='X-Sendfile')
+    def test_generated_content_not_offloaded(self):
+        request = RequestFactory().get('/')
+        response = file_download_response(request, io.BytesIO(b'journal'), 'adi.xlsm', 'text/plain')
+        self.assertNotIn('X-Sendfile', response)
+        self.assertEqual(b''.join(response.streaming_content), b'journal')
+
+
+class ConditionalDownloadTestCase(BankAdminViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.download_url = reverse('bank_admin:download_bank_statement') + '?receipt_date=2014-12-11'
+
+    def download_bank_statement(self):
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/transactions/reconcile/'), status=200)
+            rsps.add(rsps.GET, api_url('/transactions/'), json=get_test_transactions())
+            rsps.add(rsps.GET, api_url('/balances/'), json={'count': 0, 'results': []})
+            rsps.add(rsps.POST, api_url('/file-downloads/'), status=200)
+            rsps.add(
+                rsps.GET, 'https://www.gov.uk/bank-holidays.json',
+                json={'england-and-wales': {'division': 'england-and-wales', 'events': []}},
+            )
+            response = self.client.get(self.download_url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_unchanged_file_not_downloaded_again(self):
+        self.login()
+        response = self.download_bank_statement()
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        self.assertTrue(etag)
+        self.assertTrue(last_modified)
+
+        # only recording the download touches the api
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/file-downloads/'), status=200)
+            response = self.client.get(self.download_url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            response = self.client.get(self.download_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(len(rsps.calls), 2)
+
+    def test_side_effects_performed_when_not_modified(self):
+        filepath = get_cached_file_path(DISBURSEMENTS_LABEL, date(2014, 12, 11), extension='xlsm')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(b'journal')
+        etag, _ = get_file_validators(filepath)
+        on_not_modified = mock.Mock()
+        view = conditional_file_download(DISBURSEMENTS_LABEL, on_not_modified)(mock.Mock())
+
+        request = RequestFactory().get('/', headers={'If-None-Match': etag})
+        response = view(request, date(2014, 12, 11))
+
+        self.assertEqual(response.status_code, 304)
+        on_not_modified.assert_called_once_with(request, date(2014, 12, 11))
+
+    def test_personalised_download_not_validated_by_modification_time(self):
+        filepath = get_cached_file_path(ADI_JOURNAL_LABEL, date(2014, 12, 11), extension='xlsm')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(b'journal')
+        _, last_modified = get_file_validators(filepath)
+        on_not_modified = mock.Mock()
+        view = conditional_file_download(ADI_JOURNAL_LABEL, on_not_modified, variant=lambda user: 'AB')(
+            lambda request, receipt_date: HttpResponse(b'personalised journal')
+        )
+
+        request = RequestFactory().get('/', headers={'If-Modified-Since': http_date(last_modified)})
+        request.user = mock.Mock()
+        response = view(request, date(2014, 12, 11))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertNotIn('Last-Modified', response)
+        on_not_modified.assert_not_called()
+
+    def test_regenerated_file_has_new_etag(self):
+        self.login()
+        etag = self.download_bank_statement()['ETag']
+
+        filepath = get_cached_file_path(MT940_STMT_LABEL, date(2014, 12, 11))
+        with open(filepath, 'ab') as f:
+            f.write(b'\n')
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/file-downloads/'), status=200)
+            response = self.client.get(self.download_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_download_resumed_if_unchanged(self):
+        self.login()
+        response = self.download_bank_statement()
+        content = b''.join(response.streaming_content)
+        etag = response['ETag']
+
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.POST, api_url('/file-downloads/'), status=200)
+            response = self.client.get(self.download_url, HTTP_RANGE='bytes=5-', HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content[5:])
+
+            filepath = get_cached_file_path(MT940_STMT_LABEL, date(2014, 12, 11))
+            with open(filepath, 'ab') as f:
+                f.write(b'\n')
+            response = self.client.get(self.download_url, HTTP_RANGE='bytes=5-', HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), content + b'\n')
+
+    def test_personalised_etag_is_weak(self):
+        filepath = get_cached_file_path(ADI_JOURNAL_LABEL, date(2014, 12, 11), extension='xlsm')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(b'journal')
+
+        etag, _ = get_file_validators(filepath)
+        personalised_etag, _ = get_file_validators(filepath, variant='AB')
+        self.assertFalse(etag.startswith('W/'))
+        self.assertTrue(personalised_etag.startswith('W/'))
+        self.assertNotEqual(get_file_validators(filepath, variant='CD')[0], personalised_etag)
+        self.assertEqual(get_file_validators(filepath + '.missing'), (None, None))
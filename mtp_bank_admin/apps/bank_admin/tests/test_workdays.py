@@ -0,0 +1,70 @@
+from datetime import date, datetime, timedelta, timezone
+from unittest import mock
+
+from django.core.cache import cache
+from mtp_common.dates import WorkdayChecker
+import responses
+
+from bank_admin.utils import get_preceding_workday_list
+from bank_admin.workdays import HOLIDAY_CACHE_KEY, WorkdayCalendar, get_workday_calendar
+from .utils import TEST_HOLIDAYS, mock_bank_holidays, BankAdminTestCase
+
+
+class WorkdayCalendarTestCase(BankAdminTestCase):
+    @responses.activate
+    def test_matches_workday_checker(self):
+        mock_bank_holidays()
+        checker = WorkdayChecker()
+        calendar = get_workday_calendar()
+
+        day = date(2016, 11, 1)
+        while day < date(2017, 2, 1):
+            self.assertEqual(calendar.is_workday(day), checker.is_workday(day), day)
+            self.assertEqual(calendar.get_next_workday(day), checker.get_next_workday(day), day)
+            self.assertEqual(calendar.get_previous_workday(day), checker.get_previous_workday(day), day)
+            day += timedelta(days=1)
+
+    def test_preceding_workdays(self):
+        calendar = WorkdayCalendar([date(2016, 12, 26), date(2016, 12, 27)])
+        self.assertEqual(calendar.get_preceding_workdays(date(2016, 12, 28), 4), [
+            date(2016, 12, 28), date(2016, 12, 23), date(2016, 12, 22), date(2016, 12, 21),
+        ])
+        self.assertEqual(calendar.get_preceding_workdays(date(2016, 12, 27), 2, offset=1), [
+            date(2016, 12, 22), date(2016, 12, 21),
+        ])
+
+    def test_index_extended_for_distant_dates(self):
+        calendar = WorkdayCalendar([date(2016, 12, 26)])
+        self.assertEqual(calendar.get_next_workday(date(2060, 1, 2)), date(2060, 1, 5))
+        self.assertEqual(calendar.get_previous_workday(date(1990, 1, 1)), date(1989, 12, 29))
+        self.assertEqual(len(calendar.get_preceding_workdays(date(1990, 1, 1), 500)), 500)
+
+    @responses.activate
+    @mock.patch('bank_admin.utils.now', return_value=datetime(2016, 12, 29, 12, tzinfo=timezone.utc))
+    def test_preceding_workday_list(self, _):
+        mock_bank_holidays()
+        self.assertEqual(get_preceding_workday_list(3, offset=1), [
+            date(2016, 12, 28), date(2016, 12, 23), date(2016, 12, 22),
+        ])
+
+    @responses.activate
+    def test_shared_until_holidays_change(self):
+        mock_bank_holidays()
+        calendar = get_workday_calendar()
+        self.assertIs(get_workday_calendar(), calendar)
+        self.assertEqual(len(responses.calls), 1)
+
+        # downloaded again with the same holidays
+        cache.delete(HOLIDAY_CACHE_KEY)
+        self.assertIs(get_workday_calendar(), calendar)
+        self.assertEqual(len(responses.calls), 2)
+
+        holidays = {'england-and-wales': dict(TEST_HOLIDAYS['england-and-wales'], events=[
+            {'title': 'New Year’s Day', 'date': '2017-01-02', 'notes': 'Substitute day', 'bunting': True},
+        ])}
+        responses.replace(responses.GET, 'https://www.gov.uk/bank-holidays.json', json=holidays)
+        cache.delete(HOLIDAY_CACHE_KEY)
+        new_calendar = get_workday_calendar()
+        self.assertIsNot(new_calendar, calendar)
+        self.assertTrue(new_calendar.is_workday(date(2016, 12, 27)))
+        self.assertFalse(new_calendar.is_workday(date(2017, 1, 2)))
@@ -6,22 +6,16 @@ import tempfile
 from urllib.parse import urljoin, urlparse, parse_qsl
 
 from django.conf import settings
-from django.test import SimpleTestCase
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
 from govuk_bank_holidays.bank_holidays import BankHolidays
 import responses
 
+from bank_admin import fixtures
 from bank_admin.types import PaymentType
+from bank_admin.workdays import HOLIDAY_CACHE_KEY
 
-TEST_PRISONS = [
-    {'nomis_id': 'BPR', 'general_ledger_code': '048', 'name': 'Big Prison', 'private_estate': False},
-    {'nomis_id': 'MPR', 'general_ledger_code': '067', 'name': 'Medium Prison', 'private_estate': False},
-    {'nomis_id': 'SPR', 'general_ledger_code': '054', 'name': 'Small Prison', 'private_estate': False},
-    {'nomis_id': 'NPR', 'general_ledger_code': '067', 'name': 'New Prison', 'private_estate': False},
-    {'nomis_id': 'PR1', 'general_ledger_code': '10101000', 'name': 'Private 1', 'private_estate': True,
-     'cms_establishment_code': '10'},
-    {'nomis_id': 'PR2', 'general_ledger_code': '10101000', 'name': 'Private 2', 'private_estate': True,
-     'cms_establishment_code': '20'},
-]
+TEST_PRISONS = fixtures.PRISONS
 TEST_HOLIDAYS = {'england-and-wales': {
     'division': 'england-and-wales',
     'events': [
@@ -33,13 +27,7 @@ ORIGINAL_REF = 'reference'
 SENDER_NAME = 'sender'
 OPENING_BALANCE = 20000
 
-TEST_BANK_ACCOUNT = {
-    'address_line1': 'line 1',
-    'city': 'city',
-    'postcode': 'post code',
-    'account_number': '12345678',
-    'sort_code': '101010',
-}
+TEST_BANK_ACCOUNT = fixtures.BANK_ACCOUNT
 
 
 def api_url(path):
@@ -221,6 +209,8 @@ def mock_balance():
 
 
 def mock_bank_holidays(rsps=None):
+    # the workday calendar is shared across the process so it must be rebuilt from the mocked holidays
+    cache.delete(HOLIDAY_CACHE_KEY)
     rsps = rsps or responses
     rsps.add(
         responses.GET,
@@ -254,11 +244,14 @@ def temp_file(data):
         yield f
 
 
+# tests only mock the api calls they expect so failed requests are not retried unless a test enables it
+@override_settings(REQUEST_RETRY_BUDGET=0)
 class BankAdminTestCase(SimpleTestCase):
 
     def tearDown(self):
         super().tearDown()
         shutil.rmtree('local_files/cache/', ignore_errors=True)
+        cache.clear()
 
     def assert_called_with(self, url, method, expected_data):
         called = False
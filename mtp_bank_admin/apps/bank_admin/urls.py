@@ -15,6 +15,7 @@ urlpatterns = [
     re_path(r'^adi/download/$', views.download_adi_journal, name='download_adi_journal'),
     re_path(r'^bank_statement/download/$', views.download_bank_statement, name='download_bank_statement'),
     re_path(r'^disbursements/download/$', views.download_disbursements, name='download_disbursements'),
+    re_path(r'^download/status/$', views.file_generation_status, name='file_generation_status'),
 
     re_path(r'^q_and_a/$', RedirectView.as_view(url=urljoin(settings.SEND_MONEY_URL, '/help/faq/'), permanent=True)),
 ]
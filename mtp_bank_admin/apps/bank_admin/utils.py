@@ -1,19 +1,40 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+from copy import copy
+import copyreg
+import fcntl
 from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+import hashlib
 import io
-from itertools import count, islice
 import logging
+import pickle
+import tempfile
+import threading
 import time as systime
 import os
-
+import posixpath
+import re
+import shutil
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import zipfile
+
+from django.conf import settings
 from django.utils.timezone import now
-from mtp_common.api import retrieve_all_pages_for_path
-from mtp_common.dates import WorkdayChecker
 from openpyxl import load_workbook, styles
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.indexed_list import IndexedList
 from openpyxl.writer.excel import save_workbook
 import requests
 
+from .api import RetryBudget, get_with_retries, retrieve_all_pages_for_path
 from .exceptions import EarlyReconciliationError
+from .profiling import profiled_stage
+from .rendering import UNSET
+from .workdays import get_workday_calendar
 
 logger = logging.getLogger('mtp')
 
@@ -25,49 +46,148 @@ logger = logging.getLogger('mtp')
 RECONCILE_REQUEST_TIMEOUT = 120  # seconds
 RECONCILE_MAX_ATTEMPTS = 3
 RECONCILE_RETRY_DELAY = 5  # seconds
+# days already reconciled are marked in the file cache under this label
+RECONCILED_LABEL = 'RECONCILED'
+
+FILE_CACHE_PATH = 'local_files/cache'
+
+
+def retrieve_all_pages_concurrently(api_session, path, **params):
+    """
+    Loads all pages of a paginated API list into a single results list, like
+    `mtp_common.api.retrieve_all_pages_for_path`, but once the first page reveals the total count,
+    the remaining pages are fetched in parallel (up to `REQUEST_PAGE_CONCURRENCY` at a time).
+    Failed pages are retried individually, sharing one retry budget, so loaded pages are never lost.
+    :param api_session: Requests Session object
+    :param path: URL path
+    :param params: additional URL params
+    """
+    page_size = settings.REQUEST_PAGE_SIZE
+    budget = RetryBudget()
+
+    def retrieve_page(offset):
+        response = get_with_retries(
+            api_session, path, budget=budget,
+            params=dict(limit=page_size, offset=offset, **params)
+        )
+        return response.json()
+
+    first_page = retrieve_page(0)
+    loaded_results = first_page.get('results', [])
+    count = first_page.get('count', 0)
+    # the api may cap the page size so step by what was actually returned
+    step = len(loaded_results)
+    if not step or step >= count:
+        return loaded_results
+
+    offsets = range(step, count, step)
+    max_workers = max(1, min(settings.REQUEST_PAGE_CONCURRENCY, len(offsets)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # `map` yields pages in offset order regardless of which request completes first
+        for page in executor.map(retrieve_page, offsets):
+            loaded_results += page.get('results', [])
+    return loaded_results
+
+
+def run_concurrently(*calls):
+    """
+    Runs independent calls in parallel threads, returning their results in the same order
+    or raising the first call's error
+    :param calls: callables taking no arguments, e.g. `functools.partial` objects
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(calls))) as executor:
+        # calls run in copies of the caller's context, e.g. to record stages of a file generation profile
+        futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+    return [future.result() for future in futures]
 
 
 def retrieve_all_transactions(api_session, **kwargs):
-    return retrieve_all_pages_for_path(
+    return retrieve_all_pages_concurrently(
         api_session, 'transactions/', **kwargs)
 
 
 def retrieve_all_valid_credits(api_session, **kwargs):
-    return retrieve_all_pages_for_path(
+    return retrieve_all_pages_concurrently(
         api_session, 'credits/', valid=True, **kwargs)
 
 
-def retrieve_prisons(api_session):
-    prisons = retrieve_all_pages_for_path(api_session, 'prisons/')
-    return {prison['nomis_id']: prison for prison in prisons}
-
-
 def set_worldpay_cutoff(date):
     return datetime.combine(date, time(0, 0, 0, tzinfo=timezone.utc))
 
 
 def get_start_and_end_date(date):
-    checker = WorkdayChecker()
     start_date = set_worldpay_cutoff(date)
-    end_date = set_worldpay_cutoff(checker.get_next_workday(date))
+    end_date = set_worldpay_cutoff(get_workday_calendar().get_next_workday(date))
     return start_date, end_date
 
 
-def reconcile_for_date(api_session, receipt_date):
+@profiled_stage('reconciliation')
+def reconcile_for_date(api_session, receipt_date, force=False):
+    """
+    Reconciles each day covered by the receipt date. Days are remembered once reconciled
+    (until they fall out of the file cache's window of preceding workdays) so later callers do not post them again.
+    Days spanning weekends and bank holidays are reconciled in parallel; if any fail, the others
+    are still completed and the earliest error is raised with notes about the rest.
+    :param force: reconcile all days even if they were already reconciled
+    """
     start_date, end_date = get_start_and_end_date(receipt_date)
 
     if start_date.date() >= now().date() or end_date.date() > now().date():
         raise EarlyReconciliationError
 
+    days = []
     reconciliation_date = start_date
     while reconciliation_date < end_date:
         end_of_day = reconciliation_date + timedelta(days=1)
-        _reconcile_day(api_session, reconciliation_date, end_of_day)
+        days.append((reconciliation_date, end_of_day))
         reconciliation_date = end_of_day
 
+    def reconcile(day):
+        try:
+            _reconcile_day_once(api_session, *day, force=force)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(days), settings.RECONCILE_CONCURRENCY))) as executor:
+        errors = [
+            (day, error)
+            for day, error in zip(days, executor.map(reconcile, days))
+            if error is not None
+        ]
+    if errors:
+        _raise_reconciliation_errors(errors)
+
     return start_date, end_date
 
 
+def _raise_reconciliation_errors(errors):
+    (_, first_error), other_errors = errors[0], errors[1:]
+    if other_errors:
+        logger.error('Could not reconcile %s', ', '.join(
+            '%s (%r)' % (reconciliation_date.date(), error)
+            for (reconciliation_date, _), error in errors
+        ))
+    for (reconciliation_date, _), error in other_errors:
+        first_error.add_note('Could not reconcile %s either: %r' % (reconciliation_date.date(), error))
+    raise first_error
+
+
+def _reconcile_day_once(api_session, reconciliation_date, end_of_day, force=False):
+    marker_path = get_cached_file_path(RECONCILED_LABEL, reconciliation_date)
+    if not force and os.path.isfile(marker_path):
+        return
+
+    dirname, basename = os.path.split(marker_path)
+    os.makedirs(dirname, exist_ok=True)
+    with file_lock(os.path.join(dirname, '.%s.lock' % basename)):
+        if not force and os.path.isfile(marker_path):
+            # reconciled while waiting for the lock
+            return
+        _reconcile_day(api_session, reconciliation_date, end_of_day)
+        with open(marker_path, 'w') as f:
+            f.write(now().isoformat())
+
+
 def _reconcile_day(api_session, reconciliation_date, end_of_day):
     for attempt in range(1, RECONCILE_MAX_ATTEMPTS + 1):
         try:
@@ -90,9 +210,28 @@ def _reconcile_day(api_session, reconciliation_date, end_of_day):
             systime.sleep(RECONCILE_RETRY_DELAY)
 
 
+def retrieve_all_disbursements(api_session, **kwargs):
+    return retrieve_all_pages_for_path(
+        api_session, 'disbursements/', **kwargs)
+
+
+def retrieve_private_estate_batches(api_session, start_date, end_date, prison=None):
+    filters = dict(
+        date__gte=start_date.date(),
+        date__lt=end_date.date(),
+    )
+    if prison:
+        filters['prison'] = prison
+    return retrieve_all_pages_for_path(
+        api_session,
+        'private-estate-batches/',
+        **filters
+    )
+
+
 def retrieve_last_balance(api_session, date):
-    response = api_session.get(
-        'balances/', params={
+    response = get_with_retries(
+        api_session, 'balances/', params={
             'limit': 1,
             'date__lt': date.isoformat()
         }
@@ -132,18 +271,144 @@ def get_preceding_workday_list(number_of_days, offset=0):
     :param number_of_days: number of weekdays to include in total
     :param offset: number of days ago to start from; if 0 today is included
     """
+    return get_workday_calendar().get_preceding_workdays(now().date(), number_of_days, offset)
 
-    def day_generator():
-        current = now().date()
-        for day in count():
-            yield current - timedelta(days=day)
 
-    days = day_generator()
-    checker = WorkdayChecker()
-    days = filter(checker.is_workday, days)
-    days = islice(days, offset, number_of_days + offset)
+class _TemplatePickler(pickle.Pickler):
+    """
+    Pickles parsed templates for `TemplatePool` without changing how other callers pickle openpyxl objects
+    """
+    # openpyxl's IndexedList is a list subclass whose lookup dict is only built by `__init__`, so the default
+    # pickle protocol (which appends items onto an uninitialised instance) produces an empty style table
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[IndexedList] = lambda indexed_list: (IndexedList, (list(indexed_list),))
+
 
-    return list(days)
+_PooledTemplate = namedtuple('_PooledTemplate', 'mtime digest data snapshot')
+
+
+class TemplatePool:
+    """
+    Parses each workbook template once per process and hands out isolated copies of it.
+    Templates are keyed on path and modification time, and only re-parsed if their content hash changes.
+    """
+    max_size = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def load_workbook(self, template_path):
+        template = self._get_template(template_path)
+        wb = pickle.loads(template.snapshot)
+        wb.vba_archive = zipfile.ZipFile(io.BytesIO(template.data))
+        return wb
+
+    def _get_template(self, template_path):
+        mtime = os.stat(template_path).st_mtime_ns
+        with self._lock:
+            template = self._templates.get(template_path)
+            if template is None or template.mtime != mtime:
+                with open(template_path, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()
+                if template is None or template.digest != digest:
+                    template = _PooledTemplate(mtime, digest, data, self._parse(data))
+                else:
+                    template = template._replace(mtime=mtime)
+                self._templates[template_path] = template
+                if len(self._templates) > self.max_size:
+                    self._templates.popitem(last=False)
+            self._templates.move_to_end(template_path)
+            return template
+
+    @classmethod
+    def _parse(cls, data):
+        wb = load_workbook(io.BytesIO(data), keep_vba=True)
+        wb.vba_archive.close()
+        wb.vba_archive = None
+        snapshot = io.BytesIO()
+        _TemplatePickler(snapshot, pickle.HIGHEST_PROTOCOL).dump(wb)
+        return snapshot.getvalue()
+
+
+template_pool = TemplatePool()
+
+
+_SPREADSHEETML_NS = {
+    'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+}
+
+
+def get_worksheet_member(package, sheet_name):
+    """
+    Returns the name of the zip package member holding a worksheet
+    """
+    workbook = ElementTree.fromstring(package.read('xl/workbook.xml'))
+    for sheet in workbook.iterfind('main:sheets/main:sheet', _SPREADSHEETML_NS):
+        if sheet.get('name') == sheet_name:
+            relationship_id = sheet.get('{%s}id' % _SPREADSHEETML_NS['r'])
+            break
+    else:
+        raise ValueError('Worksheet %s not found' % sheet_name)
+    relationships = ElementTree.fromstring(package.read('xl/_rels/workbook.xml.rels'))
+    for relationship in relationships.iterfind('rel:Relationship', _SPREADSHEETML_NS):
+        if relationship.get('Id') == relationship_id:
+            target = relationship.get('Target')
+            if target.startswith('/'):
+                return target[1:]
+            return posixpath.normpath(posixpath.join('xl', target))
+    raise ValueError('Worksheet %s has no relationship' % sheet_name)
+
+
+def patch_cell_values(filepath, sheet_name, values):
+    """
+    Returns a copy of a saved workbook with text cells replaced, rewriting only the worksheet's XML
+    so that the workbook does not need to be loaded and saved with openpyxl.
+    Cells must already exist in the worksheet; their styles are kept.
+    :param values: dict of cell coordinates to string values
+    """
+    with zipfile.ZipFile(filepath) as package:
+        worksheet_member = get_worksheet_member(package, sheet_name)
+        worksheet = package.read(worksheet_member).decode('utf-8')
+        for coordinate, value in values.items():
+            worksheet = _patch_cell(worksheet, coordinate, value)
+
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as patched_package:
+            for member in package.infolist():
+                if member.filename == worksheet_member:
+                    patched_package.writestr(member, worksheet.encode('utf-8'))
+                else:
+                    copy_member(package, patched_package, member)
+    return output.getvalue()
+
+
+def copy_member(source, target, member):
+    """
+    Copies a member of one zip package into another, keeping its name, date and compression method
+    """
+    # a copy of the entry is written since zipfile updates its sizes and offset
+    with source.open(member) as source_file, target.open(copy(member), 'w') as target_file:
+        shutil.copyfileobj(source_file, target_file)
+
+
+def _patch_cell(worksheet, coordinate, value):
+    cell_re = re.compile(r'<c r="%s"(?P<attrs>[^>]*?)(?:/>|>.*?</c>)' % re.escape(coordinate), re.DOTALL)
+    match = cell_re.search(worksheet)
+    if not match:
+        raise ValueError('Cell %s not found' % coordinate)
+    style = re.search(r'\ss="\d+"', match.group('attrs'))
+    cell = '<c r="%s"%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+        coordinate, style.group() if style else '', escape(value),
+    )
+    return worksheet[:match.start()] + cell + worksheet[match.end():]
 
 
 class Journal:
@@ -156,74 +421,183 @@ class Journal:
     }
 
     def __init__(self, template_path, sheet_name, start_row, fields):
-        self.wb = load_workbook(template_path, keep_vba=True)
+        self.wb = template_pool.load_workbook(template_path)
         self.journal_ws = self.wb[sheet_name]
 
         self.start_row = start_row
         self.current_row = start_row
         self.fields = fields
+        self.field_columns = {
+            field: column_index_from_string(fields[field]['column'])
+            for field in fields
+        }
+        self.field_styles = {
+            field: self.compile_style(fields[field].get('style'))
+            for field in fields
+        }
+        self.style_arrays = {}
 
     def next_row(self, increment=1):
         self.current_row += increment
 
+    def add_row(self, row):
+        """
+        Renders a JournalRow into the current row of the worksheet
+        """
+        for field, value in zip(self.fields, row.values):
+            if value is not UNSET:
+                self.set_field(field, value)
+        self.next_row()
+
     def get_cell(self, field):
         return '%s%s' % (self.fields[field]['column'],
                          self.current_row)
 
-    def set_field(self, field, value, style=None, extra_style=None):
-        extra_style = extra_style or {}
-        cell = self.get_cell(field)
-        self.journal_ws[cell] = value
-
+    def set_field(self, field, value, style=None, extra_style=None, number_format=None):
+        cell = self.journal_ws.cell(row=self.current_row, column=self.field_columns[field])
+        cell.value = value
+
+        if style is None and extra_style is None:
+            compiled_style = self.field_styles[field]
+        else:
+            compiled_style = self.compile_style(style or self.fields[field].get('style', {}), extra_style)
+
+        # cells sharing a template style and a compiled style end up with identical style ids;
+        # compiled styles are interned so are keyed on identity rather than hashing openpyxl style objects
+        style_key = (cell.has_style and tuple(cell._style), id(compiled_style))
+        style_array = self.style_arrays.get(style_key)
+        if style_array is None:
+            for key, style_object in compiled_style:
+                setattr(cell, key, style_object)
+            self.style_arrays[style_key] = copy(cell._style)
+        else:
+            cell._style = copy(style_array)
+        if number_format:
+            cell.number_format = number_format
+        return cell
+
+    def set_cell_value(self, coordinate, value):
+        self.journal_ws[coordinate] = value
+
+    def set_title(self, title):
+        self.journal_ws.title = title
+
+    def create_named_range(self, name, reference):
+        self.wb.create_named_range(name, self.journal_ws, reference)
+
+    @classmethod
+    def compile_style(cls, *style_dicts):
         computed_style = defaultdict(dict)
-        base_style = style or self.fields[field].get('style', {})
-        for key in base_style:
-            computed_style[key].update(base_style[key])
-
-        for key in extra_style:
-            computed_style[key].update(extra_style[key])
-
-        for key in computed_style:
-            setattr(
-                self.journal_ws[cell],
-                key,
-                self.STYLE_TYPES[key](**computed_style[key])
-            )
-        return self.journal_ws[cell]
-
-    def lookup(self, field, context=None):
-        context = context or {}
-
-        try:
-            value = self.fields[field]['value']
-            return value.format(**context)
-        except KeyError:
-            pass  # no static value
-        return None
-
-    def create_file(self):
+        for style_dict in style_dicts:
+            for key in style_dict or {}:
+                computed_style[key].update(style_dict[key])
+        return cls._intern_style(tuple(
+            (key, tuple(sorted(computed_style[key].items())))
+            for key in computed_style
+        ))
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _intern_style(cls, frozen_style):
+        return tuple(
+            (key, cls.STYLE_TYPES[key](**dict(attributes)))
+            for key, attributes in frozen_style
+        )
+
+    def create_file(self, output=None):
+        """
+        Saves the workbook
+        :param output: file path or writable file-like object to stream the package into;
+            if omitted, the file contents are returned as bytes
+        """
+        if output is not None:
+            save_workbook(self.wb, output)
+            return None
         f = io.BytesIO()
         save_workbook(self.wb, f)
         return f.getvalue()
 
 
 def get_cached_file_path(label, date, extension=None):
-    filepath = 'local_files/cache/{label}/{date:%Y%m%d}'.format(label=label, date=date)
+    filepath = '{cache_path}/{label}/{date:%Y%m%d}'.format(cache_path=FILE_CACHE_PATH, label=label, date=date)
     if extension:
         filepath = '.'.join([filepath, extension])
     return filepath
 
 
-def get_or_create_file(label, date, creation_func, f_args=None, f_kwargs=None, file_extension=None):
+def get_file_validators(filepath, variant=None):
+    """
+    Returns an ETag and modification time for a cached file, or Nones if it does not exist.
+    The ETag is derived from the file's content hash and generation time.
+    :param variant: distinguishes responses personalised from the same file, making the ETag weak
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None, None
+    digest = _get_file_digest(filepath, stat.st_mtime_ns, stat.st_size)
+    etag = hashlib.sha256(('%s:%s:%s' % (digest, stat.st_mtime_ns, variant or '')).encode('utf-8')).hexdigest()
+    etag = '"%s"' % etag[:32]
+    if variant:
+        etag = 'W/' + etag
+    return etag, int(stat.st_mtime)
+
+
+@lru_cache(maxsize=256)
+def _get_file_digest(filepath, mtime_ns, size):
+    with open(filepath, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Holds an exclusive lock on a file, blocking until it is available;
+    works across processes as well as threads
+    """
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_or_create_file(label, date, creation_func, f_args=None, f_kwargs=None, file_extension=None, stream=False):
+    """
+    Returns the path to the cached file, generating it first if necessary.
+    Only one thread or process generates a given file at a time, others wait for its result.
+    Files are written to a temporary path and moved into place once complete.
+    :param stream: if True, `creation_func` is passed the open file as `output`
+        and must write into it instead of returning the file contents
+    """
     f_args = f_args or []
     f_kwargs = f_kwargs or {}
 
     filepath = get_cached_file_path(label, date, extension=file_extension)
-    if not os.path.isfile(filepath):
-        filedata = creation_func(*f_args, **f_kwargs)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'wb+') as f:
-            if isinstance(filedata, str):
-                filedata = filedata.encode('utf-8')
-            f.write(filedata)
+    if os.path.isfile(filepath):
+        return filepath
+
+    dirname, basename = os.path.split(filepath)
+    os.makedirs(dirname, exist_ok=True)
+    with file_lock(os.path.join(dirname, '.%s.lock' % basename)):
+        if os.path.isfile(filepath):
+            # generated while waiting for the lock
+            return filepath
+
+        fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if stream:
+                    creation_func(*f_args, output=f, **f_kwargs)
+                else:
+                    filedata = creation_func(*f_args, **f_kwargs)
+                    if isinstance(filedata, str):
+                        filedata = filedata.encode('utf-8')
+                    f.write(filedata)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, filepath)
+        except BaseException:
+            os.remove(temp_path)
+            raise
     return filepath
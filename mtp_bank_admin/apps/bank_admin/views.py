@@ -1,11 +1,24 @@
 from datetime import date
+from functools import partial
+import hashlib
+import io
 import logging
+import os
+import re
 
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+)
+from django.shortcuts import redirect, render
+from django.urls import reverse_lazy
 from django.utils.dateformat import format as date_format
 from django.utils.dateparse import parse_date
+from django.utils.http import content_disposition_header, parse_http_date_safe
+from django.utils.translation import gettext as _
 from django.views.generic.base import TemplateView
 from mtp_common.auth.api_client import get_api_session
 from mtp_common.auth.exceptions import HttpClientError
@@ -14,12 +27,26 @@ from . import (
     refund, adi, statement, disbursements, ADI_JOURNAL_LABEL, ACCESSPAY_LABEL,
     MT940_STMT_LABEL, DISBURSEMENTS_LABEL
 )
-from .decorators import filter_by_receipt_date, handle_file_download_errors
+from .api import get_with_retries
+from .decorators import (
+    FILE_DOWNLOAD_ERROR_MESSAGES, conditional_file_download, filter_by_receipt_date, generate_in_background,
+    handle_file_download_errors,
+)
 from .exceptions import EmptyFileError
-from .utils import get_preceding_workday_list
+from .generation import (
+    FILE_GENERATORS, STATUS_FAILED, STATUS_PENDING, clear_file_generation_status, get_download_url,
+    get_file_generation_status
+)
+from .utils import FILE_CACHE_PATH, get_preceding_workday_list, run_concurrently
 
 logger = logging.getLogger('mtp')
 
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+BYTE_RANGE_BLOCK_SIZE = 64 * 1024
+
+# incremented whenever a file is downloaded so that all cached missing-download lists are ignored
+MISSING_DOWNLOADS_VERSION_KEY = 'bank-admin-missing-downloads-version'
+
 
 def record_download(api_session, label, receipt_date):
     try:
@@ -32,11 +59,39 @@ def record_download(api_session, label, receipt_date):
         )
     except HttpClientError:
         pass  # expected non-unique error if re-downloading
+    invalidate_missing_downloads()
+
+
+def record_refund_file_download(request, receipt_date):
+    api_session = get_api_session(request)
+    refund.mark_as_refunded(api_session, receipt_date)
+    record_download(api_session, ACCESSPAY_LABEL, receipt_date)
+
+
+def record_adi_journal_download(request, receipt_date):
+    record_download(get_api_session(request), ADI_JOURNAL_LABEL, receipt_date)
+
+
+def record_bank_statement_download(request, receipt_date):
+    record_download(get_api_session(request), MT940_STMT_LABEL, receipt_date)
+
+
+def record_disbursements_download(request, receipt_date):
+    api_session = get_api_session(request)
+    disbursements.mark_as_sent(api_session, receipt_date)
+    record_download(api_session, DISBURSEMENTS_LABEL, receipt_date)
+
+
+def invalidate_missing_downloads():
+    try:
+        cache.incr(MISSING_DOWNLOADS_VERSION_KEY)
+    except ValueError:
+        cache.set(MISSING_DOWNLOADS_VERSION_KEY, 1, timeout=None)
 
 
 def get_missing_downloads(api_session, label, dates):
-    response = api_session.get(
-        'file-downloads/missing/',
+    response = get_with_retries(
+        api_session, 'file-downloads/missing/',
         params={
             'label': label,
             'date': dates
@@ -45,6 +100,131 @@ def get_missing_downloads(api_session, label, dates):
     return [parse_date(date) for date in response.json()['missing_dates']]
 
 
+def get_missing_downloads_by_label(api_session, user, labels, dates):
+    """
+    Returns missing download dates for each label, loading all labels in parallel.
+    Results are cached per user and date window until the next download is recorded.
+    """
+    if not labels:
+        return {}
+
+    version = cache.get(MISSING_DOWNLOADS_VERSION_KEY, 0)
+    window = ','.join(labels + [date.isoformat() for date in dates])
+    cache_key = 'bank-admin-missing-downloads-%s-%s-%s' % (
+        user.pk, version, hashlib.sha1(window.encode('utf-8')).hexdigest()
+    )
+    missing_downloads = cache.get(cache_key)
+    if missing_downloads is None:
+        missing_downloads = dict(zip(labels, run_concurrently(*(
+            partial(get_missing_downloads, api_session, label, dates)
+            for label in labels
+        ))))
+        cache.set(cache_key, missing_downloads, timeout=settings.MISSING_DOWNLOADS_CACHE_TIMEOUT)
+    return missing_downloads
+
+
+def file_download_response(request, file, filename, content_type):
+    """
+    Streams a file as an attachment, supporting a single byte range so that interrupted downloads can resume.
+    Ranges are only sent if an If-Range header matches the file's validators from `conditional_file_download`
+    so that parts of a regenerated or personalised file are never combined with an earlier download.
+    If FILE_DOWNLOAD_OFFLOAD_HEADER is set, cached files are instead sent by the web server.
+    :param file: open binary file, closed once the response is sent
+    """
+    filepath = getattr(file, 'name', None)
+    if settings.FILE_DOWNLOAD_OFFLOAD_HEADER and isinstance(filepath, str) and os.path.isfile(filepath):
+        file.close()
+        if settings.FILE_DOWNLOAD_OFFLOAD_PREFIX:
+            location = settings.FILE_DOWNLOAD_OFFLOAD_PREFIX + os.path.relpath(filepath, FILE_CACHE_PATH)
+        else:
+            location = os.path.abspath(filepath)
+        response = HttpResponse(content_type=content_type)
+        response[settings.FILE_DOWNLOAD_OFFLOAD_HEADER] = location
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        return response
+
+    file.seek(0, io.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if if_range_matches(request.headers.get('If-Range'), getattr(request, 'file_validators', None)):
+        byte_range = parse_byte_range(request.headers.get('Range'), size)
+    else:
+        byte_range = None
+    if byte_range is None:
+        response = FileResponse(file, as_attachment=True, filename=filename, content_type=content_type)
+    elif not byte_range:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            read_byte_range(file, start, end), status=206, content_type=content_type
+        )
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def if_range_matches(if_range_header, validators):
+    """
+    Checks whether a range can be sent for an If-Range header
+    :param validators: (ETag, Last-Modified timestamp) of the file, if known before the response was made
+    :return: True if there is no If-Range header or it matches the file's strong validators
+    """
+    if if_range_header is None:
+        return True
+    etag, last_modified = validators or (None, None)
+    if not etag or etag.startswith('W/'):
+        # the file has changed since the range was requested or the response is personalised
+        # so parts of different responses could be combined
+        return False
+    if_range_header = if_range_header.strip()
+    if if_range_header.startswith(('"', 'W/')):
+        return if_range_header == etag
+    return parse_http_date_safe(if_range_header) == last_modified
+
+
+def parse_byte_range(range_header, size):
+    """
+    Parses a single byte range from a Range header
+    :return: (first byte, last byte) positions, None if the whole file should be sent
+        or () if the range cannot be satisfied
+    """
+    matches = BYTE_RANGE_RE.match((range_header or '').strip())
+    if not matches:
+        # missing, multiple or other kinds of ranges are ignored
+        return None
+    start, end = matches.groups()
+    if not start:
+        if not end:
+            return None
+        # suffix range of the last bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return ()
+    return start, end
+
+
+def read_byte_range(file, start, end):
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = file.read(min(remaining, BYTE_RANGE_BLOCK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
 class DashboardView(TemplateView):
     template_name = 'bank_admin/dashboard.html'
 
@@ -57,30 +237,71 @@ class DashboardView(TemplateView):
         api_session = get_api_session(self.request)
         workday_list = get_preceding_workday_list(20, offset=2)
         user = self.request.user
+        checked_downloads = {}
         if settings.SHOW_ACCESS_PAY_REFUNDS and user.has_perm('transaction.view_bank_details_transaction'):
-            context['missed_refunds'] = get_missing_downloads(
-                api_session, ACCESSPAY_LABEL, workday_list
-            )
+            checked_downloads[ACCESSPAY_LABEL] = 'missed_refunds'
         if user.has_perm('credit.view_any_credit'):
-            context['missed_adi_journals'] = get_missing_downloads(
-                api_session, ADI_JOURNAL_LABEL, workday_list
-            )
+            checked_downloads[ADI_JOURNAL_LABEL] = 'missed_adi_journals'
         if user.has_perm('transaction.view_transaction'):
-            context['missed_statements'] = get_missing_downloads(
-                api_session, MT940_STMT_LABEL, workday_list
-            )
+            checked_downloads[MT940_STMT_LABEL] = 'missed_statements'
         if user.has_perm('disbursement.view_disbursement'):
-            context['missed_disbursements'] = get_missing_downloads(
-                api_session, DISBURSEMENTS_LABEL, workday_list
-            )
+            checked_downloads[DISBURSEMENTS_LABEL] = 'missed_disbursements'
+        missing_downloads = get_missing_downloads_by_label(
+            api_session, user, list(checked_downloads), workday_list
+        )
+        for label, context_name in checked_downloads.items():
+            context[context_name] = missing_downloads[label]
 
         context['show_access_pay_refunds'] = settings.SHOW_ACCESS_PAY_REFUNDS
         return context
 
 
+@login_required
+@filter_by_receipt_date
+def file_generation_status(request, receipt_date):
+    """
+    Reports on a file being generated in the background: as json for polling
+    or as a page that refreshes itself until the file can be downloaded
+    """
+    label = request.GET.get('label')
+    if label not in FILE_GENERATORS:
+        return HttpResponseBadRequest(_('Unknown file'))
+
+    status = get_file_generation_status(label, receipt_date) or {}
+    download_url = get_download_url(label, receipt_date)
+    error_message = None
+    if status.get('status') == STATUS_FAILED:
+        error_message = FILE_DOWNLOAD_ERROR_MESSAGES.get(
+            status['error'], FILE_DOWNLOAD_ERROR_MESSAGES['UpstreamServiceUnavailable']
+        )
+
+    if not request.accepts('text/html'):
+        return JsonResponse({
+            'status': status.get('status'),
+            'message': error_message and str(error_message),
+            'download_url': download_url,
+        })
+
+    if status.get('status') == STATUS_PENDING:
+        response = render(request, 'bank_admin/file-generation.html')
+        response['Refresh'] = str(settings.FILE_GENERATION_POLL_INTERVAL)
+        return response
+    if error_message:
+        if status['error'] == EmptyFileError.__name__:
+            # like downloads generated within the request, empty files are recorded so they are no longer missed
+            record_download(get_api_session(request), label, receipt_date)
+        clear_file_generation_status(label, receipt_date)
+        messages.error(request, error_message)
+        return redirect(reverse_lazy('bank_admin:dashboard'))
+    # ready or no longer known so the download view will serve or restart it
+    return redirect(download_url)
+
+
 @login_required
 @filter_by_receipt_date
 @handle_file_download_errors
+@conditional_file_download(ACCESSPAY_LABEL, record_refund_file_download)
+@generate_in_background(ACCESSPAY_LABEL)
 def download_refund_file(request, receipt_date):
     api_session = get_api_session(request)
     try:
@@ -94,8 +315,7 @@ def download_refund_file(request, receipt_date):
 
     filename = settings.REFUND_OUTPUT_FILENAME.format(date=date.today())
 
-    response = HttpResponse(csv_file, content_type='text/plain')
-    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response = file_download_response(request, csv_file, filename, 'text/plain')
 
     logger.info('User "%(username)s" is downloading AccessPay file for %(date)s', {
         'username': request.user.username,
@@ -108,6 +328,8 @@ def download_refund_file(request, receipt_date):
 @login_required
 @filter_by_receipt_date
 @handle_file_download_errors
+@conditional_file_download(ADI_JOURNAL_LABEL, record_adi_journal_download, variant=adi.get_batch_name)
+@generate_in_background(ADI_JOURNAL_LABEL)
 def download_adi_journal(request, receipt_date):
     api_session = get_api_session(request)
     try:
@@ -124,11 +346,10 @@ def download_adi_journal(request, receipt_date):
         date=date.today()
     )
 
-    response = HttpResponse(
-        xlsm_file,
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    response = file_download_response(
+        request, io.BytesIO(xlsm_file), filename,
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
-    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
     logger.info('User "%(username)s" is downloading ADI journal for %(date)s', {
         'username': request.user.username,
@@ -141,6 +362,8 @@ def download_adi_journal(request, receipt_date):
 @login_required
 @filter_by_receipt_date
 @handle_file_download_errors
+@conditional_file_download(MT940_STMT_LABEL, record_bank_statement_download)
+@generate_in_background(MT940_STMT_LABEL)
 def download_bank_statement(request, receipt_date):
     api_session = get_api_session(request)
     try:
@@ -154,8 +377,7 @@ def download_bank_statement(request, receipt_date):
         account_number=settings.BANK_STMT_ACCOUNT_NUMBER, date=receipt_date
     )
 
-    response = HttpResponse(mt940_file, content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response = file_download_response(request, mt940_file, filename, 'application/octet-stream')
 
     logger.info('User "%(username)s" is downloading bank statement file for %(date)s', {
         'username': request.user.username,
@@ -168,6 +390,8 @@ def download_bank_statement(request, receipt_date):
 @login_required
 @filter_by_receipt_date
 @handle_file_download_errors
+@conditional_file_download(DISBURSEMENTS_LABEL, record_disbursements_download)
+@generate_in_background(DISBURSEMENTS_LABEL)
 def download_disbursements(request, receipt_date):
     api_session = get_api_session(request)
     try:
@@ -181,11 +405,10 @@ def download_disbursements(request, receipt_date):
 
     filename = settings.DISBURSEMENT_OUTPUT_FILENAME.format(date=receipt_date)
 
-    response = HttpResponse(
-        xlsm_file,
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    response = file_download_response(
+        request, xlsm_file, filename,
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
-    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
     logger.info('User "%(username)s" is downloading Disbursements for %(date)s', {
         'username': request.user.username,
@@ -0,0 +1,112 @@
+from bisect import bisect_right
+from datetime import date, timedelta
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from govuk_bank_holidays.bank_holidays import BankHolidays
+
+HOLIDAY_CACHE_KEY = 'bank-admin-holidays'
+
+
+class WorkdayCalendar:
+    """
+    Workdays in England and Wales, indexed as a sorted list of ordinals so that finding
+    next, previous or preceding workdays is a binary search instead of a day-by-day walk.
+    The index is extended whenever a date outside it is looked up.
+    """
+
+    # days either side of the known holidays and today included in the index
+    padding = 366
+
+    def __init__(self, holidays, fetched_at=None):
+        self.holidays = frozenset(holidays)
+        self.fetched_at = fetched_at
+        self.lock = threading.Lock()
+        known_dates = list(self.holidays) + [date.today()]
+        self.workdays = self._build_index(min(known_dates), max(known_dates))
+
+    def is_workday(self, day):
+        return day.weekday() < 5 and day not in self.holidays
+
+    def get_next_workday(self, day):
+        workdays = self._get_index(day, day + timedelta(days=14))
+        return date.fromordinal(workdays[bisect_right(workdays, day.toordinal())])
+
+    def get_previous_workday(self, day):
+        workdays = self._get_index(day - timedelta(days=14), day)
+        return date.fromordinal(workdays[bisect_right(workdays, day.toordinal() - 1) - 1])
+
+    def get_preceding_workdays(self, day, number_of_days, offset=0):
+        """
+        Returns a list of workdays counting backwards from a date
+        :param day: the date to start from, included if it is a workday
+        :param number_of_days: number of workdays to include in total
+        :param offset: number of workdays to skip
+        """
+        workdays = self._get_index(day - timedelta(days=(number_of_days + offset) * 2 + 14), day)
+        end = bisect_right(workdays, day.toordinal()) - offset
+        start = max(end - number_of_days, 0)
+        return [date.fromordinal(ordinal) for ordinal in reversed(workdays[start:max(end, 0)])]
+
+    def _get_index(self, first_day, last_day):
+        workdays = self.workdays
+        if workdays[0] <= first_day.toordinal() and workdays[-1] >= last_day.toordinal():
+            return workdays
+        with self.lock:
+            workdays = self.workdays
+            self.workdays = self._build_index(
+                min(first_day, date.fromordinal(workdays[0])),
+                max(last_day, date.fromordinal(workdays[-1])),
+            )
+            return self.workdays
+
+    def _build_index(self, first_day, last_day):
+        first_day -= timedelta(days=self.padding)
+        last_day += timedelta(days=self.padding)
+        return [
+            ordinal
+            for ordinal in range(first_day.toordinal(), last_day.toordinal() + 1)
+            if self.is_workday(date.fromordinal(ordinal))
+        ]
+
+
+_calendar = None
+_calendar_lock = threading.Lock()
+
+
+def get_workday_calendar():
+    """
+    Returns the shared workday calendar, downloading bank holidays only once every `WORKDAY_CALENDAR_TTL` seconds;
+    the calendar's index is only rebuilt if the holidays have changed
+    """
+    cached = cache.get(HOLIDAY_CACHE_KEY)
+    if cached:
+        return _get_calendar(cached)
+
+    with _calendar_lock:
+        cached = cache.get(HOLIDAY_CACHE_KEY)
+        if not cached:
+            holidays = BankHolidays().get_holidays(division=BankHolidays.ENGLAND_AND_WALES)
+            cached = {
+                'fetched_at': time.time(),
+                'holidays': sorted(holiday['date'] for holiday in holidays),
+            }
+            cache.set(HOLIDAY_CACHE_KEY, cached, timeout=settings.WORKDAY_CALENDAR_TTL)
+        return _get_calendar(cached)
+
+
+def _get_calendar(cached):
+    global _calendar
+
+    calendar = _calendar
+    if calendar is not None and calendar.fetched_at == cached['fetched_at']:
+        return calendar
+    if calendar is not None and calendar.holidays == frozenset(cached['holidays']):
+        # holidays were downloaded again but have not changed
+        calendar.fetched_at = cached['fetched_at']
+        return calendar
+    calendar = WorkdayCalendar(cached['holidays'], cached['fetched_at'])
+    _calendar = calendar
+    return calendar
@@ -280,8 +280,33 @@ BANK_STMT_OUTPUT_FILENAME = 'NMS{account_number}{date:%d%m%Y}.dat'
 
 DISBURSEMENT_TEMPLATE_FILEPATH = 'local_files/disbursement_template.xlsm'
 DISBURSEMENT_OUTPUT_FILENAME = 'mtp_disbursements_{date:%d%m%Y}.xlsm'
+# journal workbooks are streamed into copies of their templates rather than built with openpyxl
+STREAM_JOURNAL_WORKBOOKS = os.environ.get('STREAM_JOURNAL_WORKBOOKS', 'True') == 'True'
 
 REQUEST_PAGE_SIZE = 500
+# prison reference data is reloaded at most this often (in seconds)
+PRISON_CACHE_TTL = 60 * 60
+# but a stale copy is kept this long in case the api is unavailable
+PRISON_CACHE_STALE_TIMEOUT = 24 * 60 * 60
+# maximum number of pages of a list to load from the api in parallel
+REQUEST_PAGE_CONCURRENCY = int(os.environ.get('REQUEST_PAGE_CONCURRENCY', '4'))
+# transient api failures of idempotent requests are retried with exponential backoff and jitter,
+# up to this many times per operation (e.g. across all pages of a list)
+REQUEST_RETRY_BUDGET = int(os.environ.get('REQUEST_RETRY_BUDGET', '5'))
+REQUEST_RETRY_BASE_DELAY = 0.5  # seconds
+REQUEST_RETRY_MAX_DELAY = 10  # seconds
+# cached files can be sent by the web server instead of being streamed through the app:
+# set the header to X-Accel-Redirect (nginx) with a prefix of an internal location serving the file cache
+# or to X-Sendfile (uWSGI collect-header/response-route or Apache) without a prefix to send absolute paths
+FILE_DOWNLOAD_OFFLOAD_HEADER = os.environ.get('FILE_DOWNLOAD_OFFLOAD_HEADER', '')
+FILE_DOWNLOAD_OFFLOAD_PREFIX = os.environ.get('FILE_DOWNLOAD_OFFLOAD_PREFIX', '')
+# missing downloads shown on the dashboard are cached per user until a file is downloaded,
+# but only for this long since the cache is not shared between processes
+MISSING_DOWNLOADS_CACHE_TIMEOUT = 5 * 60  # seconds
+# bank holidays are downloaded once a day to build the shared workday calendar
+WORKDAY_CALENDAR_TTL = 24 * 60 * 60
+# maximum number of days to reconcile in parallel when a receipt date spans weekends or bank holidays
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '4'))
 
 ZENDESK_BASE_URL = 'https://ministryofjustice.zendesk.com'
 ZENDESK_API_USERNAME = os.environ.get('ZENDESK_API_USERNAME', '')
@@ -308,6 +333,15 @@ SHOW_LANGUAGE_SWITCH = os.environ.get('SHOW_LANGUAGE_SWITCH', 'False') == 'True'
 BANK_ADMIN_USERNAME = os.environ.get('BANK_ADMIN_USERNAME', 'refund-bank-admin')
 BANK_ADMIN_PASSWORD = os.environ.get('BANK_ADMIN_PASSWORD', 'refund-bank-admin')
 
+# files not cached are generated in the uWSGI spooler while users wait on a page that polls every few seconds;
+# generation still pending after the timeout is assumed to have been lost and is started again
+FILE_GENERATION_POLL_INTERVAL = 5  # seconds
+FILE_GENERATION_TIMEOUT = 15 * 60  # seconds
+# file generation can be profiled, writing a report of each stage's time and memory use to the profile path;
+# user administrators can also profile a download by adding `profile` to its query string
+PROFILE_FILE_GENERATION = os.environ.get('PROFILE_FILE_GENERATION', 'False') == 'True'
+FILE_GENERATION_PROFILE_PATH = 'local_files/profiles'
+
 # general ledger account code for prisoner monies holding bank account
 PRISONER_MONEY_HOLDING_ACCOUNT = '1841102059'
 